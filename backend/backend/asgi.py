@@ -5,11 +5,12 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 django.setup()
 
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.routing import ProtocolTypeRouter, URLRouter, ChannelNameRouter
 from channels.auth import AuthMiddlewareStack
-from chess_app.routing import websocket_urlpatterns
+from chess_app.routing import websocket_urlpatterns, channel_routes
 
 from chess_app.middlewares import TokenAuthMiddleWare
+from chess_app.persistence import lifespan
 
 # Initialize Django ASGI application early to ensure the AppRegistry
 # is populated before importing code that may import ORM models.
@@ -17,9 +18,11 @@ django_asgi_app = get_asgi_application()
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
+    "lifespan": lifespan,
     "websocket": TokenAuthMiddleWare(
         URLRouter(
             websocket_urlpatterns
         )
-    )
+    ),
+    "channel": ChannelNameRouter(channel_routes)
 })
\ No newline at end of file
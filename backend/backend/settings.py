@@ -1,5 +1,6 @@
 from pathlib import Path
 import os
+import tempfile
 
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -40,6 +41,7 @@ INSTALLED_APPS += [
     'rest_framework',
     'rest_framework.authtoken',
     'djoser',
+    'channels',  # runworker, for the game worker shards
 ]
 
 MIDDLEWARE = [
@@ -80,6 +82,112 @@ CHANNEL_LAYERS = {
     }
 }
 
+# DJANGO_CHANNEL_LAYER=sqlite shares groups and messages between the processes (uvicorn/daphne
+# workers, runworker shards) of one machine through a SQLite file (chess_app/layers.py). Any
+# other channels layer (e.g. channels_redis for several machines) can be set here instead.
+if os.getenv('DJANGO_CHANNEL_LAYER', 'memory') == 'sqlite':
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "chess_app.layers.SQLiteChannelLayer",
+            "CONFIG": {
+                "path": os.getenv('DJANGO_CHANNEL_LAYER_PATH', str(BASE_DIR / 'channels.sqlite3')),
+                "expiry": 60,  # seconds an undelivered message is kept
+                "group_expiry": 24 * 60 * 60,  # seconds a group membership lasts without being renewed
+                "capacity": 100,  # messages queued per channel
+            }
+        }
+    }
+
+# Live games are cached per process (chess_app/live.py), timeouts in seconds
+CHESS_LIVE_GAME_IDLE_TIMEOUT = 30 * 60
+CHESS_LIVE_GAME_ENDED_TIMEOUT = 60
+CHESS_LIVE_GAME_SWEEP_INTERVAL = 30
+
+# Write-behind persistence of moves (chess_app/persistence.py): broadcast first and
+# write Game / Clock fields in batches of CHESS_WRITE_BEHIND_BATCH or every
+# CHESS_WRITE_BEHIND_INTERVAL seconds
+CHESS_WRITE_BEHIND = (os.getenv('DJANGO_CHESS_WRITE_BEHIND', 'False') == 'True')
+CHESS_WRITE_BEHIND_BATCH = 200
+CHESS_WRITE_BEHIND_INTERVAL = 0.5
+
+# Lobby snapshot (chess_app/lobby.py): changes kept for delta syncs, and how often
+# (seconds) the snapshot is re-synced with the database
+CHESS_LOBBY_HISTORY = 1000
+CHESS_LOBBY_REFRESH_INTERVAL = 60
+
+# Websocket token -> user cache in TokenAuthMiddleWare, ttl in seconds. Logout clears
+# the token in the process that served it, other processes forget it after the ttl
+CHESS_TOKEN_CACHE_SIZE = 10000
+CHESS_TOKEN_CACHE_TTL = 60
+
+# Largest base time and increment (ms) a game can be created with
+CHESS_CLOCK_MAX_BASE = 3 * 60 * 60 * 1000
+CHESS_CLOCK_MAX_INCREMENT = 3 * 60 * 1000
+
+# A reconnecting player further behind than this many moves gets the fen instead of the moves
+CHESS_RESYNC_MAX_MOVES = 60
+
+# Seconds a player whose last socket on a game closed has to come back before they leave it
+# (connected flag off, game back to waiting, clock paused); 0 leaves right away
+CHESS_RECONNECT_GRACE = 10
+
+# Times an action is re-run on a fresh copy of the game when another worker updated it first
+CHESS_STALE_RETRIES = 3
+
+# Game worker shards: 0 plays every game in the process of its sockets. With N > 0 each game
+# is owned by one of the channels chess-games-0 .. chess-games-(N-1) (by room_id), run with
+# `python manage.py runworker chess-games-0 ...`, and sockets forward their actions to it.
+# Needs a channel layer shared by the processes.
+CHESS_GAME_SHARDS = int(os.getenv('DJANGO_CHESS_GAME_SHARDS', '0'))
+
+# GET /chess/ pages: games per page by default and the most a client may ask for with ?limit=
+CHESS_GAMES_PAGE_SIZE = 50
+CHESS_GAMES_MAX_PAGE_SIZE = 200
+
+# Spectators (ws/chess/<game_id>/watch/) get at most one frame per game every CHESS_WATCH_TICK
+# seconds; a process hands a frame to CHESS_WATCH_CHUNK of its spectators at a time, and waits
+# while player actions run (up to a tick) before the next ones
+CHESS_WATCH_TICK = 0.25
+CHESS_WATCH_CHUNK = 10
+
+# Flood protection on game sockets: token buckets refilled at RATE tokens per second up to BURST,
+# one per socket and one per user across their sockets. An action costs CHESS_ACTION_COSTS[action],
+# any other message CHESS_ACTION_COST_DEFAULT. Larger messages close the socket (1009), and so
+# does letting CHESS_SEND_BUFFER frames pile up unsent (1013).
+CHESS_RATE_LIMIT = (os.getenv('DJANGO_CHESS_RATE_LIMIT', 'True') == 'True')
+CHESS_SOCKET_RATE = 5
+CHESS_SOCKET_BURST = 20
+CHESS_USER_RATE = 10
+CHESS_USER_BURST = 40
+CHESS_ACTION_COSTS = {'make_move': 1, 'join_game': 2, 'resign_game': 2, 'claim_draw': 2, 'create_game': 10}
+CHESS_ACTION_COST_DEFAULT = 2
+CHESS_MAX_MESSAGE_BYTES = 4096
+CHESS_SEND_BUFFER = 256
+
+# Stale games, ended as abandoned by `python manage.py reap_games` or every CHESS_REAP_INTERVAL
+# seconds in the processes serving the lobby (0: off), by the age of their last update whatever their
+# connected flags say (a process that stopped may have left them set): waiting games nobody joined
+# after CHESS_REAP_WAITING_AFTER seconds, waiting games with two players after CHESS_REAP_DISCONNECTED_AFTER,
+# and active games after CHESS_REAP_ACTIVE_AFTER, longer than both clocks of the longest game can run
+CHESS_REAP_INTERVAL = int(os.getenv('DJANGO_CHESS_REAP_INTERVAL', '0'))
+CHESS_REAP_WAITING_AFTER = 10 * 60
+CHESS_REAP_DISCONNECTED_AFTER = 30 * 60
+CHESS_REAP_ACTIVE_AFTER = 2 * CHESS_CLOCK_MAX_BASE // 1000 + CHESS_REAP_DISCONNECTED_AFTER
+
+# In-process metrics of the websocket paths (chess_app/metrics.py) served at GET /chess/metrics/ in the
+# Prometheus text format, one scrape target per process. With a token set the endpoint wants
+# `Authorization: Bearer <token>`; without one it is only open with DEBUG on. Staff users may always read it.
+CHESS_METRICS = True
+CHESS_METRICS_TOKEN = os.getenv('DJANGO_CHESS_METRICS_TOKEN') or None
+
+# Sampling profiler of websocket actions (chess_app/profiling.py), off by default: with
+# DJANGO_CHESS_PROFILE=True one action in CHESS_PROFILE_EVERY[action] (CHESS_PROFILE_EVERY_DEFAULT)
+# runs under cProfile, added up per action in CHESS_PROFILE_DIR; read with `manage.py profile_actions`
+CHESS_PROFILE = (os.getenv('DJANGO_CHESS_PROFILE', 'False') == 'True')
+CHESS_PROFILE_EVERY = {'make_move': 1000}
+CHESS_PROFILE_EVERY_DEFAULT = 100
+CHESS_PROFILE_DIR = os.getenv('DJANGO_CHESS_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'chess-profiles'))
+
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
@@ -87,7 +195,7 @@ CHANNEL_LAYERS = {
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.getenv('DJANGO_DB_NAME', BASE_DIR / 'db.sqlite3'),
     }
 }
 
@@ -0,0 +1,802 @@
+# actions.py
+import json
+import zlib
+
+import chess
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from .models import Game, Clock
+from .live import registry
+from .persistence import writer, save_game, StaleWrite
+from . import clock as clocks
+from .lobby import lobby
+from .metrics import metrics
+from .presence import presence
+from .protocol import game_event, move_delta
+from .spectators import watch
+
+dev_flag = False  # flag to indicate where it is development or production
+
+STALE_RETRIES = getattr(settings, 'CHESS_STALE_RETRIES', 3)
+
+GAME_WORKER_CHANNEL = 'chess-games'
+
+MAX_BASE = getattr(settings, 'CHESS_CLOCK_MAX_BASE', 3 * 60 * 60 * 1000)
+MAX_INCREMENT = getattr(settings, 'CHESS_CLOCK_MAX_INCREMENT', 3 * 60 * 1000)
+
+
+def shard_channels():
+    """Channel names of the game worker shards, none when CHESS_GAME_SHARDS is 0"""
+    return [f'{GAME_WORKER_CHANNEL}-{shard}' for shard in range(getattr(settings, 'CHESS_GAME_SHARDS', 0))]
+
+
+def shard_channel(game_id):
+    """The worker channel owning game_id, None when sockets run their games themselves"""
+    shards = getattr(settings, 'CHESS_GAME_SHARDS', 0)
+    if not shards:
+        return None
+    # crc32, not hash(): every process must pick the same shard
+    return f'{GAME_WORKER_CHANNEL}-{zlib.crc32(game_id.encode()) % shards}'
+
+def clock_millis(value, low, high):
+    """A client's clock setting as whole milliseconds in [low, high], None if it is not one"""
+    if isinstance(value, str) and value.strip().isascii() and value.strip().isdigit():
+        value = int(value)
+    elif isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high:
+        return None
+    return value
+
+
+@database_sync_to_async
+def create_game(game_id, player1, player1_color, player2_color, current_turn, format, base, increment):
+    """Create the game and its clock in one transaction, None if the room is taken"""
+    with transaction.atomic():
+        if Game.objects.filter(room_id=game_id).exists():
+            return None
+        game = Game.objects.create(
+            player1=player1,
+            player1_color=player1_color,
+            player1_connected=True,
+            player2_color=player2_color,
+            current_turn=current_turn,
+            room_id=game_id,
+            format=format,
+            fen=chess.Board().fen(),
+            status="waiting"
+        )
+        clock = Clock.objects.create(
+            game=game,
+            total_time=base,
+            incremental_time=increment,
+            clock1=base,
+            clock2=base
+        )
+    return game, clock
+
+class GameActions:
+    """The websocket actions of one player's socket on one game
+
+    Runs in the process that owns the game: the socket's own consumer, or the
+    game's shard worker (see GameWorkerConsumer) that the socket forwards to.
+    Replies for the socket go through reply, a coroutine taking the text to send.
+    """
+
+    ACTIONS = ('create_game', 'join_game', 'make_move', 'resign_game', 'claim_draw')
+
+    @classmethod
+    def label(cls, action):
+        """The action's metrics label, from a bounded set: the client picks the string"""
+        return action if action in cls.ACTIONS else 'other'
+
+    def __init__(self, channel_layer, game_id, channel_name, user, reply):
+        self.channel_layer = metrics.timed_layer(channel_layer)
+        self.game_id = game_id
+        self.room_group_name = f'game_{game_id}'
+        self.channel_name = channel_name  # the socket's channel
+        self.user = user
+        self.reply = reply
+
+    async def send(self, text_data):
+        await self.reply(text_data)
+
+    async def run(self, action, data):
+        # spectators' frames are handed out between actions (see spectators.WatchHub)
+        watch.actions += 1
+        try:
+            await self.run_handle(action, data)
+        finally:
+            watch.actions -= 1
+
+    async def run_handle(self, action, data):
+        for attempt in range(STALE_RETRIES + 1):
+            try:
+                await self.handle(action, data, self.user)
+                return
+            except StaleWrite:
+                # another worker changed the game: act again on its current state
+                registry.evict(self.game_id)
+        await self.send(text_data=json.dumps({
+            'game': {},
+            'message': {
+                'type': 'only_me',
+                'info': 'invalid',
+                'error': 'Game changed, try again',
+                'player': {}
+            }
+        }))
+
+    async def leave(self):
+        """The socket closed: the player leaves the game when it was their last socket
+        there and they do not come back within the grace period (see presence.Presence)
+        """
+        await presence.leave(self.game_id, self.user.pk, self.channel_name, self.leave_now)
+
+    async def leave_now(self):
+        for attempt in range(STALE_RETRIES + 1):
+            try:
+                await self.leave_game(self.user)
+                return
+            except StaleWrite:
+                registry.evict(self.game_id)
+
+    async def leave_game(self, user):
+        live = await registry.get(self.game_id)
+        if live is not None:
+            game = live.game
+            # only a player leaving changes the game
+            if game.status != 'ended' and user in (game.player1, game.player2):
+                if user == game.player1:
+                    game.player1_connected = False
+                if user == game.player2:
+                    game.player2_connected = False
+                listed = game.status == 'waiting'
+                game.status = "waiting"
+                clocks.pause(live)
+                await save_game(game, ['player1_connected', 'player2_connected', 'status', 'updated_at'])
+                await clocks.save_clock(live)
+                if not listed:
+                    await lobby.publish_game(self.channel_layer, game, live.clock, user.username)
+                watch.publish(live)
+                if dev_flag: print(f"change => game : {game.room_id}  status to {game.status}, p1: {game.player1_connected} p2: {game.player2_connected}")
+
+    async def handle(self, action, data, user):
+        if action == 'create_game':
+            if dev_flag: print(f"{user.username} : action: create_game")
+            base = data.get('base', None)
+            increment = data.get('increment', None)
+            format = data.get('format', 'custom')
+            p1_color = data.get('color', 'white')
+            p2_color = 'black' if p1_color == 'white' else 'white'
+            curr_turn = 'player1' if p1_color == 'white' else 'player2'
+            if base is None or increment is None:
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': 'provide base, increment time',
+                        'player': {}
+                    } 
+                }))
+                return
+            base, increment = clock_millis(base, 1, MAX_BASE), clock_millis(increment, 0, MAX_INCREMENT)
+            if base is None or increment is None:
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': f'base must be 1 to {MAX_BASE} ms and increment 0 to {MAX_INCREMENT} ms',
+                        'player': {}
+                    }
+                }))
+                return
+            
+            # Create a new game
+            # Todo : ask user of color of player 1 (defualt is white)
+            created = await create_game(
+                game_id=self.game_id,
+                player1=user,
+                player1_color=p1_color,
+                player2_color=p2_color,
+                current_turn=curr_turn,
+                format=format,
+                base=base,
+                increment=increment,
+            )
+            if created is not None:
+                game, clock = created
+                registry.add(game, clock)
+                presence.join(self.game_id, user.pk, self.channel_name)
+            else:
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': 'Game already exists',
+                        'player': {}
+                    }
+                }))
+                return
+            
+            await self.channel_layer.group_add(
+                self.room_group_name,
+                self.channel_name
+            )
+            # Also send message to available room group
+            await lobby.publish(
+                self.channel_layer,
+                {
+                    'type': 'game.update',
+                    'game': {
+                        'game_id': self.game_id,
+                        'format': game.format,
+                        'clock': {
+                            'base': clock.total_time,
+                            'increment': clock.incremental_time,
+                            'started': clock.started_at.isoformat()
+                        },
+                        'player1': game.player1.username,
+                        'player1_color': game.player1_color,
+                        'player2_color': game.player2_color,
+                        'current_turn': game.current_turn,
+                    },
+                    'message': {
+                        'type': 'all',
+                        'info': 'available',
+                        'player': {
+                            'user': user.username
+                        }
+                    }
+                }
+            )
+
+            await self.send(text_data=json.dumps({
+                'game': {
+                    'game_id': self.game_id,
+                    'clock': {
+                        'base': clock.total_time,
+                        'increment': clock.incremental_time
+                    },
+                    'player1': user.username,
+                    'player1_color': game.player1_color,
+                    'player2_color': game.player2_color
+                },
+                'message': {
+                    'type': 'only_me',
+                    'info': 'created',
+                    'player': {
+                        'user': user.username,
+                        'color': game.player1_color,
+                    }
+                }
+            }))
+
+        elif action == 'join_game':
+            if dev_flag: print(f"{user.username} : action: join_game")
+            live = await registry.get(self.game_id)
+            game = live.game if live is not None else None
+            if game is None:
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': 'Game does not exists',
+                        'player': {}
+                    }
+                }))
+                return
+
+            # if game is in active state return (playing), unless a player comes back to it
+            if game.status == "active" and user not in (game.player1, game.player2):
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': 'Game is active!!',
+                        'player': {}
+                    }
+                }))
+                return
+            
+            # reconnect the players if game is still in waiting status
+            if game.player1 == user or game.player2 == user:
+                await self.channel_layer.group_add(
+                    self.room_group_name,
+                    self.channel_name
+                )
+                color = game.player1_color if game.player1 == user else game.player2_color
+                presence.join(self.game_id, user.pk, self.channel_name)
+                before = (game.player1_connected, game.player2_connected, game.status)
+                if game.player1 == user: game.player1_connected = True
+                elif game.player2 == user: game.player2_connected = True
+            
+                # If both players are connected (alive ws connection) and the game waits for them, set status to active
+                if game.player1_connected and game.player2_connected and game.status == 'waiting':
+                    game.status = 'active'
+                    if live.board.move_stack:
+                        clocks.start_turn(live)
+                # back within the grace period, or another tab: nothing to write
+                if (game.player1_connected, game.player2_connected, game.status) != before:
+                    await save_game(game, ['player1_connected', 'player2_connected', 'status', 'updated_at'])
+                    if game.status != before[2]:
+                        await lobby.publish_game(self.channel_layer, game, live.clock, user.username)
+                    watch.publish(live)
+
+                await self.channel_layer.group_send(
+                    self.room_group_name,
+                    game_event(
+                        {
+                            'game_id': self.game_id,
+                            'status': game.status,
+                            'winner': game.winner,
+                            'over_type': game.over_type,
+                            'fen': game.fen,
+                            'player1': game.player1.username,
+                            'player1_color': game.player1_color,
+                            'player1_connected': game.player1_connected,
+                            'player2': game.player2.username if game.player2 else 'null',
+                            'player2_color': game.player2_color,
+                            'player2_connected': game.player2_connected,
+                            'current_turn': game.current_turn,
+                            'ply': live.ply,
+                        },
+                        {
+                            'type': 'both',
+                            'info': 'reconnected',
+                            'player': {
+                                'user': user.username,
+                                'color': color
+                            }
+                        }
+                    )
+                )
+
+                # only the reconnecting socket needs the moves it missed
+                last_ply = data.get('last_ply', 0)
+                if not isinstance(last_ply, int) or isinstance(last_ply, bool) or last_ply < 0:
+                    last_ply = 0
+                missing = live.moves_since(last_ply) if last_ply <= live.ply else None
+                if missing is not None and len(missing) <= settings.CHESS_RESYNC_MAX_MOVES:
+                    resync = {'game_id': self.game_id, 'ply': live.ply, 'from_ply': last_ply, 'moves': missing}
+                else:
+                    # too far behind (or history unknown): the position is enough to carry on
+                    resync = {'game_id': self.game_id, 'ply': live.ply, 'fen': game.fen, 'snapshot': True}
+                await self.send(text_data=json.dumps({
+                    'game': resync,
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'resync',
+                        'player': {
+                            'user': user.username,
+                            'color': color
+                        }
+                    }
+                }))
+                return
+            
+            if game.player2 is None:
+                game.player2 = user
+                game.player2_connected = True
+                # If both players are connected (player1 is also connected to ws), set status to active
+                if game.player1_connected:
+                    game.status = 'active'
+                await save_game(game, ['player2', 'player2_connected', 'status', 'updated_at'])
+                presence.join(self.game_id, user.pk, self.channel_name)
+
+                await self.channel_layer.group_add(
+                    self.room_group_name,
+                    self.channel_name
+                )
+                # Broadcast the join info to the group
+                await self.channel_layer.group_send(
+                    self.room_group_name,
+                    game_event(
+                        {
+                            'game_id': self.game_id,
+                            'status': game.status,
+                            'player1': game.player1.username,
+                            'player1_color': game.player1_color,
+                            'player2': game.player2.username,
+                            'player2_color': game.player2_color,
+                            'current_turn': game.current_turn,
+                        },
+                        {
+                            'type': 'both',
+                            'info': 'joined',
+                            'player': {
+                                'user': user.username,
+                                'color': game.player2_color
+                            }
+                        }
+                    )
+                )
+                
+                # broadcast the game status to avialable_games room: taken, or still listed
+                # (as the lobby query would) with both players while player1 is away
+                await lobby.publish_game(self.channel_layer, game, live.clock, user.username)
+                watch.publish(live)
+            else:
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': 'Game is full',
+                        'player': {}
+                    }
+                }))
+        
+        elif action == 'make_move':
+            if dev_flag: print(f"{user.username} : action: make_move")
+            live = await registry.get(self.game_id)
+            game = live.game if live is not None else None
+            if game is None:
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': 'Game does not exists',
+                        'player': {}
+                    }
+                }))
+                return
+            color = game.player1_color if game.player1 == user else game.player2_color   # color of the move maker
+
+            if user != game.player1 and user != game.player2:
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': 'You are not a player in this game',
+                        'player': {}
+                    }
+                }))
+                return
+            
+            if game.status == 'ended':
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': "game has already ended",
+                        'player': {
+                            'user': user.username,
+                            'color': color
+                        }
+                    }
+                }))
+                return
+            
+            if game.status != 'active':
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': 'Game is not active',
+                        'player': {}
+                    }
+                }))
+                return
+
+            turn = game.current_turn
+            if (turn == "player1" and user == game.player2) or (turn == "player2" and user == game.player1):
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': 'not your turn',
+                        'player': {}
+                    }
+                }))
+                return
+            
+            if "move" not in data:
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': 'no move to make',
+                        'player': {}
+                    }
+                }))
+                return
+
+            move = data['move']
+            if dev_flag: print(f'{user.username} :: make_move :: move : {move}')
+            try:
+                chess_move = chess.Move.from_uci(move) if isinstance(move, str) else None
+            except ValueError:
+                chess_move = None
+            # checked before anything changes, junk must not cost a reload of the game
+            if chess_move is None or chess_move not in live.board.legal_moves:
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': "illegal move",
+                        'player': {
+                            'user': user.username,
+                            'color': color
+                        }
+                    }
+                }))
+                return
+
+            try:
+                board = live.board
+                if not clocks.charge_move(live):
+                    # the mover's flag fell before the scheduler noticed
+                    await clocks.end_on_time(live)
+                    return
+
+                live.push(chess_move)
+
+                # add new FEN to game and check if game if over or not
+                game.fen = board.fen()
+                game.current_turn = "player2" if user == game.player1 else "player1"
+                
+                outcome = live.outcome()
+                if outcome:
+                    over_type = ''
+                    winner = ''
+                    if outcome.winner == chess.WHITE:
+                        if dev_flag: print("white won")
+                        over_type = 'checkmate'
+                        winner = 'player1' if game.player1_color == 'white' else 'player2'
+
+                    elif outcome.winner == chess.BLACK:
+                        over_type = 'checkmate'
+                        winner = 'player1' if game.player1_color == 'black' else 'player2'
+                        if dev_flag: print("black won")
+
+                    else:
+                        over_type = 'draw'
+                        if dev_flag: print("draw")
+                    game.status = 'ended'
+                    game.over_type = over_type
+                    game.winner = winner
+                    live.end()
+                    clocks.stop(live)
+                else:
+                    clocks.start_turn(live)
+
+                # the move itself is stored in the game's packed history (moves_packed, move_times);
+                # with write-behind the rows are written with the next batch, after the broadcast
+                await save_game(game, ['fen', 'current_turn', 'status', 'over_type', 'winner', 'moves_packed', 'move_times', 'updated_at'])
+                await clocks.save_clock(live)
+
+                # Broadcast the move to the group
+                await self.channel_layer.group_send(
+                    self.room_group_name,
+                    game_event(
+                        {
+                            'game_id': self.game_id,
+                            'fen': game.fen,
+                            'move': move,
+                            'ply': live.ply,
+                            'player1': game.player1.username,
+                            'player1_color': game.player1_color,
+                            'player2': game.player2.username,
+                            'player2_color': game.player2_color,
+                            'current_turn': game.current_turn,
+                            'status': game.status,
+                            'winner': game.winner,
+                            'over_type': game.over_type,
+                            'clock': clocks.clock_payload(live)
+                        },
+                        {
+                            'type': 'both',
+                            'info': 'moved',
+                            'player': {
+                                'user': user.username,
+                                'color': color
+                            }
+                        },
+                        move_delta(game, live, user.username)
+                    )
+                )
+                watch.publish(live)
+                if writer.enabled and game.status == 'ended':
+                    await writer.flush()
+            except StaleWrite:
+                raise
+            except Exception as e:
+                # the live state may be ahead of the database now, reload it on next access
+                registry.evict(self.game_id)
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': str(e),
+                        'player': {
+                            'user': user.username
+                        }
+                    }
+                }))
+
+        elif action == 'resign_game':
+            live = await registry.get(self.game_id)
+            if live is None:
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': 'Game does not exist',
+                        'player': {}
+                    }
+                }))
+                return
+            game = live.game
+
+            if user != game.player1 and user != game.player2:
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': 'You are not a player in this game',
+                        'player': {}
+                    }
+                }))
+                return
+
+            if game.status == 'ended':
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': 'Game has already ended',
+                        'player': {}
+                    }
+                }))
+                return
+
+            # Set game as ended and declare winner
+            listed = game.status == 'waiting'
+            game.status = 'ended'
+            game.over_type = 'resign'
+            game.winner = 'player2' if user == game.player1 else 'player1'
+            live.end()
+            clocks.pause(live)
+            await save_game(game, ['status', 'over_type', 'winner', 'updated_at'])
+            await clocks.save_clock(live)
+            if listed:
+                # resigned while the opponent was away
+                await lobby.publish_game(self.channel_layer, game, live.clock, user.username)
+            watch.publish(live)
+            if writer.enabled:
+                await writer.flush()
+
+            user_color = game.player1_color if user == game.player1 else game.player2_color
+            winner_color = game.player1_color if user == game.player2 else game.player2_color
+
+            # Broadcast resignation to both players
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                game_event(
+                    {
+                        'game_id': self.game_id,
+                        'fen': game.fen,
+                        'move': 'null',
+                        'player1': game.player1.username,
+                        'player1_color': game.player1_color,
+                        'player2': game.player2.username,
+                        'player2_color': game.player2_color,
+                        'current_turn': game.current_turn,
+                        'status': game.status,
+                        'winner': game.winner,
+                        'over_type': game.over_type
+                    },
+                    {
+                        'type': 'both',
+                        'info': 'resigned',
+                        'player': {
+                            'user': user.username,
+                            'color': user_color
+                        }
+                    }
+                )
+            )
+
+        elif action == 'claim_draw':
+            # threefold repetition or fifty moves: the player to move may end the game as a draw
+            live = await registry.get(self.game_id)
+            game = live.game if live is not None else None
+            error = None
+            if game is None:
+                error = 'Game does not exist'
+            elif user != game.player1 and user != game.player2:
+                error = 'You are not a player in this game'
+            elif game.status != 'active':
+                error = 'Game is not active'
+            elif (game.current_turn == 'player1') != (user == game.player1):
+                error = 'not your turn'
+            elif not live.can_claim_draw():
+                error = 'no draw to claim'
+            if error is not None:
+                await self.send(text_data=json.dumps({
+                    'game': {},
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': error,
+                        'player': {}
+                    }
+                }))
+                return
+
+            game.status = 'ended'
+            game.over_type = 'draw'
+            game.winner = None
+            live.end()
+            clocks.pause(live)
+            await save_game(game, ['status', 'over_type', 'winner', 'updated_at'])
+            await clocks.save_clock(live)
+            watch.publish(live)
+            if writer.enabled:
+                await writer.flush()
+
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                game_event(
+                    {
+                        'game_id': self.game_id,
+                        'fen': game.fen,
+                        'move': 'null',
+                        'player1': game.player1.username,
+                        'player1_color': game.player1_color,
+                        'player2': game.player2.username,
+                        'player2_color': game.player2_color,
+                        'current_turn': game.current_turn,
+                        'status': game.status,
+                        'winner': game.winner,
+                        'over_type': game.over_type,
+                        'clock': clocks.clock_payload(live)
+                    },
+                    {
+                        'type': 'both',
+                        'info': 'draw_claimed',
+                        'player': {
+                            'user': user.username,
+                            'color': game.player1_color if user == game.player1 else game.player2_color
+                        }
+                    }
+                )
+            )
+
+        # elif action == 'abort_game':
+        #     pass
+
+        # elif action == 'draw_request':
+        #     pass
+        else:
+            # the payload is not sent back, a small message must not buy a large reply
+            await self.send(text_data=json.dumps({
+                'game': {},
+                'message': {
+                    'type': 'only_me',
+                    'info': 'invalid',
+                    'error': 'Unknown action',
+                    'player': {
+                        'user': user.username
+                    }
+                }
+            }))
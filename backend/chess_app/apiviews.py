@@ -1,13 +1,77 @@
-from rest_framework.response import Response
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Q
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
 from rest_framework.permissions import IsAuthenticated
 
-from .models import Game, Move
-from .serializers import GameSerializer
+from .models import Game
+from .serializers import GAME_LIST_VALUES, game_list_data
+
+
+class GamePagination(CursorPagination):
+    """Keyset pages, newest games first; ?limit= sets the page size"""
+    ordering = ('-created_at', '-room_id')
+    page_size = getattr(settings, 'CHESS_GAMES_PAGE_SIZE', 50)
+    page_size_query_param = 'limit'
+    max_page_size = getattr(settings, 'CHESS_GAMES_MAX_PAGE_SIZE', 200)
+
+
+def choice_filter(request, name, choices):
+    """Values of a comma separated ?name= filter, None when it is absent"""
+    value = request.query_params.get(name)
+    if not value:
+        return None
+    values = value.split(',')
+    allowed = [choice for choice, _ in choices]
+    if not set(values) <= set(allowed):
+        raise ValidationError({name: f'must be one or more of {", ".join(allowed)}'})
+    return values
+
+
+def filter_games(request):
+    games = Game.objects.all()
+    status = choice_filter(request, 'status', Game.STATUS_CHOICES)
+    if status is not None:
+        games = games.filter(status__in=status)
+    # not ?format=, DRF reads that one to pick the renderer
+    formats = choice_filter(request, 'formats', Game.FORMAT_CHOICES)
+    if formats is not None:
+        games = games.filter(format__in=formats)
+    player = request.query_params.get('player')
+    if player:
+        player_ids = User.objects.filter(username=player).values('pk')
+        games = games.filter(Q(player1__in=player_ids) | Q(player2__in=player_ids))
+    return games
+
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_games(request):
-    games = Game.objects.all()
-    serializer = GameSerializer(games, many=True)
-    return Response(serializer.data)
\ No newline at end of file
+    """Games one page at a time, filterable by ?status=, ?formats= and ?player=<username>
+
+    The page carries an ETag so a client polling with If-None-Match gets a 304 while
+    nothing on it changed. No Last-Modified: a game leaving a filtered page changes the
+    page but not the newest updated_at on it.
+    """
+    paginator = GamePagination()
+    rows = paginator.paginate_queryset(filter_games(request).values(*GAME_LIST_VALUES), request)
+
+    # version is bumped by every update of a game, so the ids and versions stand in for the page
+    digest = hashlib.md5()
+    for row in rows:
+        digest.update(f'{row["room_id"]}:{row["version"]}:{row["updated_at"].isoformat()};'.encode())
+    digest.update(f'{paginator.get_next_link()}|{paginator.get_previous_link()}'.encode())
+    etag = quote_etag(digest.hexdigest())
+
+    not_modified = get_conditional_response(request._request, etag=etag)
+    if not_modified is not None:
+        return not_modified
+    response = paginator.get_paginated_response(game_list_data(rows))
+    response['ETag'] = etag
+    return response
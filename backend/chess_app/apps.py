@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ChessConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chess_app'
+
+    def ready(self):
+        # connects the token cache invalidation signals
+        from . import middlewares  # noqa: F401
@@ -0,0 +1,259 @@
+# clock.py
+import asyncio
+import heapq
+import logging
+import time
+
+import chess
+from channels.layers import get_channel_layer
+
+from .live import registry
+from .metrics import metrics
+from .persistence import writer, save_game, StaleWrite
+from .protocol import game_event
+from . import spectators
+from .tasks import spawn
+
+logger = logging.getLogger(__name__)
+
+
+class FlagScheduler:
+    """Flag-fall deadlines for every game in the process on one heap, served by a single timer
+
+    Rescheduling a game bumps its generation; the old heap entry stays behind and is skipped
+    when popped (and compacted away once stale entries outnumber live ones).
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.heap = []  # (deadline, generation, room_id)
+        self.generations = {}  # room_id -> generation of its live entry
+        self.counter = 0
+        self.timer = None
+        self.timer_deadline = None
+        self.tasks = set()  # flag-fall callbacks running
+        self.fired = 0
+
+    def __len__(self):
+        return len(self.generations)
+
+    def schedule(self, room_id, deadline):
+        """Call back for room_id at deadline (time.monotonic() seconds), replacing any earlier schedule"""
+        self.counter += 1
+        self.generations[room_id] = self.counter
+        heapq.heappush(self.heap, (deadline, self.counter, room_id))
+        if len(self.heap) > 2 * len(self.generations) + 64:
+            self.compact()
+        self.arm()
+
+    def cancel(self, room_id):
+        self.generations.pop(room_id, None)
+
+    def clear(self):
+        """Drop every deadline and the timer (tests and benchmarks, before a new event loop)"""
+        if self.timer is not None:
+            self.timer.cancel()
+        self.heap, self.generations, self.tasks = [], {}, set()
+        self.timer, self.timer_deadline = None, None
+
+    def compact(self):
+        self.heap = [entry for entry in self.heap if self.generations.get(entry[2]) == entry[1]]
+        heapq.heapify(self.heap)
+
+    def arm(self):
+        if not self.heap:
+            return
+        deadline = self.heap[0][0]
+        if self.timer is not None and self.timer_deadline <= deadline:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer_deadline = deadline
+        self.timer = asyncio.get_running_loop().call_later(max(0.0, deadline - time.monotonic()), self.fire)
+
+    def fire(self):
+        self.timer, self.timer_deadline = None, None
+        now = time.monotonic()
+        while self.heap and self.heap[0][0] <= now:
+            _, generation, room_id = heapq.heappop(self.heap)
+            if self.generations.get(room_id) != generation:
+                continue
+            del self.generations[room_id]
+            self.fired += 1
+            if self.callback is not None:
+                spawn(self.callback(room_id), self.tasks)
+        if self.heap:
+            self.arm()
+
+
+def clock_field(turn):
+    return 'clock1' if turn == 'player1' else 'clock2'
+
+
+def remaining(live, now=None):
+    """Milliseconds left for the side to move, counting the running turn"""
+    clock = live.clock
+    left = getattr(clock, clock_field(live.game.current_turn))
+    if live.turn_started is not None:
+        now = now if now is not None else time.monotonic()
+        left -= int((now - live.turn_started) * 1000)
+    return left
+
+
+def start_turn(live, now=None):
+    """Start the clock of the side to move and schedule its flag-fall"""
+    if live.clock is None:
+        return
+    now = now if now is not None else time.monotonic()
+    live.turn_started = now
+    scheduler.schedule(live.game.room_id, now + max(0, remaining(live, now)) / 1000)
+
+
+def resume(live):
+    """Registry hook for a game loaded while its clock runs (see live.restore): schedule its flag-fall"""
+    if live.turn_started is not None:
+        start_turn(live, live.turn_started)
+
+
+def charge_move(live, now=None):
+    """Charge the mover for the time spent on this move and add the increment
+
+    Returns False, without adding the increment, if the mover had already flagged.
+    Must run before current_turn is switched to the opponent.
+    """
+    if live.clock is None:
+        return True
+    now = now if now is not None else time.monotonic()
+    left = remaining(live, now)
+    field = clock_field(live.game.current_turn)
+    live.turn_started = None
+    scheduler.cancel(live.game.room_id)
+    if left <= 0:
+        setattr(live.clock, field, 0)
+        return False
+    setattr(live.clock, field, left + live.clock.incremental_time)
+    return True
+
+
+def pause(live, now=None):
+    """Stop the running clock (game left active) keeping the time already used"""
+    if live.clock is None or live.turn_started is None:
+        return
+    field = clock_field(live.game.current_turn)
+    setattr(live.clock, field, max(0, remaining(live, now)))
+    live.turn_started = None
+    scheduler.cancel(live.game.room_id)
+
+
+def stop(live):
+    live.turn_started = None
+    scheduler.cancel(live.game.room_id)
+
+
+def timeout(live):
+    """End the game on time: the opponent wins unless they cannot mate"""
+    game = live.game
+    flagged = game.current_turn
+    setattr(live.clock, clock_field(flagged), 0)
+    opponent = 'player2' if flagged == 'player1' else 'player1'
+    opponent_color = game.player1_color if opponent == 'player1' else game.player2_color
+    stop(live)
+    game.status = 'ended'
+    game.over_type = 'timeout'
+    if live.board.has_insufficient_material(chess.WHITE if opponent_color == 'white' else chess.BLACK):
+        game.winner = None
+    else:
+        game.winner = opponent
+    live.end()
+
+
+async def save_clock(live):
+    if live.clock is None:
+        return
+    if writer.enabled:
+        writer.queue_update(live.clock, ['clock1', 'clock2'])
+    else:
+        await live.clock.asave(update_fields=['clock1', 'clock2'])
+
+
+def clock_payload(live):
+    if live.clock is None:
+        return None
+    return {
+        'clock1': live.clock.clock1,
+        'clock2': live.clock.clock2,
+        'increment': live.clock.incremental_time,
+    }
+
+
+async def flag_fall(room_id):
+    """Scheduler callback: end the game if the side to move is still out of time
+
+    A game evicted from the registry since (failed or stale save) is loaded again,
+    with its running turn restored from the database.
+    """
+    live = await registry.get(room_id)
+    if live is None or live.game.status != 'active' or live.turn_started is None:
+        return
+    if remaining(live) > 0:
+        start_turn(live, live.turn_started)  # fired early, wait for the real deadline
+        return
+    try:
+        await end_on_time(live)
+    except StaleWrite:
+        pass  # another worker changed the game, it ends the game on its own clock
+
+
+async def end_on_time(live):
+    """End the game as lost on time by the side to move, save it and tell both players
+
+    Raises StaleWrite (with the live game evicted) when another worker changed the game first.
+    """
+    game = live.game
+    room_id = game.room_id
+    flagged = game.current_turn
+    timeout(live)
+    try:
+        await save_game(game, ['status', 'over_type', 'winner', 'updated_at'])
+        await save_clock(live)
+        if writer.enabled:
+            await writer.flush()
+    except StaleWrite:
+        registry.evict(room_id)
+        raise
+    except Exception:
+        logger.exception("saving timeout of game %s failed", room_id)
+        registry.evict(room_id)
+
+    await metrics.timed_layer(get_channel_layer()).group_send(
+        f'game_{room_id}',
+        game_event(
+            {
+                'game_id': room_id,
+                'fen': game.fen,
+                'move': 'null',
+                'player1': game.player1.username,
+                'player1_color': game.player1_color,
+                'player2': game.player2.username,
+                'player2_color': game.player2_color,
+                'current_turn': game.current_turn,
+                'status': game.status,
+                'winner': game.winner,
+                'over_type': game.over_type,
+                'clock': clock_payload(live),
+            },
+            {
+                'type': 'both',
+                'info': 'timeout',
+                'player': {
+                    'user': getattr(game, flagged).username,
+                    'color': game.player1_color if flagged == 'player1' else game.player2_color
+                }
+            }
+        )
+    )
+    spectators.watch.publish(live)
+
+
+scheduler = FlagScheduler(flag_fall)
+registry.on_load = resume
@@ -1,16 +1,66 @@
 # consumers.py
-from channels.generic.websocket import WebsocketConsumer
-from .models import Game, Clock, Move
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.consumer import AsyncConsumer
+from channels.exceptions import StopConsumer
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from .actions import GameActions, shard_channel, dev_flag
+from .live import registry, load_game
+from .lobby import lobby, LobbyFilter, LOBBY_GROUP, event_entry
+from .metrics import metrics
+from .profiling import profiler
+from .protocol import negotiate, event_frame
+from .ratelimit import limiter
+from .reaper import reaper
+from .spectators import watch, watch_frame
+from collections import deque
+import asyncio
 import json
-from asgiref.sync import async_to_sync
-import chess
 
-dev_flag = False  # flag to indicate where it is development or production
+WATCH_SNAPSHOT_TIMEOUT = 5  # seconds a shard worker has to answer for a spectator's first frame
 
-class ChessConsumer(WebsocketConsumer):
-    def connect(self):
+
+class MeteredConsumer:
+    """Times connect and disconnect and counts the open sockets (metrics.metrics)"""
+
+    metrics_name = None
+    metered = False  # accepted and counted in chess_sockets
+
+    async def websocket_connect(self, message):
+        with metrics.span(self.metrics_name, 'connect'):
+            await super().websocket_connect(message)
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol, headers)
+        if not self.metered:
+            self.metered = True
+            metrics.sockets.inc(self.metrics_name)
+
+    async def websocket_disconnect(self, message):
+        if self.metered:
+            self.metered = False
+            metrics.sockets.dec(self.metrics_name)
+        with metrics.span(self.metrics_name, 'disconnect'):
+            try:
+                await super().websocket_disconnect(message)
+            except StopConsumer:
+                # how every consumer ends, not a failure of its disconnect
+                pass
+        raise StopConsumer()
+
+
+class ChessConsumer(MeteredConsumer, AsyncWebsocketConsumer):
+    metrics_name = 'game'
+
+    async def connect(self):
         self.game_id = self.scope['url_route']['kwargs'].get('game_id')
         self.room_group_name = f'game_{self.game_id}' if self.game_id else None
+        subprotocol, self.wire = negotiate(self.scope)
+        self.bucket = limiter.socket_bucket()
+        self.limited = False
+        self.outbox = deque()  # frames not written to the socket yet
+        self.sending = None
+        self.closing = False
         user = self.scope['user']
 
         if user.username:
@@ -18,51 +68,49 @@ class ChessConsumer(WebsocketConsumer):
  
             if self.room_group_name:
                 # Join the game group
-                async_to_sync(self.channel_layer.group_add)(
+                await self.channel_layer.group_add(
                     self.room_group_name,
                     self.channel_name
                 )
-                self.accept()
-                self.send(text_data=json.dumps({ 
+                await self.accept(subprotocol)
+                await self.send(text_data=json.dumps({ 
                     'game': {},
                     'message': {
                         'type': 'only_me',
                         'info': 'connected',
+                        'protocol': self.wire,
                         'player': {
                             'user': user.username
                         }
                     }
                 }))
             else:
-                self.close()
+                await self.close()
         else:
             if dev_flag: print(f"no user and received gameid = {self.game_id}")
-            self.close()
+            await self.close()
     
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
+        if self.sending is not None:
+            self.sending.cancel()
         if self.room_group_name:
             if "user" in self.scope:
-                user = self.scope["user"]
-                if Game.objects.filter(room_id=self.game_id).exists():
-                    game = Game.objects.get(room_id=self.game_id)
-                    if game is not None:
-                        if game.status != 'ended':
-                            if user == game.player1:
-                                game.player1_connected = False
-                            if user == game.player2:
-                                game.player2_connected = False
-                            game.status = "waiting"
-                            game.save()
-                            if dev_flag: print(f"change => game : {game.room_id}  status to {game.status}, p1: {game.player1_connected} p2: {game.player2_connected}")
-            async_to_sync(self.channel_layer.group_discard)(self.room_group_name, self.channel_name)
+                await self.run_action(None, None)
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
     
-    def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
+        if len(text_data or bytes_data or '') > limiter.max_message_bytes:
+            limiter.oversized += 1
+            await self.close(code=1009)  # message too big
+            return
         try:
             data = json.loads(text_data)
             action = data.get('action')
             user = self.scope['user']
         except Exception as e:
-            self.send(text_data=json.dumps({
+            if await self.limit(None):
+                return
+            await self.send(text_data=json.dumps({
                 'game': {},
                 'message': {
                     'type': 'only_me',
@@ -72,578 +120,230 @@ class ChessConsumer(WebsocketConsumer):
                 } 
             }))
             return
-        
-        if action == 'create_game':
-            if dev_flag: print(f"{user.username} : action: create_game")
-            base = data.get('base', None)
-            increment = data.get('increment', None)
-            format = data.get('format', 'custom')
-            p1_color = data.get('color', 'white')
-            p2_color = 'black' if p1_color == 'white' else 'white'
-            curr_turn = 'player1' if p1_color == 'white' else 'player2'
-            if base is None or increment is None:
-                self.send(text_data=json.dumps({
-                    'game': {},
-                    'message': {
-                        'type': 'only_me',
-                        'info': 'invalid',
-                        'error': 'provide base, increment time',
-                        'player': {}
-                    } 
-                }))
-                return
-            
-            # Create a new game
-            if not Game.objects.filter(room_id=self.game_id).exists():
-                # Todo : ask user of color of player 1 (defualt is white)
-                game = Game.objects.create(
-                    player1=user,
-                    player1_color=p1_color,
-                    player1_connected=True,
-                    player2_color=p2_color,
-                    current_turn=curr_turn,
-                    room_id=self.game_id,
-                    format=format,
-                    fen=chess.Board().fen(),
-                    status="waiting"
-                )
-                clock = Clock.objects.create(
-                    game=game,
-                    total_time=base,
-                    incremental_time=increment,
-                    clock1=base,
-                    clock2=base
-                )
-            else:
-                self.send(text_data=json.dumps({
-                    'game': {},
-                    'message': {
-                        'type': 'only_me',
-                        'info': 'invalid',
-                        'error': 'Game already exists',
-                        'player': {}
-                    }
-                }))
-                return
-            
-            async_to_sync(self.channel_layer.group_add)(
-                self.room_group_name,
-                self.channel_name
-            )
-            # Also send message to available room group
-            async_to_sync(self.channel_layer.group_send)(
-                'available_games',
-                {
-                    'type': 'game.update',
-                    'game': {
-                        'game_id': self.game_id,
-                        'format': game.format,
-                        'clock': {
-                            'base': clock.total_time,
-                            'increment': clock.incremental_time,
-                            'started': clock.started_at.isoformat()
-                        },
-                        'player1': game.player1.username,
-                        'player1_color': game.player1_color,
-                        'player2_color': game.player2_color,
-                        'current_turn': game.current_turn,
-                    },
-                    'message': {
-                        'type': 'all',
-                        'info': 'available',
-                        'player': {
-                            'user': user.username
-                        }
-                    }
-                }
-            )
 
-            self.send(text_data=json.dumps({
-                'game': {
-                    'game_id': self.game_id,
-                    'clock': {
-                        'base': clock.total_time,
-                        'increment': clock.incremental_time
-                    },
-                    'player1': user.username,
-                    'player1_color': game.player1_color,
-                    'player2_color': game.player2_color
-                },
+        if await self.limit(action):
+            return
+        label = GameActions.label(action)
+        with metrics.span('game', label), profiler.sample(label):
+            await self.run_action(action, data)
+
+    async def limit(self, action):
+        """True when the socket or its user is over the rate limit, the client is told once per burst"""
+        retry_after = limiter.check(self.bucket, self.scope['user'].pk, action)
+        if not retry_after:
+            self.limited = False
+            return False
+        if not self.limited:
+            self.limited = True
+            await self.send(text_data=json.dumps({
+                'game': {},
                 'message': {
                     'type': 'only_me',
-                    'info': 'created',
-                    'player': {
-                        'user': user.username,
-                        'color': game.player1_color,
-                    }
+                    'info': 'limited',
+                    'error': 'Too many messages, slow down',
+                    'retry_after': round(retry_after, 2),
+                    'player': {}
                 }
             }))
+        return True
 
-        elif action == 'join_game':
-            if dev_flag: print(f"{user.username} : action: join_game")
-            try:
-                game = Game.objects.get(room_id=self.game_id)
-            except Game.DoesNotExist:
-                game = None
-            if game is None:
-                self.send(text_data=json.dumps({
-                    'game': {},
-                    'message': {
-                        'type': 'only_me',
-                        'info': 'invalid',
-                        'error': 'Game does not exists',
-                        'player': {}
-                    }
-                }))
-                return
-
-            # if game is in active state return (playing)
-            if game.status == "active":
-                self.send(text_data=json.dumps({
-                    'game': {},
-                    'message': {
-                        'type': 'only_me',
-                        'info': 'invalid',
-                        'error': 'Game is active!!',
-                        'player': {}
-                    }
-                }))
-                return
-            
-            # reconnect the players if game is still in waiting status
-            if game.player1 == user or game.player2 == user:
-                async_to_sync(self.channel_layer.group_add)(
-                    self.room_group_name,
-                    self.channel_name
-                )
-                color = game.player1_color if game.player1 == user else game.player2_color
-                if game.player1 == user: game.player1_connected = True
-                elif game.player2 == user: game.player2_connected = True
-            
-                # Broadcast the join info to the group
-                # Get all moves for this game
-                moves = list(Move.objects.filter(game=game).values('move', 'played_at'))
-                # Convert datetime to string format
-                for move in moves:
-                    move['played_at'] = move['played_at'].isoformat() if move['played_at'] else None
-                
-                # If both players are connected (alive ws connection) and game is not ended, set status to active
-                if game.player1_connected and game.player2_connected and game.status != 'ended':
-                    game.status = 'active'
-                game.save()
-
-                async_to_sync(self.channel_layer.group_send)(
-                    self.room_group_name,
-                    {
-                        'type': 'game.send',
-                        'game': {
-                            'game_id': self.game_id,
-                            'status': game.status,
-                            'winner': game.winner,
-                            'over_type': game.over_type,
-                            'fen': game.fen,
-                            'player1': game.player1.username,
-                            'player1_color': game.player1_color,
-                            'player1_connected': game.player1_connected,
-                            'player2': game.player2.username if game.player2 else 'null',
-                            'player2_color': game.player2_color,
-                            'player2_connected': game.player2_connected,
-                            'current_turn': game.current_turn,
-                            'moves': moves,
-                        },
-                        'message': {
-                            'type': 'both',
-                            'info': 'reconnected',
-                            'player': {
-                                'user': user.username,
-                                'color': color
-                            }
-                        }
-                    }
-                )
-                return
-            
-            if game.player2 is None:
-                game.player2 = user
-                game.player2_connected = True
-                # If both players are connected (player1 is also connected to ws), set status to active
-                if game.player1_connected:
-                    game.status = 'active'
-                game.save()
-
-                async_to_sync(self.channel_layer.group_add)(
-                    self.room_group_name,
-                    self.channel_name
-                )
-                # Broadcast the join info to the group
-                async_to_sync(self.channel_layer.group_send)(
-                    self.room_group_name,
-                    {
-                        'type': 'game.send',
-                        'game': {
-                            'game_id': self.game_id,
-                            'status': game.status,
-                            'player1': game.player1.username,
-                            'player1_color': game.player1_color,
-                            'player2': game.player2.username,
-                            'player2_color': game.player2_color,
-                            'current_turn': game.current_turn,
-                        },
-                        'message': {
-                            'type': 'both',
-                            'info': 'joined',
-                            'player': {
-                                'user': user.username,
-                                'color': game.player2_color
-                            }
-                        }
-                    }
-                )
-                
-                # broadcast the game status to avialable_games room
-                async_to_sync(self.channel_layer.group_send)(
-                    'available_games',
-                    {
-                        'type': 'game.update',
-                        'game': {
-                            'game_id': self.game_id,
-                        },
-                        'message': {
-                            'type': 'all',
-                            'info': 'unavailable',
-                            'player': {
-                                'user': user.username
-                            }
-                        }
-                    }
-                )
-            else:
-                self.send(text_data=json.dumps({
-                    'game': {},
-                    'message': {
-                        'type': 'only_me',
-                        'info': 'invalid',
-                        'error': 'Game is full',
-                        'player': {}
-                    }
-                }))
-        
-        elif action == 'make_move':
-            if dev_flag: print(f"{user.username} : action: make_move")
-            try:
-                game = Game.objects.get(room_id=self.game_id)
-                color = game.player1_color if game.player1 == user else game.player2_color   # color of the move maker
-            except Game.DoesNotExist:
-                game = None
-            if game is None:
-                self.send(text_data=json.dumps({
-                    'game': {},
-                    'message': {
-                        'type': 'only_me',
-                        'info': 'invalid',
-                        'error': 'Game does not exists',
-                        'player': {}
-                    }
-                }))
-                return
-
-            if user != game.player1 and user != game.player2:
-                self.send(text_data=json.dumps({
-                    'game': {},
-                    'message': {
-                        'type': 'only_me',
-                        'info': 'invalid',
-                        'error': 'You are not a player in this game',
-                        'player': {}
-                    }
-                }))
-                return
-            
-            if game.status == 'ended':
-                self.send(text_data=json.dumps({
-                    'game': {},
-                    'message': {
-                        'type': 'only_me',
-                        'info': 'invalid',
-                        'error': "game has already ended",
-                        'player': {
-                            'user': user.username,
-                            'color': color
-                        }
-                    }
-                }))
-                return
-            
-            if game.status != 'active':
-                self.send(text_data=json.dumps({
-                    'game': {},
-                    'message': {
-                        'type': 'only_me',
-                        'info': 'invalid',
-                        'error': 'Game is not active',
-                        'player': {}
-                    }
-                }))
-                return
-
-            turn = game.current_turn
-            if (turn == "player1" and user == game.player2) or (turn == "player2" and user == game.player1):
-                self.send(text_data=json.dumps({
-                    'game': {},
-                    'message': {
-                        'type': 'only_me',
-                        'info': 'invalid',
-                        'error': 'not your turn',
-                        'player': {}
-                    }
-                }))
-                return
-            
-            if "move" not in data:
-                self.send(text_data=json.dumps({
-                    'game': {},
-                    'message': {
-                        'type': 'only_me',
-                        'info': 'invalid',
-                        'error': 'no move to make',
-                        'player': {}
-                    }
-                }))
-                return
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        """Queue a frame for the socket; one that lets CHESS_SEND_BUFFER frames pile up is closed"""
+        if self.closing:
+            return
+        if len(self.outbox) >= limiter.send_buffer:
+            limiter.send_overflows += 1
+            self.closing = True
+            self.outbox.clear()
+            await self.close(code=1013)  # try again later, the client reconnects and resyncs
+            return
+        self.outbox.append((text_data, bytes_data, close))
+        if self.sending is None:
+            self.sending = asyncio.ensure_future(self.write_outbox())
 
-            try:
-                move = data['move']
-                if dev_flag: print(f'{user.username} :: make_move :: move : {move}')
-
-                board = chess.Board(fen=game.fen)
-                chess_move = chess.Move.from_uci(move)
-                if chess_move not in board.legal_moves:
-                    self.send(text_data=json.dumps({
-                        'game': {},
-                        'message': {
-                            'type': 'only_me',
-                            'info': 'invalid',
-                            'error': "illegal move",
-                            'player': {
-                                'user': user.username,
-                                'color': color
-                            }
-                        }
-                    }))
-                    return
-                
-                board.push(chess_move)
-                move_model = Move.objects.create(
-                    game=game,
-                    move=move
-                )
+    async def write_outbox(self):
+        try:
+            while self.outbox:
+                text_data, bytes_data, close = self.outbox.popleft()
+                await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+        finally:
+            self.sending = None
+
+    async def run_action(self, action, data):
+        """Run an action (None: the socket left) here, or forward it to the shard worker owning the game"""
+        user = self.scope['user']
+        owner = shard_channel(self.game_id)
+        if owner is not None:
+            await metrics.timed_layer(self.channel_layer).send(owner, {
+                'type': 'game.action',
+                'game_id': self.game_id,
+                'action': action,
+                'data': data,
+                'user': {'id': user.pk, 'username': user.username},
+                'reply_channel': self.channel_name
+            })
+            return
+        actions = GameActions(self.channel_layer, self.game_id, self.channel_name, user, self.send)
+        if action is None:
+            await actions.leave()
+        else:
+            await actions.run(action, data)
 
-                # add new FEN to game and check if game if over or not
-                game.fen = board.fen()
-                game.current_turn = "player2" if user == game.player1 else "player1"
-                
-                outcome = board.outcome()
-                if outcome:
-                    over_type = ''
-                    winner = ''
-                    if outcome.winner == chess.WHITE:
-                        if dev_flag: print("white won")
-                        over_type = 'checkmate'
-                        winner = 'player1' if game.player1_color == 'white' else 'player2'
-
-                    elif outcome.winner == chess.BLACK:
-                        over_type = 'checkmate'
-                        winner = 'player1' if game.player1_color == 'black' else 'player2'
-                        if dev_flag: print("black won")
-
-                    else:
-                        over_type = 'draw'
-                        if dev_flag: print("draw")
-                    game.status = 'ended'
-                    game.over_type = over_type
-                    game.winner = winner
-                game.save()
-
-                # Broadcast the move to the group
-                async_to_sync(self.channel_layer.group_send)(
-                    self.room_group_name,
-                    {
-                        'type': 'game.send',
-                        'game': {
-                            'game_id': self.game_id,
-                            'fen': game.fen,
-                            'move': move,
-                            'player1': game.player1.username,
-                            'player1_color': game.player1_color,
-                            'player2': game.player2.username,
-                            'player2_color': game.player2_color,
-                            'current_turn': game.current_turn,
-                            'status': game.status,
-                            'winner': game.winner,
-                            'over_type': game.over_type
-                        },
-                        'message': {
-                            'type': 'both',
-                            'info': 'moved',
-                            'player': {
-                                'user': user.username,
-                                'color': color
-                            }
-                        }
-                    }
-                )
-            except Exception as e:
-                self.send(text_data=json.dumps({
-                    'game': {},
-                    'message': {
-                        'type': 'only_me',
-                        'info': 'invalid',
-                        'error': str(e),
-                        'player': {
-                            'user': user.username
-                        }
-                    }
-                }))
 
-        elif action == 'resign_game':
-            try:
-                game = Game.objects.get(room_id=self.game_id)
-            except Game.DoesNotExist:
-                self.send(text_data=json.dumps({
-                    'game': {},
-                    'message': {
-                        'type': 'only_me',
-                        'info': 'invalid',
-                        'error': 'Game does not exist',
-                        'player': {}
-                    }
-                }))
-                return
+    async def game_send(self, event):
+        # encoded once per process and wire format, by the first socket sending it
+        text_data, bytes_data = event_frame(event, self.wire)
+        await self.send(text_data=text_data, bytes_data=bytes_data)
 
-            if user != game.player1 and user != game.player2:
-                self.send(text_data=json.dumps({
-                    'game': {},
-                    'message': {
-                        'type': 'only_me',
-                        'info': 'invalid',
-                        'error': 'You are not a player in this game',
-                        'player': {}
-                    }
-                }))
-                return
+    async def game_text(self, event):
+        """A reply from the shard worker running this socket's actions"""
+        await self.send(text_data=event['text'])
 
-            if game.status == 'ended':
-                self.send(text_data=json.dumps({
-                    'game': {},
-                    'message': {
-                        'type': 'only_me',
-                        'info': 'invalid',
-                        'error': 'Game has already ended',
-                        'player': {}
-                    }
-                }))
-                return
 
-            # Set game as ended and declare winner
-            game.status = 'ended'
-            game.over_type = 'resign'
-            game.winner = 'player2' if user == game.player1 else 'player1'
-            game.save()
+class GameWorkerConsumer(AsyncConsumer):
+    """Owner of the games of one shard channel (see actions.shard_channel)
 
-            user_color = game.player1_color if user == game.player1 else game.player2_color
-            winner_color = game.player1_color if user == game.player2 else game.player2_color
+    Sockets in any process forward their actions here, so a game's live state is
+    kept in exactly one process. Messages are handled one at a time, in order.
+    """
 
-            # Broadcast resignation to both players
-            async_to_sync(self.channel_layer.group_send)(
-                self.room_group_name,
-                {
-                    'type': 'game.send',
-                    'game': {
-                        'game_id': self.game_id,
-                        'fen': game.fen,
-                        'move': 'null',
-                        'player1': game.player1.username,
-                        'player1_color': game.player1_color,
-                        'player2': game.player2.username,
-                        'player2_color': game.player2_color,
-                        'current_turn': game.current_turn,
-                        'status': game.status,
-                        'winner': game.winner,
-                        'over_type': game.over_type
-                    },
-                    'message': {
-                        'type': 'both',
-                        'info': 'resigned',
-                        'player': {
-                            'user': user.username,
-                            'color': user_color
-                        }
-                    }
-                }
-            )
+    async def game_action(self, event):
+        # the socket's process authenticated the user, id and username are all the actions need
+        user = User(pk=event['user']['id'], username=event['user']['username'])
+        reply_channel = event['reply_channel']
 
-        # elif action == 'abort_game':
-        #     pass
+        async def reply(text_data):
+            await actions.channel_layer.send(reply_channel, {'type': 'game.text', 'text': text_data})
 
-        # elif action == 'draw_request':
-        #     pass
-        else:
-            # Echo back any other action and its payload
-            self.send(text_data=json.dumps({
-                'game': {},
-                'message': {
-                    'type': 'only_me',
-                    'info': 'echo',
-                    'action': action,
-                    'payload': data,
-                    'player': {
-                        'user': user.username
-                    }
-                }
-            }))
+        actions = GameActions(self.channel_layer, event['game_id'], reply_channel, user, reply)
+        action = event['action']
+        label = 'disconnect' if action is None else GameActions.label(action)
+        with metrics.span('worker', label), profiler.sample(label):
+            if action is None:
+                await actions.leave()
+            else:
+                await actions.run(action, event['data'])
+
+    async def watch_snapshot(self, event):
+        """The first frame of a spectator connecting in another process, from this shard's live game"""
+        live = await registry.get(event['game_id'])
+        await self.channel_layer.send(event['reply_channel'], {
+            'type': 'watch.frame',
+            'ply': live.ply if live is not None else None,
+            'frame': watch_frame(live, info='connected') if live is not None else None,
+        })
+
+
+async def load_watch_frame(game_id):
+    """(ply, first frame) of a game no spectator in this process watches yet, None if it
+    does not exist: asked of the shard worker that owns it, or read from the database
+    (without caching a live copy here, the players may be in another process)"""
+    owner = shard_channel(game_id)
+    if owner is None:
+        live = await load_game(game_id)
+        return (live.ply, watch_frame(live, info='connected')) if live is not None else None
+    channel_layer = get_channel_layer()
+    reply_channel = await channel_layer.new_channel()
+    await channel_layer.send(owner, {'type': 'watch.snapshot', 'game_id': game_id, 'reply_channel': reply_channel})
+    reply = await asyncio.wait_for(channel_layer.receive(reply_channel), WATCH_SNAPSHOT_TIMEOUT)
+    return (reply['ply'], reply['frame']) if reply['frame'] is not None else None
+
+
+class SpectatorConsumer(MeteredConsumer, AsyncWebsocketConsumer):
+    """Watches a game without playing it
+
+    Frames come from this process' WatchHub (spectators.watch), not from the players'
+    group. Only the newest frame not sent yet is kept, so a slow socket skips the
+    states in between; every frame carries the fen and the ply.
+    """
+
+    # nothing is sent to a spectator through the channel layer, it keeps no channel per socket
+    channel_layer_alias = None
+    metrics_name = 'spectator'
+
+    async def connect(self):
+        self.game_id = self.scope['url_route']['kwargs'].get('game_id')
+        self.pending = None
+        self.sender = None
+        user = self.scope['user']
 
-    def game_send(self, event):
-        message = event['message']
-        game = event['game']
-        self.send(text_data=json.dumps({
-            "message": message,
-            "game": game
-        }))
+        if not user.username:
+            await self.close()
+            return
+        # subscribed before the snapshot, so no change is missed in between
+        await watch.add(self.game_id, self)
+        try:
+            frame = await watch.snapshot(self.game_id, load_watch_frame)
+        except asyncio.TimeoutError:
+            frame = None
+        if frame is None:
+            await watch.discard(self.game_id, self)
+            await self.close()
+            return
+        if dev_flag: print(f"{user.username} watching game {self.game_id}")
+        await self.accept()
+        await self.send(text_data=frame)
 
+    async def disconnect(self, close_code):
+        if self.sender is not None:
+            self.sender.cancel()
+        await watch.discard(self.game_id, self)
 
+    async def receive(self, text_data=None, bytes_data=None):
+        # spectators have no actions
+        pass
 
-class ChessRoomConsumer(WebsocketConsumer):
-    def connect(self):
-        self.room_group_name = 'available_games'
+    def offer(self, frame):
+        """Queue a frame in place of the one still waiting, if any (then returns True)"""
+        dropped = self.pending is not None
+        self.pending = frame
+        if self.sender is None:
+            # a task only while there is something to send: thousands of idle
+            # spectators keep nothing alive for the garbage collector to walk
+            self.sender = asyncio.ensure_future(self.send_frames())
+        return dropped
+
+    async def send_frames(self):
+        try:
+            while self.pending is not None:
+                frame, self.pending = self.pending, None
+                await self.send(text_data=frame)
+        finally:
+            self.sender = None
+
+
+class ChessRoomConsumer(MeteredConsumer, AsyncWebsocketConsumer):
+    metrics_name = 'lobby'
+    ACTIONS = ('subscribe', 'unsubscribe', 'sync')
+
+    async def connect(self):
+        self.room_group_name = LOBBY_GROUP
+        self.groups_joined = [LOBBY_GROUP]
+        self.subscription = None  # LobbyFilter once the client subscribes
+        self.first_version = 0  # version of the snapshot sent on connect
         user = self.scope['user']
 
         if user.username:
             if dev_flag: print(f"Connected to room {self.room_group_name} as {user.username}")
 
-            async_to_sync(self.channel_layer.group_add)(
+            await self.channel_layer.group_add(
                 self.room_group_name,
                 self.channel_name
             )
-            self.accept()
+            await self.accept()
+            # the optional periodic reaping of stale games (CHESS_REAP_INTERVAL) runs where the lobby is served
+            reaper.start()
+            await lobby.listen(self.channel_layer)
             
             # Send current available games on connect
-            available_games = Game.objects.filter(status='waiting')
-            games_list = [{
-                'game_id': game.room_id,
-                'format': game.format,
-                'clock': {
-                    'base': game.game_clock.total_time,
-                    'increment': game.game_clock.incremental_time,
-                    'started': game.game_clock.started_at.isoformat()
-                },
-                'player1': game.player1.username,
-                'player1_color': game.player1_color,
-                'player2': game.player2.username if game.player2 else None,
-                'player2_color': game.player2_color
-            } for game in available_games]
-
-            self.send(text_data=json.dumps({ 
+            await lobby.ensure_loaded()
+            version, games_list = lobby.snapshot()
+            # versions are this process' own: older ones came from elsewhere
+            self.first_version = version
+
+            await self.send(text_data=json.dumps({ 
                 'games': games_list,
+                'version': version,
                 'message': {
                     'type': 'only_me',
                     'info': 'connected',
@@ -653,18 +353,125 @@ class ChessRoomConsumer(WebsocketConsumer):
                 }
             }))
     
-    def disconnect(self, code):
-        async_to_sync(self.channel_layer.group_discard)(
-            self.room_group_name,
-            self.channel_name
-        )
+    async def disconnect(self, code):
+        for group in getattr(self, 'groups_joined', [LOBBY_GROUP]):
+            await self.channel_layer.group_discard(
+                group,
+                self.channel_name
+            )
     
-    def receive(self, text_data):
-        pass
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = json.loads(text_data if text_data is not None else bytes_data)
+        except ValueError:
+            return
+        if not isinstance(data, dict):
+            # only {"action": ...} objects are requests
+            return
+        action = data.get('action')
+        with metrics.span('lobby', action if action in self.ACTIONS else 'other'):
+            await self.handle(action, data)
+
+    async def handle(self, action, data):
+        if action == 'subscribe':
+            # only receive games matching {formats, base: [min, max], increment: [min, max]}
+            try:
+                subscription = LobbyFilter.from_request(data)
+            except ValueError as e:
+                await self.send(text_data=json.dumps({
+                    'games': [],
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'invalid',
+                        'error': str(e)
+                    }
+                }))
+                return
+            await self.join_groups(subscription.groups())
+            self.subscription = subscription
+            await lobby.ensure_loaded()
+            version, games_list = lobby.snapshot(subscription)
+            await self.send(text_data=json.dumps({
+                'games': games_list,
+                'version': version,
+                'message': {
+                    'type': 'only_me',
+                    'info': 'subscribed'
+                }
+            }))
+
+        elif action == 'unsubscribe':
+            await self.join_groups([LOBBY_GROUP])
+            self.subscription = None
+            await lobby.ensure_loaded()
+            version, games_list = lobby.snapshot()
+            await self.send(text_data=json.dumps({
+                'games': games_list,
+                'version': version,
+                'message': {
+                    'type': 'only_me',
+                    'info': 'unsubscribed'
+                }
+            }))
 
-    def game_update(self, event):
+        elif action == 'sync':
+            # changes since the version the client last saw on this socket, or the full list if that
+            # is too old or was not sent here (versions are numbered per process, see lobby.Lobby)
+            await lobby.ensure_loaded()
+            since = data.get('version')
+            changes = None
+            if isinstance(since, int) and since >= self.first_version:
+                changes = lobby.changes_since(since, self.subscription)
+            if changes is None:
+                version, games_list = lobby.snapshot(self.subscription)
+                await self.send(text_data=json.dumps({
+                    'games': games_list,
+                    'version': version,
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'snapshot'
+                    }
+                }))
+            else:
+                await self.send(text_data=json.dumps({
+                    'changes': changes,
+                    'version': lobby.version,
+                    'message': {
+                        'type': 'only_me',
+                        'info': 'changes'
+                    }
+                }))
+
+    async def join_groups(self, groups):
+        for group in self.groups_joined:
+            if group not in groups:
+                await self.channel_layer.group_discard(group, self.channel_name)
+        for group in groups:
+            if group not in self.groups_joined:
+                await self.channel_layer.group_add(group, self.channel_name)
+        self.groups_joined = list(groups)
+
+    async def games_removed(self, event):
+        """Several games left the lobby at once (stale games reaped)"""
+        # the process' lobby listener applies the event too; until it has, a sync
+        # from this version sends the removal again, which the client can ignore
+        await self.send(text_data=json.dumps({
+            'game_ids': event['game_ids'],
+            'version': lobby.version,
+            'message': event['message']
+        }))
+
+    async def game_update(self, event):
         """Handle game updates from database"""
-        self.send(text_data=json.dumps({
+        if (
+            self.subscription is not None
+            and event['message'].get('info') == 'available'
+            and not self.subscription.matches(event_entry(event['game']))
+        ):
+            # same bucket, outside the exact ranges asked for
+            return
+        await self.send(text_data=json.dumps({
             'game': event['game'],
+            'version': lobby.version,
             'message': event['message']
-        }))
\ No newline at end of file
+        }))
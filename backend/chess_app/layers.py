@@ -0,0 +1,289 @@
+# layers.py
+import asyncio
+import base64
+import json
+import time
+import uuid
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+SCHEMA = [
+    # target: the part of the channel a process receives on, up to the ! for process specific channels
+    'CREATE TABLE IF NOT EXISTS messages ('
+    ' id INTEGER PRIMARY KEY AUTOINCREMENT, target TEXT NOT NULL, channel TEXT NOT NULL,'
+    ' expires REAL NOT NULL, body TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS messages_target ON messages (target, id)',
+    'CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel, expires)',
+    'CREATE TABLE IF NOT EXISTS groups ('
+    ' grp TEXT NOT NULL, channel TEXT NOT NULL, expires REAL NOT NULL, PRIMARY KEY (grp, channel))',
+]
+
+INSERT_MESSAGE = 'INSERT INTO messages (target, channel, expires, body) VALUES (?, ?, ?, ?)'
+
+
+def encode_bytes(value):
+    if isinstance(value, bytes):
+        return {'__bytes__': base64.b64encode(value).decode()}
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def decode_bytes(value):
+    if '__bytes__' in value and len(value) == 1:
+        return base64.b64decode(value['__bytes__'])
+    return value
+
+
+def encode(message):
+    return json.dumps(message, default=encode_bytes)
+
+
+def decode(body):
+    return json.loads(body, object_hook=decode_bytes)
+
+
+class SQLiteChannelLayer(BaseChannelLayer):
+    """Channel layer shared by the processes of one machine through a SQLite file (WAL mode)
+
+    Writes queued while a batch is being committed go out together in the next
+    transaction, so a burst of group_sends costs one commit. Each process polls
+    once for all of its own (specific) channels. Group memberships expire after
+    group_expiry seconds and messages after expiry; a channel holding capacity
+    messages refuses more (ChannelFull on send, skipped by group_send).
+    Messages must be JSON serializable, apart from bytes values.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path='channels.sqlite3', expiry=60, group_expiry=86400, capacity=100,
+                 channel_capacity=None, poll_interval=0.01, batch_size=500, cleanup_interval=10, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.path = str(path)
+        self.group_expiry = group_expiry
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.cleanup_interval = cleanup_interval
+        self.client_prefix = uuid.uuid4().hex[:12]
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-channel-layer')
+        self.connection = None  # only touched on the executor thread
+        self.local_targets = set()  # non local names of this process' specific channels
+        self.receive_buffer = {}  # specific channel -> asyncio.Queue
+        self.poller = None
+        self.writes = []  # (operation, args, future) waiting for the next batch
+        self.writing = None
+        self.last_cleanup = time.monotonic()
+        # metrics
+        self.batches = 0
+        self.messages_written = 0
+        self.messages_dropped = 0
+
+    # executor thread
+
+    def db(self):
+        if self.connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                connection.execute(statement)
+            self.connection = connection
+        return self.connection
+
+    def apply_writes(self, batch):
+        db = self.db()
+        now = time.time()
+        results = []
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for operation, args, _ in batch:
+                try:
+                    results.append(operation(db, now, *args))
+                except ChannelFull as e:
+                    results.append(e)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return results
+
+    def insert_message(self, db, now, channel, body):
+        (queued,) = db.execute(
+            'SELECT COUNT(*) FROM messages WHERE channel = ? AND expires > ?', (channel, now)
+        ).fetchone()
+        if queued >= self.get_capacity(channel):
+            raise ChannelFull(channel)
+        db.execute(INSERT_MESSAGE, (self.non_local_name(channel), channel, now + self.expiry, body))
+        self.messages_written += 1
+
+    def insert_group_message(self, db, now, group, body):
+        members = db.execute(
+            'SELECT g.channel, (SELECT COUNT(*) FROM messages m WHERE m.channel = g.channel AND m.expires > ?)'
+            ' FROM groups g WHERE g.grp = ? AND g.expires > ?',
+            (now, group, now)
+        ).fetchall()
+        rows = [
+            (self.non_local_name(channel), channel, now + self.expiry, body)
+            for channel, queued in members if queued < self.get_capacity(channel)
+        ]
+        db.executemany(INSERT_MESSAGE, rows)
+        self.messages_written += len(rows)
+        self.messages_dropped += len(members) - len(rows)
+
+    def add_member(self, db, now, group, channel):
+        db.execute(
+            'INSERT OR REPLACE INTO groups (grp, channel, expires) VALUES (?, ?, ?)',
+            (group, channel, now + self.group_expiry)
+        )
+
+    def discard_member(self, db, now, group, channel):
+        db.execute('DELETE FROM groups WHERE grp = ? AND channel = ?', (group, channel))
+
+    def delete_expired(self, db, now):
+        db.execute('DELETE FROM messages WHERE expires <= ?', (now,))
+        db.execute('DELETE FROM groups WHERE expires <= ?', (now,))
+
+    def delete_all(self, db, now):
+        db.execute('DELETE FROM messages')
+        db.execute('DELETE FROM groups')
+
+    def pop_messages(self, targets):
+        """Take up to batch_size messages for the targets, oldest first"""
+        db = self.db()
+        marks = ', '.join('?' * len(targets))
+        # a plain read first, so an idle poll never takes the write lock
+        if db.execute(f'SELECT 1 FROM messages WHERE target IN ({marks}) LIMIT 1', targets).fetchone() is None:
+            return []
+        rows = db.execute(
+            f'DELETE FROM messages WHERE id IN (SELECT id FROM messages WHERE target IN ({marks}) ORDER BY id LIMIT ?)'
+            ' RETURNING id, channel, expires, body',
+            (*targets, self.batch_size)
+        ).fetchall()
+        now = time.time()
+        return [(channel, body) for _, channel, expires, body in sorted(rows) if expires > now]
+
+    def pop_message(self, channel):
+        db = self.db()
+        while True:
+            row = db.execute(
+                'DELETE FROM messages WHERE id = (SELECT id FROM messages WHERE target = ? ORDER BY id LIMIT 1)'
+                ' RETURNING expires, body',
+                (channel,)
+            ).fetchone()
+            if row is None or row[0] > time.time():
+                return row[1] if row is not None else None
+
+    # event loop
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def write(self, operation, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.writes.append((operation, args, future))
+        if self.writing is None:
+            self.writing = loop.create_task(self.write_batches())
+        result = await future
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def write_batches(self):
+        try:
+            while self.writes:
+                batch, self.writes = self.writes, []
+                try:
+                    results = await self.run(self.apply_writes, batch)
+                except Exception as e:
+                    results = [e] * len(batch)
+                self.batches += 1
+                for (_, _, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            self.writing = None
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel)
+        await self.write(self.insert_message, channel, encode(message))
+
+    async def new_channel(self, prefix='specific'):
+        channel = f'{prefix}.{self.client_prefix}!{uuid.uuid4().hex}'
+        self.local_targets.add(self.non_local_name(channel))
+        return channel
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        if '!' not in channel:
+            # a normal channel may have receivers in several processes, each message goes to one
+            while True:
+                body = await self.run(self.pop_message, channel)
+                if body is not None:
+                    return decode(body)
+                await asyncio.sleep(self.poll_interval)
+
+        self.local_targets.add(self.non_local_name(channel))
+        queue = self.receive_buffer.setdefault(channel, asyncio.Queue())
+        if self.poller is None or self.poller.done():
+            self.poller = asyncio.get_running_loop().create_task(self.poll())
+        try:
+            return await queue.get()
+        except asyncio.CancelledError:
+            # the consumer is gone, later messages for its channel are dropped
+            if queue.empty():
+                self.receive_buffer.pop(channel, None)
+            raise
+
+    async def poll(self):
+        while True:
+            if time.monotonic() - self.last_cleanup >= self.cleanup_interval:
+                self.last_cleanup = time.monotonic()
+                await self.write(self.delete_expired)
+            received = await self.run(self.pop_messages, sorted(self.local_targets))
+            for channel, body in received:
+                queue = self.receive_buffer.get(channel)
+                if queue is not None:
+                    queue.put_nowait(decode(body))
+            if len(received) < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+    # groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        await self.write(self.add_member, group, channel)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        await self.write(self.discard_member, group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_group_name(group), "Group name not valid"
+        # encoded once for every member
+        await self.write(self.insert_group_message, group, encode(message))
+
+    # flush extension
+
+    async def flush(self):
+        await self.write(self.delete_all)
+        self.receive_buffer = {}
+
+    async def close(self):
+        if self.poller is not None:
+            self.poller.cancel()
+            self.poller = None
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'messages_written': self.messages_written,
+            'messages_dropped': self.messages_dropped,
+            'local_channels': len(self.receive_buffer),
+        }
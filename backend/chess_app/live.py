@@ -0,0 +1,262 @@
+# live.py
+import asyncio
+import time
+from collections import Counter
+
+import chess
+import chess.polyglot
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Game, Clock
+from .persistence import writer
+
+
+class LiveGame:
+    """A game being played in this process: the Game row (players loaded), its clock and the board with its move stack
+
+    Positions since the last capture or pawn move are counted by Zobrist hash, so
+    repetitions are known after every push without replaying the move stack.
+    """
+
+    def __init__(self, game, clock, board=None):
+        self.game = game
+        self.clock = clock
+        self.board = board if board is not None else chess.Board()
+        self.key = chess.polyglot.zobrist_hash(self.board)
+        self.repetitions = Counter({self.key: 1})
+        self.move_times = []  # played_at of each move on the board's move stack
+        self.ply_offset = 0  # moves played before the board's root (games restored from the fen)
+        self.last_seen = time.monotonic()
+        self.ended_at = None
+        self.turn_started = None  # monotonic time the running clock started, None while stopped
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    def end(self):
+        if self.ended_at is None:
+            self.ended_at = time.monotonic()
+
+    @property
+    def ply(self):
+        """Number of moves played, also the sequence number of the last move"""
+        return self.ply_offset + len(self.move_times)
+
+    def push(self, move, played_at=None):
+        """Play a (legal) move, add it to the game's packed history and return how often
+        the resulting position has occurred
+        """
+        played_at = played_at if played_at is not None else timezone.now()
+        previous = self.move_times[-1] if self.move_times else (self.clock.started_at if self.clock else None)
+        delta = (played_at - previous).total_seconds() * 1000 if previous is not None else 0
+        self.game.append_move(move, delta)
+        return self.play(move, played_at)
+
+    def play(self, move, played_at):
+        """Play a move on the board only (restoring a game that already has it stored)"""
+        if self.board.is_zeroing(move):
+            # no position before a capture or pawn move can occur again
+            self.repetitions.clear()
+        self.board.push(move)
+        self.move_times.append(played_at)
+        self.key = chess.polyglot.zobrist_hash(self.board)
+        self.repetitions[self.key] += 1
+        return self.repetitions[self.key]
+
+    def outcome(self):
+        """Like board.outcome() but repetitions come from the counter instead of replaying history
+
+        As there, only fivefold repetition ends the game; threefold is claimed (can_claim_draw).
+        """
+        board = self.board
+        if board.is_checkmate():
+            return chess.Outcome(chess.Termination.CHECKMATE, not board.turn)
+        if board.is_insufficient_material():
+            return chess.Outcome(chess.Termination.INSUFFICIENT_MATERIAL, None)
+        if not any(board.generate_legal_moves()):
+            return chess.Outcome(chess.Termination.STALEMATE, None)
+        if board.is_seventyfive_moves():
+            return chess.Outcome(chess.Termination.SEVENTYFIVE_MOVES, None)
+        if self.repetitions[self.key] >= 5:
+            return chess.Outcome(chess.Termination.FIVEFOLD_REPETITION, None)
+        return None
+
+    def can_claim_threefold(self):
+        """board.can_claim_threefold_repetition() from the counter: the position occurred three
+        times, or a legal move of the side to move makes its position occur a third time
+        """
+        if self.repetitions[self.key] >= 3:
+            return True
+        board = self.board
+        for move in board.generate_legal_moves():
+            if board.is_zeroing(move):
+                continue  # leads to a position not seen before
+            board.push(move)
+            key = chess.polyglot.zobrist_hash(board)
+            board.pop()
+            if self.repetitions[key] >= 2:
+                return True
+        return False
+
+    def can_claim_draw(self):
+        """What board.can_claim_draw() checks: threefold repetition or the fifty-move rule"""
+        return self.board.can_claim_fifty_moves() or self.can_claim_threefold()
+
+    def moves_since(self, ply):
+        """The moves after ply as sent to clients, None if they are not all known"""
+        if ply < self.ply_offset:
+            return None
+        start = ply - self.ply_offset
+        return [
+            {
+                'ply': self.ply_offset + index + 1,
+                'move': move.uci(),
+                'played_at': played_at.isoformat() if played_at else None
+            }
+            for index, (move, played_at) in enumerate(
+                zip(self.board.move_stack[start:], self.move_times[start:]), start=start
+            )
+        ]
+
+
+def restore(game, clock):
+    """Rebuild a LiveGame from the game's packed moves, falling back to the fen if they disagree
+
+    A clock that was running keeps running: the turn started when the game was
+    last saved, by the last move or by the players coming back to it.
+    """
+    live = LiveGame(game, clock)
+    moves = game.moves
+    try:
+        for move, played_at in zip(moves, game.played_times(clock.started_at if clock else None)):
+            live.play(chess.Move.from_uci(move), played_at)
+    except (ValueError, AssertionError):
+        live = None
+    if live is None or live.board.fen() != game.fen:
+        live = LiveGame(game, clock, chess.Board(game.fen))
+        live.ply_offset = len(moves)
+    if clock is not None and game.status == 'active' and live.ply and game.updated_at is not None:
+        elapsed = max(0.0, (timezone.now() - game.updated_at).total_seconds())
+        live.turn_started = time.monotonic() - elapsed
+    return live
+
+
+@database_sync_to_async
+def load_game(room_id):
+    game = Game.objects.select_related('player1', 'player2', 'game_clock').filter(room_id=room_id).first()
+    if game is None:
+        return None
+    try:
+        clock = game.game_clock
+    except Clock.DoesNotExist:
+        clock = None
+    return restore(game, clock)
+
+
+class GameRegistry:
+    """Per process cache of live games so the move hot path never reads the database"""
+
+    def __init__(self, idle_timeout=None, ended_timeout=None, sweep_interval=None):
+        if idle_timeout is None:
+            idle_timeout = getattr(settings, 'CHESS_LIVE_GAME_IDLE_TIMEOUT', 30 * 60)
+        if ended_timeout is None:
+            ended_timeout = getattr(settings, 'CHESS_LIVE_GAME_ENDED_TIMEOUT', 60)
+        if sweep_interval is None:
+            sweep_interval = getattr(settings, 'CHESS_LIVE_GAME_SWEEP_INTERVAL', 30)
+        self.idle_timeout = idle_timeout
+        self.ended_timeout = ended_timeout
+        self.sweep_interval = sweep_interval
+        self.games = {}
+        self.loading = {}
+        self.on_load = None  # called with each game loaded, clock.py reschedules running clocks
+        self.last_sweep = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.games)
+
+    def __contains__(self, room_id):
+        return room_id in self.games
+
+    async def get(self, room_id):
+        """Return the live game, loading it from the database on a miss (None if it does not exist)"""
+        self.maybe_sweep()
+        live = self.games.get(room_id)
+        if live is not None:
+            self.hits += 1
+            live.touch()
+            return live
+
+        self.misses += 1
+        if writer.pending(room_id):
+            # the database is behind the queued writes for this game
+            await writer.flush()
+            if room_id in self.games:
+                return self.games[room_id]
+
+        # concurrent misses for the same room share one load
+        pending = self.loading.get(room_id)
+        if pending is None:
+            pending = asyncio.ensure_future(load_game(room_id))
+            self.loading[room_id] = pending
+            try:
+                live = await pending
+            finally:
+                del self.loading[room_id]
+            if live is not None:
+                if live.game.status == 'ended':
+                    live.end()
+                self.games[room_id] = live
+                if self.on_load is not None:
+                    self.on_load(live)
+            return live
+        return await asyncio.shield(pending)
+
+    def add(self, game, clock, board=None):
+        live = LiveGame(game, clock, board)
+        self.games[game.room_id] = live
+        return live
+
+    def evict(self, room_id):
+        return self.games.pop(room_id, None)
+
+    def maybe_sweep(self):
+        now = time.monotonic()
+        if now - self.last_sweep >= self.sweep_interval:
+            self.sweep(now)
+
+    def sweep(self, now=None):
+        """Drop games nobody touched for idle_timeout and ended games after ended_timeout
+
+        A game whose clock is running stays, its flag-fall needs it.
+        """
+        now = now if now is not None else time.monotonic()
+        self.last_sweep = now
+        stale = [
+            room_id for room_id, live in self.games.items()
+            if (live.turn_started is None and now - live.last_seen >= self.idle_timeout)
+            or (live.ended_at is not None and now - live.ended_at >= self.ended_timeout)
+        ]
+        for room_id in stale:
+            del self.games[room_id]
+        return len(stale)
+
+    def clear(self):
+        self.games.clear()
+
+    def stats(self):
+        return {
+            'games': len(self.games),
+            'active': sum(1 for live in self.games.values() if live.ended_at is None),
+            'loading': len(self.loading),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+registry = GameRegistry()
+# a queued write another worker got ahead of: reload the game on its next use
+writer.on_stale = registry.evict
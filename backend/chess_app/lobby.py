@@ -0,0 +1,335 @@
+# lobby.py
+import asyncio
+import logging
+import time
+from collections import deque
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .models import Game, Clock
+
+logger = logging.getLogger(__name__)
+
+LOBBY_GROUP = 'available_games'
+# the lobby listener's group membership is renewed this often (seconds), layers expire them
+LISTEN_RENEW_INTERVAL = 60 * 60
+
+# lobby buckets: one channel group per format and base time band, so filtered
+# subscribers only receive the announcements they can match
+FORMATS = [value for value, _ in Game.FORMAT_CHOICES]
+BASE_BANDS = [3 * 60 * 1000, 10 * 60 * 1000, 30 * 60 * 1000, 60 * 60 * 1000]  # upper bounds (ms), last band is open
+
+
+def base_band(base):
+    for band, upper in enumerate(BASE_BANDS):
+        if base < upper:
+            return band
+    return len(BASE_BANDS)
+
+
+def bucket_group(format, band):
+    return f'{LOBBY_GROUP}.{format}.{band}'
+
+
+def entry_group(entry):
+    """The bucket group of a lobby entry, None if it lacks a known format or clock"""
+    clock = entry.get('clock') or {}
+    if entry.get('format') not in FORMATS or not isinstance(clock.get('base'), int):
+        return None
+    return bucket_group(entry['format'], base_band(clock['base']))
+
+
+class LobbyFilter:
+    """What a lobby client wants to see: formats and inclusive base/increment ranges in ms"""
+
+    def __init__(self, formats=None, base=None, increment=None):
+        self.formats = set(formats) if formats else set(FORMATS)
+        self.base = base or (0, None)
+        self.increment = increment or (0, None)
+
+    @classmethod
+    def from_request(cls, data):
+        formats = data.get('formats')
+        if formats is not None:
+            if not isinstance(formats, list) or not set(formats) <= set(FORMATS):
+                raise ValueError(f'formats must be a list of {", ".join(FORMATS)}')
+        return cls(formats, cls.parse_range(data, 'base'), cls.parse_range(data, 'increment'))
+
+    @staticmethod
+    def parse_range(data, key):
+        value = data.get(key)
+        if value is None:
+            return None
+        if (
+            not isinstance(value, list) or len(value) != 2
+            or not isinstance(value[0], int) or not (value[1] is None or isinstance(value[1], int))
+            or value[0] < 0 or (value[1] is not None and value[1] < value[0])
+        ):
+            raise ValueError(f'{key} must be [min, max] in ms (max may be null)')
+        return tuple(value)
+
+    @staticmethod
+    def in_range(value, bounds):
+        low, high = bounds
+        return value >= low and (high is None or value <= high)
+
+    def matches(self, entry):
+        clock = entry.get('clock') or {}
+        return (
+            entry.get('format') in self.formats
+            and isinstance(clock.get('base'), int) and self.in_range(clock['base'], self.base)
+            and isinstance(clock.get('increment'), int) and self.in_range(clock['increment'], self.increment)
+        )
+
+    def groups(self):
+        """Bucket groups that can hold a matching game"""
+        low, high = self.base
+        bands = range(base_band(low), (base_band(high) if high is not None else len(BASE_BANDS)) + 1)
+        return [bucket_group(format, band) for format in sorted(self.formats) for band in bands]
+
+
+def game_entry(game, clock):
+    """A waiting game as lobby clients see it"""
+    return {
+        'game_id': game.room_id,
+        'format': game.format,
+        'clock': {
+            'base': clock.total_time,
+            'increment': clock.incremental_time,
+            'started': clock.started_at.isoformat()
+        } if clock is not None else None,
+        'player1': game.player1.username if game.player1 else None,
+        'player1_color': game.player1_color,
+        'player2': game.player2.username if game.player2 else None,
+        'player2_color': game.player2_color
+    }
+
+
+def event_entry(game):
+    """The lobby entry carried by an 'available' game.update event"""
+    return {
+        'game_id': game['game_id'],
+        'format': game.get('format'),
+        'clock': game.get('clock'),
+        'player1': game.get('player1'),
+        'player1_color': game.get('player1_color'),
+        'player2': game.get('player2'),
+        'player2_color': game.get('player2_color')
+    }
+
+
+def waiting_games():
+    return Game.objects.filter(status='waiting').select_related('player1', 'player2', 'game_clock')
+
+
+@database_sync_to_async
+def load_waiting_games():
+    entries = []
+    for game in waiting_games():
+        try:
+            clock = game.game_clock
+        except Clock.DoesNotExist:
+            clock = None
+        entries.append(game_entry(game, clock))
+    return entries
+
+
+class Lobby:
+    """Per process snapshot of waiting games with a version number and a log of recent changes
+
+    Every change bumps the version, so a client that saw version X can be sent only
+    the changes after X (or the whole snapshot once X has left the log). Versions
+    are numbered by each process: once a process serves the lobby, its listener
+    applies the events every process publishes (its own included) to its snapshot,
+    in the order it receives them.
+    """
+
+    def __init__(self, history=None, refresh_interval=None):
+        if history is None:
+            history = getattr(settings, 'CHESS_LOBBY_HISTORY', 1000)
+        if refresh_interval is None:
+            refresh_interval = getattr(settings, 'CHESS_LOBBY_REFRESH_INTERVAL', 60)
+        self.refresh_interval = refresh_interval
+        self.games = {}  # game_id -> entry
+        self.version = 0
+        self.changes = deque(maxlen=history)  # (version, game_id, entry or None when removed)
+        self.loaded_at = None
+        self.loading = None
+        self.listener = None
+        self.listener_loop = None
+        self.listener_channel = None
+        self.events_applied = 0
+
+    def __len__(self):
+        return len(self.games)
+
+    def upsert(self, entry):
+        if self.games.get(entry['game_id']) != entry:
+            self.games[entry['game_id']] = entry
+            self.version += 1
+            self.changes.append((self.version, entry['game_id'], entry))
+        return self.version
+
+    def discard(self, game_id):
+        if self.games.pop(game_id, None) is not None:
+            self.version += 1
+            self.changes.append((self.version, game_id, None))
+        return self.version
+
+    def apply(self, event):
+        """Apply a lobby game.update or games.removed event and return the resulting version"""
+        if event['type'] == 'games.removed':
+            for game_id in event['game_ids']:
+                self.discard(game_id)
+            return self.version
+        info = event['message'].get('info')
+        if info == 'available':
+            return self.upsert(event_entry(event['game']))
+        if info == 'unavailable':
+            return self.discard(event['game']['game_id'])
+        return self.version
+
+    async def listen(self, channel_layer):
+        """Start applying every process' lobby events to this snapshot, once per process (event loop)
+
+        The snapshot is reloaded then: what was published before went unseen.
+        """
+        loop = asyncio.get_running_loop()
+        if self.listener is not None and self.listener_loop is loop and not self.listener.done():
+            return
+        if self.listener_channel is not None:
+            # the listener of an earlier event loop (tests) is gone
+            await channel_layer.group_discard(LOBBY_GROUP, self.listener_channel)
+        self.listener_channel = await channel_layer.new_channel()
+        await channel_layer.group_add(LOBBY_GROUP, self.listener_channel)
+        self.listener_loop = loop
+        self.listener = loop.create_task(self.receive_events(channel_layer, self.listener_channel))
+        self.loaded_at = None
+
+    async def receive_events(self, channel_layer, channel):
+        renewed = time.monotonic()
+        receiving = None
+        while True:
+            if receiving is None:
+                receiving = asyncio.ensure_future(channel_layer.receive(channel))
+            # the receive is kept across the waits, cancelling it could drop a message
+            done, _ = await asyncio.wait({receiving}, timeout=LISTEN_RENEW_INTERVAL)
+            if time.monotonic() - renewed >= LISTEN_RENEW_INTERVAL:
+                renewed = time.monotonic()
+                await channel_layer.group_add(LOBBY_GROUP, channel)
+            if not done:
+                continue
+            try:
+                event = receiving.result()
+                if event['type'] in ('game.update', 'games.removed'):
+                    self.apply(event)
+                    self.events_applied += 1
+            except Exception:
+                logger.exception("applying a lobby event failed")
+                await asyncio.sleep(1)
+            receiving = None
+
+    def snapshot(self, subscription=None):
+        games = self.games.values()
+        if subscription is not None:
+            games = [entry for entry in games if subscription.matches(entry)]
+        return self.version, list(games)
+
+    def changes_since(self, version, subscription=None):
+        """Changes after version, oldest first, or None if they are no longer all in the log
+
+        With a subscription only matching additions are returned; removals are always
+        included since the client may have been shown the game before.
+        """
+        if version > self.version:
+            return None
+        if version == self.version:
+            return []
+        if not self.changes or self.changes[0][0] > version + 1:
+            return None
+        return [
+            {'version': changed, 'game_id': game_id, 'game': entry}
+            for changed, game_id, entry in self.changes
+            if changed > version and (entry is None or subscription is None or subscription.matches(entry))
+        ]
+
+    async def ensure_loaded(self):
+        """Build the snapshot with one query the first time, and re-sync it every refresh_interval"""
+        if self.loaded_at is not None and time.monotonic() - self.loaded_at < self.refresh_interval:
+            return
+        if self.loading is None:
+            self.loading = asyncio.ensure_future(self.refresh())
+        loading = self.loading
+        try:
+            await asyncio.shield(loading)
+        finally:
+            if self.loading is loading and loading.done():
+                self.loading = None
+
+    async def refresh(self):
+        """Reload from the database, recording the difference as ordinary changes"""
+        entries = await load_waiting_games()
+        seen = set()
+        for entry in entries:
+            seen.add(entry['game_id'])
+            self.upsert(entry)
+        for game_id in [game_id for game_id in self.games if game_id not in seen]:
+            self.discard(game_id)
+        self.loaded_at = time.monotonic()
+
+    async def publish(self, channel_layer, event):
+        """Apply the event to the snapshot and fan it out to the unfiltered lobby group and to
+        the bucket group of the game; lobby sockets send it with their own process' version
+        """
+        known = self.games.get(event['game']['game_id'])
+        group = entry_group(known if known is not None else event_entry(event['game']))
+        self.apply(event)
+        await channel_layer.group_send(LOBBY_GROUP, event)
+        if group is not None:
+            await channel_layer.group_send(group, event)
+        else:
+            # unknown game: every filtered subscriber may have it listed
+            for format in FORMATS:
+                for band in range(len(BASE_BANDS) + 1):
+                    await channel_layer.group_send(bucket_group(format, band), event)
+
+    async def publish_game(self, channel_layer, game, clock, player=None):
+        """Publish a game whose place in the lobby changed: 'available' with its entry while it
+        is waiting, 'unavailable' otherwise; every process' snapshot follows from the event
+        """
+        message = {'type': 'all', 'info': 'available' if game.status == 'waiting' else 'unavailable'}
+        if player is not None:
+            message['player'] = {'user': player}
+        await self.publish(channel_layer, {'type': 'game.update', 'game': game_entry(game, clock), 'message': message})
+
+    async def publish_removed(self, channel_layer, entries):
+        """Take several games out of the lobby with a single games.removed event per group:
+        one to the unfiltered lobby group, one to each bucket group that held some of them
+        """
+        buckets = {}
+        for entry in entries:
+            game_id = entry['game_id']
+            known = self.games.get(game_id)
+            group = entry_group(known if known is not None else entry)
+            if group is None:
+                for format in FORMATS:
+                    for band in range(len(BASE_BANDS) + 1):
+                        buckets.setdefault(bucket_group(format, band), []).append(game_id)
+            else:
+                buckets.setdefault(group, []).append(game_id)
+            self.discard(game_id)
+        event = {
+            'type': 'games.removed',
+            'game_ids': [entry['game_id'] for entry in entries],
+            'message': {
+                'type': 'all',
+                'info': 'unavailable'
+            }
+        }
+        await channel_layer.group_send(LOBBY_GROUP, event)
+        for group, game_ids in buckets.items():
+            await channel_layer.group_send(group, dict(event, game_ids=game_ids))
+
+
+lobby = Lobby()
@@ -0,0 +1,520 @@
+import asyncio
+import gc
+import json
+import os
+import random
+import secrets
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+import chess
+import msgpack
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils.module_loading import import_string
+from rest_framework.authtoken.models import Token
+
+from chess_app.consumers import ChessRoomConsumer, SpectatorConsumer
+from chess_app.clock import scheduler
+from chess_app.persistence import writer
+from chess_app.presence import presence
+from chess_app.ratelimit import limiter
+from chess_app.spectators import watch
+
+SUBPROTOCOLS = {'v1': None, 'v2': 'chess.v2', 'v2.msgpack': 'chess.v2.msgpack'}
+ACTIONS = ('create_game', 'join_game', 'make_move', 'resign_game')
+
+
+def scripted_moves(count, seed=0):
+    """A reproducible line of legal moves that does not end the game early"""
+    rng = random.Random(seed)
+    while True:
+        board = chess.Board()
+        for _ in range(count):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+            if board.is_game_over(claim_draw=True):
+                break
+        else:
+            return [move.uci() for move in board.move_stack]
+
+
+def with_user(app, user, game_id):
+    """Fill the scope the way TokenAuthMiddleWare and URLRouter would"""
+    async def application(scope, receive, send):
+        kwargs = {} if game_id is None else {'game_id': game_id}
+        scope = dict(scope, user=user, url_route={'args': (), 'kwargs': kwargs})
+        return await app(scope, receive, send)
+    return application
+
+
+def decode(data):
+    """A frame decoded from JSON text or MessagePack bytes, and its size in bytes"""
+    if isinstance(data, bytes):
+        return msgpack.unpackb(data), len(data)
+    return json.loads(data), len(data.encode())
+
+
+async def receive_frame(socket, timeout=60):
+    """The next frame of a WebsocketCommunicator, decoded, and its size in bytes"""
+    frame = await socket.receive_output(timeout)
+    return decode(frame['bytes'] if frame.get('bytes') is not None else frame['text'])
+
+
+def info(frame):
+    return frame.get('t', frame.get('message', {}).get('info'))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def milliseconds(seconds):
+    return round(seconds * 1000, 2)
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def resident_bytes(pid):
+    """Resident memory of a process (Linux), None where /proc is not available"""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise CommandError(f'nothing listening on {port}')
+
+
+class QueryCounter:
+    """Counts the queries of every database connection opened while it is installed, in any thread"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class LocalClient:
+    """A socket to a consumer running in this process"""
+
+    def __init__(self, app, user, path, game_id=None, subprotocols=None):
+        self.socket = WebsocketCommunicator(with_user(app, user, game_id), path, subprotocols=subprotocols)
+
+    async def connect(self):
+        connected, _ = await self.socket.connect(timeout=120)
+        assert connected
+
+    async def send(self, content):
+        await self.socket.send_json_to(content)
+
+    async def receive(self):
+        return await receive_frame(self.socket)
+
+    def drain(self):
+        # the frames a watcher's client would read, left in the queue until the run is over
+        count = 0
+        while not self.socket.output_queue.empty():
+            self.socket.output_queue.get_nowait()
+            count += 1
+        return count
+
+    async def close(self):
+        await self.socket.disconnect(timeout=60)
+
+
+class RemoteClient:
+    """A real websocket to a server; a watcher's frames are read (and counted) as they come"""
+
+    def __init__(self, url, subprotocols=None, watcher=False):
+        self.url = url
+        self.subprotocols = subprotocols
+        self.watcher = watcher
+        self.socket = None
+        self.reader = None
+        self.frames = 0
+
+    async def connect(self):
+        from websockets.asyncio.client import connect
+
+        self.socket = await connect(self.url, subprotocols=self.subprotocols, open_timeout=120)
+        if self.watcher:
+            self.reader = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        async for _ in self.socket:
+            self.frames += 1
+
+    async def send(self, content):
+        await self.socket.send(json.dumps(content))
+
+    async def receive(self):
+        return decode(await asyncio.wait_for(self.socket.recv(), 60))
+
+    def drain(self):
+        count, self.frames = self.frames, 0
+        return count
+
+    async def close(self):
+        await self.socket.close()
+        if self.reader is not None:
+            await self.reader
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the websocket consumers: games created, joined, played and resigned by many concurrent "
+        "sockets, with lobby watchers and spectators, in-process on a throwaway test database or over "
+        "real sockets against uvicorn"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=1000, help="concurrent player sockets (two per game)")
+        parser.add_argument('--moves', type=int, default=20, help="moves played in each game before a resign")
+        parser.add_argument(
+            '--consumer', action='append', dest='consumers',
+            help="dotted path of a consumer class, may be repeated to compare (default: chess_app.consumers.ChessConsumer)"
+        )
+        parser.add_argument(
+            '--protocol', choices=sorted(SUBPROTOCOLS), default='v1', help="wire format the sockets ask for"
+        )
+        parser.add_argument(
+            '--spectators', type=int, default=0, help="spectator sockets watching the first game"
+        )
+        parser.add_argument('--watchers', type=int, default=0, help="lobby sockets watching games come and go")
+        parser.add_argument(
+            '--uvicorn', action='store_true',
+            help="real sockets against a uvicorn process on a temporary database instead of in-process consumers"
+        )
+        parser.add_argument('--output', help="also write the runs to this file as a JSON list")
+
+    def handle(self, *args, **options):
+        if options['uvicorn']:
+            if options['consumers']:
+                raise CommandError("--consumer picks in-process consumers, uvicorn serves the routed ones")
+            results = self.handle_uvicorn(options)
+        else:
+            results = self.handle_local(options)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    def users_needed(self, options):
+        return max(1, options['sockets'] // 2) * 2 + options['spectators'] + options['watchers']
+
+    def handle_local(self, options):
+        consumers = options['consumers'] or ['chess_app.consumers.ChessConsumer']
+        # the scripted players move far faster than people, the flood protection would stop them
+        limiter.enabled = False
+        queries = QueryCounter()
+        connection_created.connect(queries.install)
+
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        results = []
+        try:
+            users = User.objects.bulk_create(
+                [User(username=f'bench{i}') for i in range(self.users_needed(options))]
+            )
+            queries.install(None, connection)
+            lobby_app = ChessRoomConsumer.as_asgi()
+            spectator_app = SpectatorConsumer.as_asgi()
+            for run, path in enumerate(consumers):
+                app = import_string(path).as_asgi()
+                subprotocols = [SUBPROTOCOLS[options['protocol']]] if SUBPROTOCOLS[options['protocol']] else None
+
+                def client(kind, index, game_id=None):
+                    if kind == 'game':
+                        return LocalClient(app, users[index], f'/ws/chess/{game_id}/', game_id, subprotocols)
+                    if kind == 'watch':
+                        return LocalClient(spectator_app, users[index], f'/ws/chess/{game_id}/watch/', game_id)
+                    return LocalClient(lobby_app, users[index], '/ws/chess/')
+
+                bench = Bench(client, f'bench{run}x', options, queries)
+                result = asyncio.run(bench.run(memory=bench.traced_memory))
+                results.append(dict({'consumer': path, 'transport': 'in-process'}, **result))
+                self.stdout.write(json.dumps(results[-1]))
+        finally:
+            connection_created.disconnect(queries.install)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        return results
+
+    def handle_uvicorn(self, options):
+        directory = tempfile.TemporaryDirectory()
+        database = os.path.join(directory.name, 'bench.sqlite3')
+        old_name = connection.settings_dict['NAME']
+        connection.close()
+        connection.settings_dict['NAME'] = database
+        server = None
+        try:
+            call_command('migrate', verbosity=0, interactive=False)
+            users = User.objects.bulk_create(
+                [User(username=f'bench{i}') for i in range(self.users_needed(options))]
+            )
+            tokens = [token.key for token in Token.objects.bulk_create(
+                [Token(key=secrets.token_hex(20), user=user) for user in users]
+            )]
+            connection.close()
+
+            port = free_port()
+            server = subprocess.Popen(
+                [sys.executable, '-m', 'uvicorn', 'backend.asgi:application', '--port', str(port), '--log-level', 'warning'],
+                cwd=settings.BASE_DIR,
+                env=dict(os.environ, DJANGO_DB_NAME=database, DJANGO_CHESS_RATE_LIMIT='False'),
+            )
+            wait_for(port)
+            base = f'ws://127.0.0.1:{port}/ws/chess/'
+            subprotocols = [SUBPROTOCOLS[options['protocol']]] if SUBPROTOCOLS[options['protocol']] else None
+
+            def client(kind, index, game_id=None):
+                if kind == 'game':
+                    return RemoteClient(f'{base}{game_id}/?token={tokens[index]}', subprotocols)
+                if kind == 'watch':
+                    return RemoteClient(f'{base}{game_id}/watch/?token={tokens[index]}', watcher=True)
+                return RemoteClient(f'{base}?token={tokens[index]}', watcher=True)
+
+            def memory(connect):
+                return Bench.resident_memory(connect, server.pid)
+
+            bench = Bench(client, 'bench0x', options)
+            result = dict({'consumer': 'backend.asgi:application', 'transport': 'uvicorn'}, **asyncio.run(bench.run(memory)))
+            self.stdout.write(json.dumps(result))
+            return [result]
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait(10)
+            connection.close()
+            connection.settings_dict['NAME'] = old_name
+            directory.cleanup()
+
+
+class Bench:
+    """One run: the sockets connect, then every game is created, joined, played and resigned
+    phase by phase, so that each phase's queries belong to one action
+    """
+
+    def __init__(self, client, prefix, options, queries=None):
+        self.client = client
+        self.prefix = prefix
+        self.games = max(1, options['sockets'] // 2)
+        self.script = scripted_moves(options['moves'])
+        self.protocol = options['protocol']
+        self.spectators = options['spectators']
+        self.watchers = options['watchers']
+        self.queries = queries
+        self.latencies = defaultdict(list)
+        self.phase_queries = {}
+        self.move_bytes = []
+        self.frames = 0
+
+    @staticmethod
+    async def traced_memory(connect):
+        """Bytes allocated in this process while connecting: the consumers and the test client's side"""
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            await connect()
+            return tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+
+    @staticmethod
+    async def resident_memory(connect, pid):
+        """Growth of the server's resident memory while connecting"""
+        before = resident_bytes(pid)
+        await connect()
+        after = resident_bytes(pid)
+        return None if before is None or after is None else after - before
+
+    async def receive(self, socket, expected):
+        """Read frames up to the one with info `expected`"""
+        for _ in range(10):
+            frame, size = await socket.receive()
+            self.frames += 1
+            if info(frame) == expected:
+                return frame, size
+        raise AssertionError(f'no {expected!r} frame, last was {frame}')
+
+    async def timed(self, action, socket, content, expected):
+        started = time.perf_counter()
+        await socket.send(dict(content, action=action))
+        frame, size = await self.receive(socket, expected)
+        self.latencies[action].append(time.perf_counter() - started)
+        return frame, size
+
+    async def phase(self, action, coroutines):
+        queries = self.queries.count if self.queries is not None else 0
+        started = time.perf_counter()
+        await asyncio.gather(*coroutines)
+        elapsed = time.perf_counter() - started
+        if self.queries is not None:
+            # write-behind rows are part of what the phase's actions cost
+            await writer.flush()
+            self.phase_queries[action] = self.queries.count - queries
+        return elapsed
+
+    async def run(self, memory):
+        # every run has its own event loop, the previous run's timers and sockets are gone
+        scheduler.clear()
+        presence.clear()
+        watch.clear()
+        players = [
+            (self.client('game', index * 2, f'{self.prefix}{index}'), self.client('game', index * 2 + 1, f'{self.prefix}{index}'))
+            for index in range(self.games)
+        ]
+        lobby = [self.client('lobby', self.games * 2 + index) for index in range(self.watchers)]
+        spectators = [
+            self.client('watch', self.games * 2 + self.watchers + index, f'{self.prefix}0')
+            for index in range(self.spectators)
+        ]
+        sockets = [socket for pair in players for socket in pair]
+
+        await asyncio.gather(*(socket.connect() for socket in lobby))
+
+        async def connect_players():
+            await asyncio.gather(*(socket.connect() for socket in sockets))
+            await asyncio.gather(*(self.receive(socket, 'connected') for socket in sockets))
+
+        connect_memory = await memory(connect_players)
+        # the watchers' frames are counted once they are done: polling 10k sockets' queues
+        # on the players' event loop would cost more than serving them
+        watchers = lobby + spectators
+
+        async def create(white, black):
+            await self.timed('create_game', white, {'base': 60000, 'increment': 0, 'format': 'bullet'}, 'created')
+
+        async def join(white, black):
+            await self.timed('join_game', black, {}, 'joined')
+            await self.receive(white, 'joined')
+
+        async def play(white, black):
+            pair = (white, black)
+            for ply, move in enumerate(self.script):
+                _, size = await self.timed('make_move', pair[ply % 2], {'move': move}, 'moved')
+                self.move_bytes.append(size)
+                await self.receive(pair[(ply + 1) % 2], 'moved')
+
+        async def resign(white, black):
+            resigning, other = (white, black) if len(self.script) % 2 == 0 else (black, white)
+            await self.timed('resign_game', resigning, {}, 'resigned')
+            await self.receive(other, 'resigned')
+
+        try:
+            started = time.perf_counter()
+            await self.phase('create_game', (create(*pair) for pair in players))
+            await self.phase('join_game', (join(*pair) for pair in players))
+            window = time.perf_counter() - started
+            if spectators:
+                await asyncio.gather(*(socket.connect() for socket in spectators))
+            # like a warmed up server: the sockets' objects are old, full collections would walk
+            # them all (hundreds of ms for 10k sockets) whatever the actions cost
+            gc.collect()
+            gc.freeze()
+            started = time.perf_counter()
+            elapsed = await self.phase('make_move', (play(*pair) for pair in players))
+            await self.phase('resign_game', (resign(*pair) for pair in players))
+            window += time.perf_counter() - started
+            if spectators:
+                # the last frames are sent one tick after the last move
+                await asyncio.sleep(watch.tick * 2)
+        finally:
+            self.frames += sum(socket.drain() for socket in watchers)
+            await asyncio.gather(*(socket.close() for socket in watchers + sockets), return_exceptions=True)
+            gc.unfreeze()
+        if self.queries is not None:
+            await writer.flush()
+        return self.report(elapsed, window, connect_memory)
+
+    def report(self, elapsed, window, connect_memory):
+        moves = self.latencies['make_move']
+        result = {
+            'commit': current_commit(),
+            'sockets': self.games * 2,
+            'moves': len(moves),
+            'seconds': round(elapsed, 3),
+            'moves_per_sec': round(len(moves) / elapsed, 1),
+            'move_ms_p50': milliseconds(percentile(moves, 50)),
+            'move_ms_p95': milliseconds(percentile(moves, 95)),
+            'move_ms_mean': milliseconds(statistics.fmean(moves)) if moves else 0.0,
+            'protocol': self.protocol,
+            'move_frame_bytes': round(statistics.fmean(self.move_bytes), 1) if self.move_bytes else 0.0,
+            # every frame the players, lobby watchers and spectators read while the games ran
+            'messages_per_sec': round(self.frames / window, 1),
+            'memory_per_socket_bytes': None if connect_memory is None else round(connect_memory / (self.games * 2)),
+            'actions': {
+                action: {
+                    'count': len(self.latencies[action]),
+                    'ms_p50': milliseconds(percentile(self.latencies[action], 50)),
+                    'ms_p95': milliseconds(percentile(self.latencies[action], 95)),
+                    'ms_p99': milliseconds(percentile(self.latencies[action], 99)),
+                    'queries': (
+                        round(self.phase_queries[action] / len(self.latencies[action]), 2)
+                        if action in self.phase_queries and self.latencies[action] else None
+                    ),
+                }
+                for action in ACTIONS
+            },
+        }
+        if self.watchers:
+            result['lobby_watchers'] = self.watchers
+        if self.spectators:
+            result['spectators'] = self.spectators
+        if self.queries is not None:
+            # the server's own state only exists in-process
+            if self.spectators:
+                result['watch'] = watch.stats()
+            if writer.enabled:
+                result['write_behind'] = writer.stats()
+        return result
@@ -0,0 +1,241 @@
+import datetime
+import random
+import time
+from contextlib import contextmanager
+
+import chess
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from chess_app.models import Game, Clock, Move, pack_move, pack_values, unpack_values
+
+# (format, weight, [(base, increment) ms], milliseconds a move takes (min, max))
+FORMATS = [
+    ('bullet', 25, [(60000, 0), (120000, 1000)], (300, 3000)),
+    ('bliz', 35, [(180000, 0), (180000, 2000), (300000, 0), (300000, 3000)], (1000, 10000)),
+    ('rapid', 25, [(600000, 0), (600000, 5000), (900000, 10000)], (3000, 30000)),
+    ('classic', 10, [(1800000, 0), (1800000, 20000)], (10000, 90000)),
+    ('custom', 5, [(45000, 0), (420000, 7000), (2700000, 30000)], (1000, 30000)),
+]
+STATUS_WEIGHTS = {'waiting': 2, 'active': 3, 'ended': 95}
+# how ended games ended; checkmate and draw only where a line really ends that way
+OVER_WEIGHTS = {'resign': 40, 'timeout': 20, 'checkmate': 15, 'draw': 10, 'abandoned': 15}
+MAX_LINE_PLIES = 300
+
+
+class Line:
+    """A random game of legal moves, with what a game cut at any ply needs"""
+
+    def __init__(self, rng):
+        board = chess.Board()
+        self.fens = [board.fen()]
+        while len(board.move_stack) < MAX_LINE_PLIES:
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+            self.fens.append(board.fen())
+            if board.is_insufficient_material() or board.is_seventyfive_moves():
+                break
+        self.moves = list(board.move_stack)
+        self.packed = pack_values('H', [pack_move(move) for move in self.moves])
+        outcome = board.outcome()
+        self.termination = outcome.termination if outcome else None
+        # milliseconds per move in each format
+        self.times = {
+            format: pack_values('I', [rng.randint(*move_ms) for _ in self.moves])
+            for format, _, _, move_ms in FORMATS
+        }
+
+    def __len__(self):
+        return len(self.moves)
+
+
+@contextmanager
+def explicit_timestamps(*fields):
+    """Let auto_now / auto_now_add fields keep the values set on the instances"""
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the database with synthetic users and games in every status and format, their moves "
+        "taken from random games of legal moves (bulk_create in batches, reproducible with --seed)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=100000, help="games to create")
+        parser.add_argument('--users', type=int, default=10000, help="users to create and pair up")
+        parser.add_argument('--batch', type=int, default=5000, help="games per bulk_create and transaction")
+        parser.add_argument('--seed', type=int, default=0, help="seed of every random choice")
+        parser.add_argument(
+            '--lines', type=int, default=300,
+            help="random games of legal moves played up front; each game is a cut of one of them"
+        )
+        parser.add_argument('--days', type=int, default=365, help="games are spread over this many past days")
+        parser.add_argument('--prefix', default='syn', help="prefix of the generated room ids and usernames")
+        parser.add_argument(
+            '--move-rows', action='store_true',
+            help="also write a Move row per move (the history the app reads is packed in Game)"
+        )
+
+    def handle(self, *args, **options):
+        prefix = options['prefix']
+        if Game.objects.filter(room_id__startswith=prefix).exists() or \
+                User.objects.filter(username__startswith=prefix).exists():
+            raise CommandError(f"there are games or users named {prefix}... already, pick another --prefix")
+        if options['games'] < 1 or options['users'] < 2 or options['batch'] < 1 or options['lines'] < 1:
+            raise CommandError("--games, --batch and --lines must be at least 1, --users at least 2")
+        rng = random.Random(options['seed'])
+        started = time.perf_counter()
+
+        lines = [Line(rng) for _ in range(options['lines'])]
+        self.by_termination = {
+            'checkmate': [line for line in lines if line.termination == chess.Termination.CHECKMATE],
+            'draw': [line for line in lines if line.termination not in (None, chess.Termination.CHECKMATE)],
+        }
+        self.lines = lines
+        self.stdout.write(f"Played {len(lines)} random lines in {time.perf_counter() - started:.1f}s")
+
+        if connection.vendor == 'sqlite':
+            # a bulk load of throwaway data: no fsync per transaction on this connection
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA synchronous = OFF')
+
+        password = make_password(None)  # unusable, hashed once
+        users = User.objects.bulk_create(
+            [User(username=f'{prefix}{index}', password=password) for index in range(options['users'])],
+            batch_size=options['batch']
+        )
+        user_ids = [user.pk for user in users]
+        if user_ids[0] is None:
+            user_ids = list(User.objects.filter(username__startswith=prefix).order_by('pk').values_list('pk', flat=True))
+
+        now = timezone.now()
+        counts = {status: 0 for status in STATUS_WEIGHTS}
+        statuses, status_weights = zip(*STATUS_WEIGHTS.items())
+        format_weights = [weight for _, weight, _, _ in FORMATS]
+        moves_written = 0
+        with explicit_timestamps(Game._meta.get_field('updated_at'), Clock._meta.get_field('started_at')):
+            for first in range(0, options['games'], options['batch']):
+                games, clocks, move_rows = [], [], []
+                for index in range(first, min(first + options['batch'], options['games'])):
+                    status = rng.choices(statuses, status_weights)[0]
+                    format_entry = rng.choices(FORMATS, format_weights)[0]
+                    created_at = now - datetime.timedelta(seconds=rng.uniform(0, options['days'] * 86400))
+                    game, clock, line, plies = self.game(
+                        rng, f'{prefix}{index}', status, format_entry, created_at, user_ids
+                    )
+                    games.append(game)
+                    clocks.append(clock)
+                    counts[status] += 1
+                    if options['move_rows'] and plies:
+                        played_at = clock.started_at
+                        # in UCI, as the app reads them (migration 0008)
+                        for ply, (move, delta) in enumerate(zip(line.moves[:plies], game.move_deltas), start=1):
+                            played_at += datetime.timedelta(milliseconds=delta)
+                            move_rows.append(Move(game=game, move=move.uci(), ply=ply, played_at=played_at))
+                with transaction.atomic():
+                    Game.objects.bulk_create(games)
+                    Clock.objects.bulk_create(clocks)
+                    if move_rows:
+                        Move.objects.bulk_create(move_rows)
+                moves_written += len(move_rows)
+                done = first + len(games)
+                if done % (options['batch'] * 20) == 0 or done == options['games']:
+                    self.stdout.write(f"{done} games, {time.perf_counter() - started:.1f}s")
+
+        self.stdout.write(
+            f"Generated {options['games']} games ({counts['waiting']} waiting, {counts['active']} active, "
+            f"{counts['ended']} ended), {options['users']} users"
+            + (f", {moves_written} move rows" if options['move_rows'] else '')
+            + f" in {time.perf_counter() - started:.1f}s"
+        )
+
+    def game(self, rng, room_id, status, format_entry, created_at, user_ids):
+        """An unsaved game and clock, the line its moves come from and how many of them it played"""
+        format, _, controls, _ = format_entry
+        base, increment = rng.choice(controls)
+        player1, player2 = rng.sample(user_ids, 2)
+        player1_color = rng.choice(('white', 'black'))
+        over_type = winner = None
+        line = rng.choice(self.lines)
+        clock1 = clock2 = base
+
+        if status == 'waiting':
+            # mostly a creator waiting for an opponent, sometimes a game both players left
+            plies = 0 if rng.random() < 0.8 else rng.randint(1, min(len(line), 40))
+            if not plies:
+                player2 = None
+            connected = (plies == 0, False)
+        elif status == 'active':
+            plies = rng.randint(1, min(len(line), 120))
+            connected = (True, True)
+        else:
+            over_type = rng.choices(list(OVER_WEIGHTS), list(OVER_WEIGHTS.values()))[0]
+            if over_type in self.by_termination and not self.by_termination[over_type]:
+                over_type = 'resign'
+            if over_type in self.by_termination:
+                line = rng.choice(self.by_termination[over_type])
+                plies = len(line)
+            elif over_type == 'abandoned':
+                plies = 0 if rng.random() < 0.7 else rng.randint(1, min(len(line), 40))
+                if not plies:
+                    player2 = None
+            else:
+                plies = rng.randint(min(len(line), 10), min(len(line), 160))
+            connected = (False, False)
+
+        white_to_move = plies % 2 == 0
+        to_move = 'player1' if (player1_color == 'white') == white_to_move else 'player2'
+        other = 'player2' if to_move == 'player1' else 'player1'
+        if over_type == 'checkmate':
+            winner = other  # the side to move is mated
+        elif over_type == 'timeout':
+            winner = other
+            clock1, clock2 = (0, clock2) if to_move == 'player1' else (clock1, 0)
+        elif over_type == 'resign':
+            winner = rng.choice(('player1', 'player2'))
+        if plies and over_type != 'timeout':
+            clock1, clock2 = rng.randint(base // 20, base), rng.randint(base // 20, base)
+
+        times = line.times[format][:plies * 4]
+        game = Game(
+            room_id=room_id,
+            player1_id=player1,
+            player1_color=player1_color,
+            player2_id=player2,
+            player2_color='black' if player1_color == 'white' else 'white',
+            player1_connected=connected[0],
+            player2_connected=connected[1],
+            current_turn=to_move,
+            fen=line.fens[plies],
+            status=status,
+            winner=winner,
+            over_type=over_type,
+            format=format,
+            moves_packed=line.packed[:plies * 2],
+            move_times=times,
+            version=plies + (1 if player2 is not None else 0) + (1 if status == 'ended' else 0),
+            created_at=created_at,
+            updated_at=created_at + datetime.timedelta(milliseconds=sum(unpack_values('I', times))),
+        )
+        clock = Clock(
+            game=game,
+            started_at=created_at,
+            total_time=base,
+            incremental_time=increment,
+            clock1=clock1,
+            clock2=clock2,
+        )
+        return game, clock, line, plies
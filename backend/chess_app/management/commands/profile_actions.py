@@ -0,0 +1,46 @@
+import glob
+import io
+import os
+import pstats
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        "Print the sampled profiles of websocket actions (DJANGO_CHESS_PROFILE=True), "
+        "the files of every process added up per action"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--action', action='append', dest='actions', help="only this action, may be repeated (default: all)"
+        )
+        parser.add_argument(
+            '--sort', default='cumulative', help="pstats sort key: cumulative, tottime, ncalls, ... (default: cumulative)"
+        )
+        parser.add_argument('--limit', type=int, default=30, help="functions printed per action")
+        parser.add_argument('--dir', help="where the profiles are (default: CHESS_PROFILE_DIR)")
+        parser.add_argument('--clear', action='store_true', help="delete the profiles once printed")
+
+    def handle(self, *args, **options):
+        directory = options['dir'] or str(getattr(settings, 'CHESS_PROFILE_DIR', 'profiles'))
+        files = defaultdict(list)  # action -> one file per process
+        for path in sorted(glob.glob(os.path.join(directory, '*.prof'))):
+            action = os.path.basename(path).split('.')[0]
+            if not options['actions'] or action in options['actions']:
+                files[action].append(path)
+        if not files:
+            raise CommandError(f"no profiles in {directory}")
+
+        for action, paths in sorted(files.items()):
+            report = io.StringIO()
+            stats = pstats.Stats(*paths, stream=report)
+            stats.strip_dirs().sort_stats(options['sort']).print_stats(options['limit'])
+            self.stdout.write(f"== {action}: {len(paths)} process(es)")
+            self.stdout.write(report.getvalue())
+            if options['clear']:
+                for path in paths:
+                    os.remove(path)
@@ -0,0 +1,41 @@
+import asyncio
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+
+from chess_app.reaper import reap
+
+
+class Command(BaseCommand):
+    help = (
+        "End stale waiting and active games as abandoned (one UPDATE) and tell the lobby in one message; "
+        "the servers' lobby clients hear it through a shared channel layer"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--waiting-after', type=int,
+            help="seconds since a game nobody joined was updated (default: CHESS_REAP_WAITING_AFTER)"
+        )
+        parser.add_argument(
+            '--disconnected-after', type=int,
+            help="seconds since a waiting game with two players was updated (default: CHESS_REAP_DISCONNECTED_AFTER)"
+        )
+        parser.add_argument(
+            '--active-after', type=int,
+            help="seconds since an active game was updated (default: CHESS_REAP_ACTIVE_AFTER)"
+        )
+        parser.add_argument('--dry-run', action='store_true', help="only report what would be reaped")
+
+    def handle(self, *args, **options):
+        reaped = asyncio.run(reap(
+            waiting_after=options['waiting_after'],
+            disconnected_after=options['disconnected_after'],
+            active_after=options['active_after'],
+            dry_run=options['dry_run'],
+        ))
+        kinds = Counter(game['abandoned'] for game in reaped)
+        self.stdout.write(
+            f"{'Would reap' if options['dry_run'] else 'Reaped'} {len(reaped)} stale games "
+            f"({kinds['waiting']} waiting, {kinds['disconnected']} disconnected, {kinds['active']} active)"
+        )
@@ -0,0 +1,277 @@
+# metrics.py
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 32)
+
+# the span (action, connect, ...) running in this task; database_sync_to_async copies
+# the context into the database thread, so its queries are counted for the span
+current_span = contextvars.ContextVar('chess_metrics_span', default=None)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def label_text(names, values, extra=()):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A family of values by label; recorded from the event loop and from the database
+    threads (Metrics.execute), so every change and read holds the family's lock"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}  # label values -> value
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return sorted(self.values.items())
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for values, value in self.snapshot():
+            lines.append(f'{self.name}{label_text(self.labels, values)} {number(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                # counts per bucket (the last one past the largest bound), sum, count
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+            entry[0][bucket] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return sorted((values, (list(counts), total, count)) for values, (counts, total, count) in self.values.items())
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for values, (counts, total, count) in self.snapshot():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                lines.append(
+                    f'{self.name}_bucket{label_text(self.labels, values, [("le", number(bound))])} {cumulative}'
+                )
+            lines.append(f'{self.name}_sum{label_text(self.labels, values)} {number(total)}')
+            lines.append(f'{self.name}_count{label_text(self.labels, values)} {count}')
+        return lines
+
+
+class Span:
+    """Times a block into a histogram and counts the database queries run for it"""
+
+    __slots__ = ('metrics', 'labels', 'started', 'token', 'queries', 'db_seconds')
+
+    def __init__(self, metrics, labels):
+        self.metrics = metrics
+        self.labels = labels
+        self.queries = 0
+        self.db_seconds = 0.0
+
+    def __enter__(self):
+        self.token = current_span.set(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        elapsed = time.perf_counter() - self.started
+        current_span.reset(self.token)
+        metrics = self.metrics
+        metrics.action_seconds.observe(elapsed, *self.labels)
+        metrics.action_queries.observe(self.queries, *self.labels)
+        if self.db_seconds:
+            metrics.action_db_seconds.inc(*self.labels, amount=self.db_seconds)
+        if exc_type is not None and issubclass(exc_type, Exception):
+            metrics.action_errors.inc(*self.labels)
+        return False
+
+
+class NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+class TimedLayer:
+    """A channel layer whose send and group_send are timed into chess_layer_send_seconds"""
+
+    __slots__ = ('layer', 'metrics')
+
+    def __init__(self, layer, metrics):
+        self.layer = layer
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.layer, name)
+
+    async def send(self, channel, message):
+        started = time.perf_counter()
+        try:
+            await self.layer.send(channel, message)
+        finally:
+            self.metrics.layer_send_seconds.observe(time.perf_counter() - started, 'send')
+
+    async def group_send(self, group, message):
+        started = time.perf_counter()
+        try:
+            await self.layer.group_send(group, message)
+        finally:
+            self.metrics.layer_send_seconds.observe(time.perf_counter() - started, 'group_send')
+
+
+class Metrics:
+    """In-process metrics of the websocket hot paths, rendered in the Prometheus text format
+
+    Each process keeps its own (uvicorn workers, shard workers), a scraper reads
+    every process. Recording is a dict lookup and a few additions per event, under the
+    family's lock.
+    """
+
+    def __init__(self, enabled=None):
+        if enabled is None:
+            enabled = getattr(settings, 'CHESS_METRICS', True)
+        self.enabled = enabled
+        self.action_seconds = Histogram(
+            'chess_action_seconds', "Time to handle a websocket message or connect/disconnect", ('consumer', 'action')
+        )
+        self.action_queries = Histogram(
+            'chess_action_queries', "Database queries run for one websocket message or connect/disconnect",
+            ('consumer', 'action'), QUERY_BUCKETS
+        )
+        self.action_db_seconds = Counter(
+            'chess_action_db_seconds_total', "Time spent in database queries per action", ('consumer', 'action')
+        )
+        self.action_errors = Counter(
+            'chess_action_errors_total', "Websocket messages whose handling raised", ('consumer', 'action')
+        )
+        self.db_query_seconds = Histogram('chess_db_query_seconds', "Time of each database query")
+        self.auth_seconds = Histogram(
+            'chess_auth_seconds', "Time to authenticate a websocket by its token", ('result',)
+        )
+        self.layer_send_seconds = Histogram(
+            'chess_layer_send_seconds', "Time of channel layer sends from the game paths", ('method',)
+        )
+        self.sockets = Gauge('chess_sockets', "Open websockets", ('consumer',))
+        self.families = [
+            self.action_seconds, self.action_queries, self.action_db_seconds, self.action_errors,
+            self.db_query_seconds, self.auth_seconds, self.layer_send_seconds, self.sockets,
+        ]
+
+    def span(self, consumer, action):
+        """Context manager timing the handling of action on a consumer ('game', 'lobby', 'spectator')"""
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, (consumer, action))
+
+    def timed_layer(self, layer):
+        if not self.enabled or layer is None:
+            return layer
+        return TimedLayer(layer, self)
+
+    def execute(self, execute, sql, params, many, context):
+        """Database execute wrapper: every query's time, and its span's count"""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.db_query_seconds.observe(elapsed)
+            span = current_span.get()
+            if span is not None:
+                span.queries += 1
+                span.db_seconds += elapsed
+
+    def clear(self):
+        for family in self.families:
+            family.clear()
+
+    def render(self, stats=()):
+        """The exposition text; stats are (prefix, help, dict) whose numbers become gauges prefix_key"""
+        lines = []
+        for family in self.families:
+            lines.extend(family.render())
+        for prefix, help, values in stats:
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    name = f'{prefix}_{key}'
+                    lines.extend([f'# HELP {name} {help}', f'# TYPE {name} gauge', f'{name} {number(value)}'])
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+@receiver(connection_created)
+def time_queries(sender, connection, **kwargs):
+    if metrics.enabled and metrics.execute not in connection.execute_wrappers:
+        connection.execute_wrappers.append(metrics.execute)
@@ -1,13 +1,109 @@
 from rest_framework.authtoken.models import Token
 from urllib.parse import parse_qs
 from channels.db import database_sync_to_async
-from django.contrib.auth.models import AnonymousUser
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from collections import OrderedDict
+import threading
+import time
+
+from .metrics import metrics
+
+
+class TokenCache:
+    """Bounded LRU of token key -> user, entries expire after ttl seconds
+
+    The signal handlers below invalidate entries from whatever thread saves the
+    model (database_sync_to_async's among them) while the event loop reads the
+    cache, so every access holds the lock.
+    """
+
+    def __init__(self, maxsize=None, ttl=None):
+        self.maxsize = maxsize if maxsize is not None else getattr(settings, 'CHESS_TOKEN_CACHE_SIZE', 10000)
+        self.ttl = ttl if ttl is not None else getattr(settings, 'CHESS_TOKEN_CACHE_TTL', 60)
+        self.entries = OrderedDict()  # key -> (user, expires)
+        self.keys_by_user = {}  # user pk -> keys of its entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                user, expires = entry
+                if expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return user
+                self.remove(key)
+            self.misses += 1
+            return None
+
+    def set(self, key, user):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (user, time.monotonic() + self.ttl)
+            self.keys_by_user.setdefault(user.pk, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        """Drop an entry, the lock held"""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            keys = self.keys_by_user.get(entry[0].pk)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_user[entry[0].pk]
+
+    def invalidate(self, key):
+        with self.lock:
+            self.remove(key)
+
+    def invalidate_user(self, user_id):
+        with self.lock:
+            for key in list(self.keys_by_user.get(user_id, ())):
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_user.clear()
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+token_cache = TokenCache()
+
+
+@receiver(post_delete, sender=Token)
+def forget_token(sender, instance, **kwargs):
+    # djoser's token/logout deletes the token
+    token_cache.invalidate(instance.key)
+
+
+@receiver(post_save, sender=User)
+def forget_user_tokens(sender, instance, update_fields=None, **kwargs):
+    # username or is_active may have changed; a login only stamps last_login
+    if update_fields is not None and update_fields <= {'last_login'}:
+        return
+    token_cache.invalidate_user(instance.pk)
 
 
 @database_sync_to_async
 def returnUser(token_string):
     try:
-        user = Token.objects.get(key=token_string).user
+        user = Token.objects.select_related('user').get(key=token_string).user
     except:
         user = AnonymousUser()
     return user
@@ -18,13 +114,22 @@ class TokenAuthMiddleWare:
         self.app = app
 
     async def __call__(self, scope, receive, send):
+        started = time.perf_counter()
         query_string = scope["query_string"]
         query_params = query_string.decode()
         query_dict = parse_qs(query_params)
         if "token" in query_dict and query_dict["token"]:
             token = query_dict["token"][0]
-            user = await returnUser(token)
+            user = token_cache.get(token)
+            result = 'cached'
+            if user is None:
+                user = await returnUser(token)
+                result = 'database'
+                if user.is_authenticated:
+                    token_cache.set(token, user)
             scope["user"] = user
         else:
             scope["user"] = AnonymousUser()
+            result = 'anonymous'
+        metrics.auth_seconds.observe(time.perf_counter() - started, result)
         return await self.app(scope, receive, send)
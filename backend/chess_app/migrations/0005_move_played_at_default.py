@@ -0,0 +1,19 @@
+# Generated by Django 5.1.6 on 2026-10-18 11:07
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess_app', '0004_remove_game_player1_status_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='move',
+            name='played_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.6 on 2026-10-18 11:12
+
+from django.db import migrations, models
+
+
+def number_moves(apps, schema_editor):
+    Move = apps.get_model('chess_app', 'Move')
+    numbered = []
+    game_id, ply = None, 0
+    for move in Move.objects.order_by('game_id', 'played_at', 'id').only('id', 'game_id'):
+        if move.game_id != game_id:
+            game_id, ply = move.game_id, 0
+        ply += 1
+        move.ply = ply
+        numbered.append(move)
+        if len(numbered) >= 1000:
+            Move.objects.bulk_update(numbered, ['ply'])
+            numbered = []
+    Move.objects.bulk_update(numbered, ['ply'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess_app', '0006_game_over_type_timeout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='move',
+            name='ply',
+            field=models.PositiveIntegerField(default=0, help_text='sequence number of the move in its game, from 1'),
+        ),
+        migrations.RunPython(number_moves, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.1.6 on 2026-10-18 11:13
+
+import array
+import sys
+
+import chess
+from django.db import migrations, models
+
+
+def pack(typecode, values):
+    data = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data.tobytes()
+
+
+def pack_move_rows(apps, schema_editor):
+    """Copy the Move rows of every game into Game.moves_packed / Game.move_times"""
+    Game = apps.get_model('chess_app', 'Game')
+    Move = apps.get_model('chess_app', 'Move')
+    Clock = apps.get_model('chess_app', 'Clock')
+    started = dict(Clock.objects.values_list('game_id', 'started_at'))
+
+    def packed(game_id, rows):
+        codes, deltas = [], []
+        previous = started.get(game_id)
+        for uci, played_at in rows:
+            move = chess.Move.from_uci(uci)
+            codes.append(move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12))
+            delta = (played_at - previous).total_seconds() * 1000 if previous and played_at else 0
+            deltas.append(min(max(0, int(delta)), 2 ** 32 - 1))
+            previous = played_at or previous
+        return Game(room_id=game_id, moves_packed=pack('H', codes), move_times=pack('I', deltas))
+
+    games, game_id, rows = [], None, []
+    for row_game_id, uci, played_at in Move.objects.order_by('game_id', 'ply', 'played_at', 'id').values_list('game_id', 'move', 'played_at').iterator():
+        if row_game_id != game_id:
+            if rows:
+                games.append(packed(game_id, rows))
+            game_id, rows = row_game_id, []
+        rows.append((uci, played_at))
+        if len(games) >= 500:
+            Game.objects.bulk_update(games, ['moves_packed', 'move_times'])
+            games = []
+    if rows:
+        games.append(packed(game_id, rows))
+    Game.objects.bulk_update(games, ['moves_packed', 'move_times'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess_app', '0007_move_ply'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='move_times',
+            field=models.BinaryField(blank=True, default=b''),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='moves_packed',
+            field=models.BinaryField(blank=True, default=b''),
+        ),
+        migrations.RunPython(pack_move_rows, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.1.6 on 2026-10-18 11:15
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def backfill_timestamps(apps, schema_editor):
+    """Existing games were created when their clock started"""
+    Clock = apps.get_model('chess_app', 'Clock')
+    Game = apps.get_model('chess_app', 'Game')
+    games = []
+    for game_id, started_at in Clock.objects.values_list('game_id', 'started_at').iterator():
+        games.append(Game(room_id=game_id, created_at=started_at, updated_at=started_at))
+        if len(games) >= 500:
+            Game.objects.bulk_update(games, ['created_at', 'updated_at'])
+            games = []
+    Game.objects.bulk_update(games, ['created_at', 'updated_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess_app', '0008_game_packed_moves'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(backfill_timestamps, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.6 on 2026-10-18 11:17
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess_app', '0009_game_timestamps'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['-created_at', '-room_id'], name='game_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['status', '-created_at', '-room_id'], name='game_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['format', '-created_at', '-room_id'], name='game_format_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='move',
+            index=models.Index(fields=['game', 'ply'], name='move_game_ply_idx'),
+        ),
+    ]
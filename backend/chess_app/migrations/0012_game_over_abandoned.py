@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 11:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess_app', '0011_game_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='game',
+            name='over_type',
+            field=models.CharField(blank=True, choices=[('draw', 'Draw'), ('resign', 'Resign'), ('checkmate', 'Checkmate'), ('timeout', 'Timeout'), ('abandoned', 'Abandoned')], max_length=20, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 13:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess_app', '0012_game_over_abandoned'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='move',
+            name='move',
+            field=models.CharField(help_text='move in UCI', max_length=10),
+        ),
+    ]
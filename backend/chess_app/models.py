@@ -1,7 +1,39 @@
 from django.db import models
+from django.utils import timezone
+import array
 import datetime
+import sys
+import chess
 from django.contrib.auth.models import User
 
+MAX_MOVE_DELTA = 2 ** 32 - 1  # move_times entries are uint32 milliseconds
+
+
+def pack_values(typecode, values):
+    """Little-endian bytes of an array of ints"""
+    data = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data.tobytes()
+
+
+def unpack_values(typecode, raw):
+    data = array.array(typecode)
+    data.frombytes(bytes(raw or b''))
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data.tolist()
+
+
+def pack_move(move):
+    """16 bits: from square, to square (6 bits each) and promotion piece type (3 bits)"""
+    return move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+
+
+def unpack_move(code):
+    return chess.Move(code & 0x3f, (code >> 6) & 0x3f, (code >> 12) & 0x7 or None)
+
+
 class Game(models.Model):
     room_id = models.CharField(max_length=24, primary_key=True, blank=True)
 
@@ -24,16 +56,70 @@ class Game(models.Model):
 
     winner = models.CharField(max_length=64, choices=TURN_CHOICES, null=True, blank=True)
 
-    OVER_TYPES = [('draw', 'Draw'), ('resign', 'Resign'), ('checkmate', 'Checkmate')]
+    OVER_TYPES = [('draw', 'Draw'), ('resign', 'Resign'), ('checkmate', 'Checkmate'), ('timeout', 'Timeout'), ('abandoned', 'Abandoned')]
     over_type = models.CharField(max_length=20, null=True, blank=True, choices=OVER_TYPES)
     
     # time
     FORMAT_CHOICES = [('classic', 'Classic'), ('rapid', 'Rapid'), ('bliz', 'Bliz'), ('bullet', 'Bullet'), ('custom', 'Custom')]
     format = models.CharField(max_length=10, choices=FORMAT_CHOICES, default='rapid')
+
+    # move history, packed: 2 bytes per move (see pack_move) and a parallel array of
+    # 4 byte milliseconds since the previous move (the first one since the clock started)
+    moves_packed = models.BinaryField(default=b'', blank=True)
+    move_times = models.BinaryField(default=b'', blank=True)
+
+    # bumped by every update of the row, writers only update the version they loaded (see persistence.save_game)
+    version = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)  # list 'updated_at' in update_fields so saves bump it
     
+    class Meta:
+        # hot queries: the lobby (status='waiting') and GET /chess/ pages in (-created_at, -room_id)
+        # order, optionally filtered by status or format; by player uses the player1/player2 FK indexes
+        indexes = [
+            models.Index(fields=['-created_at', '-room_id'], name='game_created_idx'),
+            models.Index(fields=['status', '-created_at', '-room_id'], name='game_status_created_idx'),
+            models.Index(fields=['format', '-created_at', '-room_id'], name='game_format_created_idx'),
+        ]
+
     def __str__(self):
         return f"Game {self.room_id} between {self.player1} and {self.player2} of format {self.format}"
 
+    @property
+    def move_count(self):
+        return len(self.moves_packed or b'') // 2
+
+    @property
+    def moves(self):
+        """The moves played, in UCI, decoded on first access"""
+        raw = bytes(self.moves_packed or b'')
+        cached = self.__dict__.get('_moves_cache')
+        if cached is None or cached[0] != raw:
+            cached = (raw, [unpack_move(code).uci() for code in unpack_values('H', raw)])
+            self._moves_cache = cached
+        return cached[1]
+
+    @property
+    def move_deltas(self):
+        return unpack_values('I', self.move_times)
+
+    def played_times(self, started_at):
+        """played_at of each move, counted from started_at (None for all when it is unknown)"""
+        deltas = self.move_deltas
+        if started_at is None:
+            return [None] * len(deltas)
+        times, elapsed = [], 0
+        for delta in deltas:
+            elapsed += delta
+            times.append(started_at + datetime.timedelta(milliseconds=elapsed))
+        return times
+
+    def append_move(self, move, delta_ms):
+        """Add a chess.Move and the milliseconds since the previous one to the packed history"""
+        delta_ms = min(max(0, int(delta_ms)), MAX_MOVE_DELTA)
+        self.moves_packed = bytes(self.moves_packed or b'') + pack_values('H', [pack_move(move)])
+        self.move_times = bytes(self.move_times or b'') + pack_values('I', [delta_ms])
+
 class Clock(models.Model):
     DEFAULT_TOTAL_TIME = 15 * 60 * 1000  # 15 minutes in milliseconds
     DEFAULT_INCREMENTAL_TIME = 0  # 0 seconds
@@ -56,9 +142,15 @@ class Clock(models.Model):
         return f"Clock {self.total_time/(1000*60)}mins|+{self.incremental_time/1000}secs ({self.started_at}) game:"
     
 class Move(models.Model):
+    """One move per row: games played before Game.moves_packed (migration 0008) and the
+    fixtures of generate_games; live games only write the packed history"""
     game = models.ForeignKey(Game, on_delete=models.CASCADE, related_name='game_moves')
-    move = models.CharField(max_length=10, help_text="move in SAN")  # e.g., "e4", "Nf3"
-    played_at = models.DateTimeField(auto_now_add=True)
+    move = models.CharField(max_length=10, help_text="move in UCI")  # e.g., "e2e4", "g1f3"
+    ply = models.PositiveIntegerField(default=0, help_text="sequence number of the move in its game, from 1")
+    played_at = models.DateTimeField(default=timezone.now)  # set when played, rows may be inserted later in a batch
+
+    class Meta:
+        indexes = [models.Index(fields=['game', 'ply'], name='move_game_ply_idx')]
 
     def __str__(self):
         return f"Played move {self.move} in game {self.game.room_id}"
\ No newline at end of file
@@ -0,0 +1,246 @@
+# persistence.py
+import asyncio
+import atexit
+import logging
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from .models import Game, Clock
+from .presence import presence
+from .tasks import spawn
+
+logger = logging.getLogger(__name__)
+
+
+class StaleWrite(Exception):
+    """The row was changed by another writer since it was loaded"""
+
+
+class WriteBehind:
+    """Queues Game/Clock field updates and writes them in batches
+
+    Updates to the same row are merged. A flush happens when the queue reaches
+    max_batch rows, flush_interval seconds after the first queued write, when a
+    game ends and on shutdown.
+
+    Versioned rows (Game) are written with UPDATE ... WHERE version= the version
+    they had when first queued. A row another writer changed in the meantime is
+    not written, nor is the Clock of that game; on_stale is called with its pk.
+    """
+
+    def __init__(self, enabled=None, max_batch=None, flush_interval=None):
+        if enabled is None:
+            enabled = getattr(settings, 'CHESS_WRITE_BEHIND', False)
+        if max_batch is None:
+            max_batch = getattr(settings, 'CHESS_WRITE_BEHIND_BATCH', 200)
+        if flush_interval is None:
+            flush_interval = getattr(settings, 'CHESS_WRITE_BEHIND_INTERVAL', 0.5)
+        self.enabled = enabled
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.updates = {}  # (model, pk) -> (instance, fields, version expected in the row or None)
+        self.timer = None
+        self.tasks = set()  # flushes running
+        self.on_stale = None  # called with the pk of each stale row, live.py evicts the game
+        # metrics
+        self.flushes = 0
+        self.flush_failures = 0
+        self.rows_written = 0
+        self.stale_writes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    @property
+    def depth(self):
+        return len(self.updates)
+
+    def pending(self, room_id):
+        return (Game, room_id) in self.updates or (Clock, room_id) in self.updates
+
+    def queue_update(self, instance, fields, version=None):
+        """Queue fields of instance; with version, only write them while the row still has it"""
+        stamp_auto_now(instance, fields)  # bulk_update does not stamp auto_now fields
+        key = (type(instance), instance.pk)
+        queued = self.updates.get(key)
+        if queued is not None:
+            # the row must still be as it was before the first of the merged updates
+            fields, version = queued[1] | set(fields), queued[2]
+        self.updates[key] = (instance, set(fields), version)
+        self.schedule()
+
+    def schedule(self):
+        if self.depth >= self.max_batch:
+            self.cancel_timer()
+            spawn(self.flush(), self.tasks)
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.flush_interval, lambda: spawn(self.flush(), self.tasks))
+
+    def cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def take(self):
+        updates, self.updates = self.updates, {}
+        return list(updates.values())
+
+    def requeue(self, updates):
+        for instance, fields, version in updates:
+            key = (type(instance), instance.pk)
+            queued = self.updates.get(key)
+            if queued is not None:
+                # queued since the failed flush: the older expected version applies
+                fields = fields | queued[1]
+            self.updates[key] = (instance, fields, version)
+        if self.updates:
+            self.schedule()
+
+    def record(self, started, rows):
+        elapsed = (time.perf_counter() - started) * 1000
+        self.flushes += 1
+        self.rows_written += rows
+        self.last_flush_ms = elapsed
+        self.max_flush_ms = max(self.max_flush_ms, elapsed)
+        self.total_flush_ms += elapsed
+
+    async def flush(self):
+        # buffers are swapped synchronously and database_sync_to_async runs writes
+        # on one thread in submission order, so overlapping flushes stay ordered
+        self.cancel_timer()
+        updates = self.take()
+        if not updates:
+            return 0
+        started = time.perf_counter()
+        try:
+            stale = await database_sync_to_async(write)(updates)
+        except Exception:
+            logger.exception("write-behind flush of %d updates failed", len(updates))
+            self.flush_failures += 1
+            self.requeue(updates)
+            return 0
+        self.record(started, len(updates))
+        self.dropped(stale)
+        return len(updates)
+
+    def flush_sync(self):
+        """Flush from a context without a running event loop (process exit)"""
+        self.cancel_timer()
+        updates = self.take()
+        if not updates:
+            return 0
+        started = time.perf_counter()
+        stale = write(updates)
+        self.record(started, len(updates))
+        self.dropped(stale)
+        return len(updates)
+
+    def dropped(self, stale):
+        for pk in stale:
+            self.stale_writes += 1
+            logger.warning("write-behind update of game %s dropped, another writer changed it", pk)
+            if self.on_stale is not None:
+                self.on_stale(pk)
+
+    def stats(self):
+        return {
+            'queue_depth': self.depth,
+            'flushes': self.flushes,
+            'flush_failures': self.flush_failures,
+            'rows_written': self.rows_written,
+            'stale_writes': self.stale_writes,
+            'last_flush_ms': round(self.last_flush_ms, 3),
+            'max_flush_ms': round(self.max_flush_ms, 3),
+            'mean_flush_ms': round(self.total_flush_ms / self.flushes, 3) if self.flushes else 0.0,
+        }
+
+
+def write(updates):
+    """Write the updates in one transaction, returning the pks of versioned rows found stale
+
+    A game's Clock shares its pk and is dropped with it.
+    """
+    stale = set()
+    by_model = {}
+    with transaction.atomic():
+        for instance, fields, version in updates:
+            if version is None:
+                continue
+            # one conditional UPDATE per versioned row, bulk_update cannot check the version
+            attnames = {instance._meta.get_field(name).attname for name in fields} | {'version'}
+            updated = type(instance).objects.filter(pk=instance.pk, version=version).update(
+                **{attname: getattr(instance, attname) for attname in attnames}
+            )
+            if not updated:
+                stale.add(instance.pk)
+        for instance, fields, version in updates:
+            if version is not None or instance.pk in stale:
+                continue
+            instances, model_fields = by_model.setdefault(type(instance), ([], set()))
+            instances.append(instance)
+            model_fields |= fields
+        for model, (instances, fields) in by_model.items():
+            model.objects.bulk_update(instances, sorted(fields))
+    return stale
+
+
+writer = WriteBehind()
+
+
+def stamp_auto_now(instance, fields):
+    for field in instance._meta.concrete_fields:
+        if field.name in fields and getattr(field, 'auto_now', False):
+            field.pre_save(instance, False)
+
+
+async def save_game(game, fields):
+    """UPDATE the game's fields WHERE version is the one loaded, bumping it
+
+    Raises StaleWrite when another worker updated the row first; the caller then
+    reloads the game and retries its action. With write-behind the update is
+    queued instead and the version checked when it is flushed: an update another
+    worker got ahead of is dropped and the live game evicted (WriteBehind.on_stale).
+    """
+    if writer.enabled:
+        version = game.version
+        game.version += 1
+        writer.queue_update(game, fields, version)
+        return
+    if writer.pending(game.pk):
+        await writer.flush()
+    stamp_auto_now(game, fields)
+    attnames = [game._meta.get_field(name).attname for name in fields]
+    updated = await type(game).objects.filter(pk=game.pk, version=game.version).aupdate(
+        version=F('version') + 1, **{attname: getattr(game, attname) for attname in attnames}
+    )
+    if not updated:
+        raise StaleWrite(f'{type(game).__name__} {game.pk} changed since version {game.version}')
+    game.version += 1
+
+
+@atexit.register
+def flush_on_exit():
+    if writer.depth:
+        try:
+            writer.flush_sync()
+        except Exception:
+            logger.exception("write-behind flush at exit failed")
+
+
+async def lifespan(scope, receive, send):
+    """ASGI lifespan handler so servers that support it run the pending leaves and flush
+    pending writes on shutdown"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # the leaves queue writes of their own
+            await presence.flush()
+            await writer.flush()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
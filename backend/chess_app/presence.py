@@ -0,0 +1,98 @@
+# presence.py
+import asyncio
+import logging
+
+from django.conf import settings
+
+from .tasks import spawn
+
+logger = logging.getLogger(__name__)
+
+
+class Presence:
+    """The players' sockets on each game, in the process running the game's actions
+
+    A player may have several sockets (tabs) on a game, and leaves it only when the
+    last one closes. Even then leaving is put off for grace seconds and called off
+    if the player comes back in time. A dropped connection costs no write and no
+    pause then, as long as the player reconnects within the grace period.
+    """
+
+    def __init__(self, grace=None):
+        if grace is None:
+            grace = getattr(settings, 'CHESS_RECONNECT_GRACE', 10)
+        self.grace = grace
+        self.sockets = {}  # (room_id, user_id) -> channel names of the player's sockets
+        self.leaving = {}  # (room_id, user_id) -> (timer, on_leave) of the pending leave
+        self.tasks = set()  # leaves running
+        # metrics
+        self.resumed = 0
+        self.left = 0
+
+    def clear(self):
+        """Forget every socket and pending leave (tests and benchmarks, before a new event loop)"""
+        for timer, _ in self.leaving.values():
+            timer.cancel()
+        self.sockets, self.leaving, self.tasks = {}, {}, set()
+
+    def join(self, room_id, user_id, channel_name):
+        """Count a player's socket on the game, True if it calls off the player's pending leave"""
+        key = (room_id, user_id)
+        self.sockets.setdefault(key, set()).add(channel_name)
+        pending = self.leaving.pop(key, None)
+        if pending is None:
+            return False
+        pending[0].cancel()
+        self.resumed += 1
+        return True
+
+    def connected(self, room_id, user_id):
+        return len(self.sockets.get((room_id, user_id), ()))
+
+    async def leave(self, room_id, user_id, channel_name, on_leave):
+        """A socket closed: await on_leave() once the player has no socket left on the game
+        for grace seconds (right away without a grace period)
+        """
+        key = (room_id, user_id)
+        sockets = self.sockets.get(key)
+        if sockets is not None:
+            sockets.discard(channel_name)
+            if sockets:
+                # another tab is still open
+                return
+            del self.sockets[key]
+        if key in self.leaving:
+            return
+        if self.grace <= 0:
+            await self.expire(key, on_leave)
+            return
+        timer = asyncio.get_running_loop().call_later(self.grace, lambda: spawn(self.expire(key, on_leave), self.tasks))
+        self.leaving[key] = (timer, on_leave)
+
+    async def expire(self, key, on_leave):
+        self.leaving.pop(key, None)
+        self.left += 1
+        try:
+            await on_leave()
+        except Exception:
+            logger.exception("leaving game %s failed", key[0])
+
+    async def flush(self):
+        """Leave now every game whose player is still in the grace period (shutdown), so
+        no game keeps a player connected in the database that no socket is left for"""
+        pending, self.leaving = self.leaving, {}
+        for key, (timer, on_leave) in pending.items():
+            timer.cancel()
+            await self.expire(key, on_leave)
+
+    def stats(self):
+        return {
+            'players': len(self.sockets),
+            'sockets': sum(len(sockets) for sockets in self.sockets.values()),
+            'pending_leaves': len(self.leaving),
+            'resumed': self.resumed,
+            'left': self.left,
+        }
+
+
+presence = Presence()
@@ -0,0 +1,129 @@
+# profiling.py
+import cProfile
+import logging
+import os
+import pstats
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class NoProfile:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+NO_PROFILE = NoProfile()
+
+
+class Sample:
+    """cProfile running for one action"""
+
+    __slots__ = ('profiler', 'action', 'profile')
+
+    def __init__(self, profiler, action):
+        self.profiler = profiler
+        self.action = action
+        self.profile = cProfile.Profile()
+
+    def __enter__(self):
+        try:
+            self.profile.enable()
+        except ValueError:
+            # another profiler holds the thread (Python 3.12+), no sample then
+            self.profile = None
+            return self
+        self.profiler.active = True
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.profile is not None:
+            self.profile.disable()
+            self.profiler.record(self.action, self.profile)
+        return False
+
+
+class ActionProfiler:
+    """Opt-in cProfile of one action in every CHESS_PROFILE_EVERY[action] (CHESS_PROFILE_EVERY_DEFAULT)
+
+    The samples of an action are added up and written to
+    CHESS_PROFILE_DIR/<action>.<pid>.prof after each one, where
+    `manage.py profile_actions` merges the processes' files. The profile covers the
+    event loop while the action runs, other tasks included, but not the database
+    thread (queries show as the await of database_sync_to_async). One action is
+    profiled at a time. Disabled, an action costs one attribute check.
+    """
+
+    def __init__(self, enabled=None, every=None, default_every=None, directory=None):
+        if enabled is None:
+            enabled = getattr(settings, 'CHESS_PROFILE', False)
+        if every is None:
+            every = getattr(settings, 'CHESS_PROFILE_EVERY', {})
+        if default_every is None:
+            default_every = getattr(settings, 'CHESS_PROFILE_EVERY_DEFAULT', 100)
+        if directory is None:
+            directory = getattr(settings, 'CHESS_PROFILE_DIR', 'profiles')
+        self.enabled = enabled
+        self.every = every
+        self.default_every = default_every
+        self.directory = str(directory)
+        self.seen = {}  # action -> times it ran
+        self.profiles = {}  # action -> pstats.Stats of its samples
+        self.active = False
+        # metrics
+        self.samples = 0
+        self.skipped = 0
+        self.dump_failures = 0
+
+    def sample(self, action):
+        """Context manager profiling this run of action if it is due for a sample"""
+        if not self.enabled:
+            return NO_PROFILE
+        seen = self.seen[action] = self.seen.get(action, 0) + 1
+        if seen % self.every.get(action, self.default_every):
+            return NO_PROFILE
+        if self.active:
+            # another action is being profiled, a second profiler cannot run on this thread
+            self.skipped += 1
+            return NO_PROFILE
+        return Sample(self, action)
+
+    def record(self, action, profile):
+        self.active = False
+        self.samples += 1
+        stats = self.profiles.get(action)
+        if stats is None:
+            stats = self.profiles[action] = pstats.Stats(profile)
+        else:
+            stats.add(profile)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            stats.dump_stats(self.path(action))
+        except OSError:
+            self.dump_failures += 1
+            logger.exception("writing the %s profile failed", action)
+
+    def path(self, action):
+        return os.path.join(self.directory, f'{action}.{os.getpid()}.prof')
+
+    def clear(self):
+        self.seen.clear()
+        self.profiles.clear()
+        self.active = False
+
+    def stats(self):
+        return {
+            'enabled': int(self.enabled),
+            'samples': self.samples,
+            'skipped': self.skipped,
+            'dump_failures': self.dump_failures,
+        }
+
+
+profiler = ActionProfiler()
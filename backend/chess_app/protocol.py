@@ -0,0 +1,77 @@
+# protocol.py
+"""Wire formats of the game socket
+
+v1 (default): every frame is the JSON {"game": ..., "message": ...} object.
+v2: moves are sent as compact deltas, {"t": "moved", "g": game_id, "p": ply, "m": uci,
+"c": [clock1, clock2], "u": mover}, plus "s"/"w"/"o" (status, winner, over_type) only
+when the move ended the game; every other frame is the v1 object. Asked for with the
+websocket subprotocol chess.v2 (JSON text) or chess.v2.msgpack (MessagePack binary).
+
+A broadcast frame is encoded once per process for each wire format its sockets speak,
+by the first of them that sends it.
+"""
+import json
+import uuid
+from collections import OrderedDict
+
+import msgpack
+
+V1 = 'v1'
+V2 = 'v2'
+V2_MSGPACK = 'v2.msgpack'
+
+SUBPROTOCOLS = {'chess.v2.msgpack': V2_MSGPACK, 'chess.v2': V2}
+
+# the frames of the most recent events, the channel layer hands every socket its own copy of an event
+FRAME_CACHE_SIZE = 256
+encoded_frames = OrderedDict()  # (event id, wire) -> (text_data, bytes_data)
+
+
+def negotiate(scope):
+    """The (subprotocol to accept, wire format) for a connecting socket"""
+    offered = scope.get('subprotocols') or []
+    for subprotocol, wire in SUBPROTOCOLS.items():
+        if subprotocol in offered:
+            return subprotocol, wire
+    return None, V1
+
+
+def move_delta(game, live, mover):
+    delta = {
+        't': 'moved',
+        'g': game.room_id,
+        'p': live.ply,
+        'm': live.board.peek().uci(),
+        'c': [live.clock.clock1, live.clock.clock2] if live.clock is not None else None,
+        'u': mover,
+    }
+    if game.status == 'ended':
+        delta.update({'s': game.status, 'w': game.winner, 'o': game.over_type})
+    return delta
+
+
+def game_event(game, message, delta=None):
+    """A game.send event; v2 sockets get delta instead of the v1 frame when there is one"""
+    return {'type': 'game.send', 'id': uuid.uuid4().hex, 'game': game, 'message': message, 'delta': delta}
+
+
+def encode_frame(event, wire):
+    full = {'game': event['game'], 'message': event['message']}
+    v2 = event['delta'] if event['delta'] is not None else full
+    if wire == V2_MSGPACK:
+        # packb's default buffer is 256 KiB per call, frames are a few hundred bytes (it grows if needed)
+        return None, msgpack.packb(v2, buf_size=1024)
+    return json.dumps(v2 if wire == V2 else full), None
+
+
+def event_frame(event, wire):
+    """(text_data, bytes_data) of an event for a socket speaking wire, encoded on first use"""
+    if wire == V2 and event['delta'] is None:
+        wire = V1  # the same frame
+    key = (event['id'], wire)
+    frame = encoded_frames.get(key)
+    if frame is None:
+        frame = encoded_frames[key] = encode_frame(event, wire)
+        if len(encoded_frames) > FRAME_CACHE_SIZE:
+            encoded_frames.popitem(last=False)
+    return frame
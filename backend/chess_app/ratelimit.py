@@ -0,0 +1,111 @@
+# ratelimit.py
+import time
+
+from django.conf import settings
+
+
+class TokenBucket:
+    """rate tokens per second, holding at most burst"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost, now):
+        self.refill(now)
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def retry_after(self, cost):
+        """Seconds until cost tokens are available"""
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+    def full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class RateLimiter:
+    """Flood protection for game sockets: one bucket per socket and one per user across their sockets
+
+    An action costs CHESS_ACTION_COSTS[action] (CHESS_ACTION_COST_DEFAULT for any
+    other message) from both buckets; it is refused when either is short.
+    """
+
+    def __init__(self):
+        self.enabled = getattr(settings, 'CHESS_RATE_LIMIT', True)
+        self.socket_rate = getattr(settings, 'CHESS_SOCKET_RATE', 5)
+        self.socket_burst = getattr(settings, 'CHESS_SOCKET_BURST', 20)
+        self.user_rate = getattr(settings, 'CHESS_USER_RATE', 10)
+        self.user_burst = getattr(settings, 'CHESS_USER_BURST', 40)
+        self.costs = getattr(settings, 'CHESS_ACTION_COSTS', {'make_move': 1, 'create_game': 10})
+        self.default_cost = getattr(settings, 'CHESS_ACTION_COST_DEFAULT', 2)
+        self.max_message_bytes = getattr(settings, 'CHESS_MAX_MESSAGE_BYTES', 4096)
+        self.send_buffer = getattr(settings, 'CHESS_SEND_BUFFER', 256)
+        self.users = {}  # user id -> TokenBucket
+        self.last_prune = time.monotonic()
+        # metrics
+        self.allowed = 0
+        self.limited_socket = 0
+        self.limited_user = 0
+        self.oversized = 0
+        self.send_overflows = 0
+
+    def socket_bucket(self):
+        return TokenBucket(self.socket_rate, self.socket_burst)
+
+    def cost(self, action):
+        return self.costs.get(action, self.default_cost)
+
+    def check(self, bucket, user_id, action, now=None):
+        """0 if the action may run now, else the seconds to wait before it could"""
+        if not self.enabled:
+            return 0
+        now = time.monotonic() if now is None else now
+        cost = self.cost(action)
+        if not bucket.take(cost, now):
+            self.limited_socket += 1
+            return bucket.retry_after(cost)
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = TokenBucket(self.user_rate, self.user_burst, now)
+            self.maybe_prune(now)
+        if not user.take(cost, now):
+            # the socket is not charged for what did not run
+            bucket.tokens += cost
+            self.limited_user += 1
+            return user.retry_after(cost)
+        self.allowed += 1
+        return 0
+
+    def maybe_prune(self, now):
+        # a full bucket is the same as no bucket
+        if now - self.last_prune >= self.user_burst / self.user_rate:
+            self.last_prune = now
+            for user_id in [user_id for user_id, bucket in self.users.items() if bucket.full(now)]:
+                del self.users[user_id]
+
+    def clear(self):
+        self.users.clear()
+
+    def stats(self):
+        return {
+            'users': len(self.users),
+            'allowed': self.allowed,
+            'limited_socket': self.limited_socket,
+            'limited_user': self.limited_user,
+            'oversized': self.oversized,
+            'send_overflows': self.send_overflows,
+        }
+
+
+limiter = RateLimiter()
@@ -0,0 +1,137 @@
+# reaper.py
+import asyncio
+import logging
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .live import registry
+from .lobby import lobby
+from .models import Game
+from .persistence import writer
+
+logger = logging.getLogger(__name__)
+
+
+def stale_games(now, waiting_after, disconnected_after, active_after):
+    """Games not updated for long enough: waiting games never joined for waiting_after
+    seconds or left for disconnected_after seconds, and active games for active_after
+
+    The connected flags are not looked at, a process that stopped with players on its
+    games leaves them set.
+    """
+    return Game.objects.filter(
+        Q(status='waiting', player2__isnull=True, updated_at__lt=now - timedelta(seconds=waiting_after))
+        | Q(status='waiting', player2__isnull=False, updated_at__lt=now - timedelta(seconds=disconnected_after))
+        | Q(status='active', updated_at__lt=now - timedelta(seconds=active_after))
+    )
+
+
+def abandoned_kind(status, player2):
+    if status == 'active':
+        return 'active'
+    return 'waiting' if player2 is None else 'disconnected'
+
+
+def reap_games(now=None, waiting_after=None, disconnected_after=None, active_after=None, dry_run=False):
+    """End the stale games as abandoned with a single UPDATE
+
+    Returns the reaped games as dicts of room_id, format, base (ms, None without a
+    clock) and abandoned ('waiting', 'disconnected' or 'active').
+    """
+    now = now or timezone.now()
+    if waiting_after is None:
+        waiting_after = getattr(settings, 'CHESS_REAP_WAITING_AFTER', 10 * 60)
+    if disconnected_after is None:
+        disconnected_after = getattr(settings, 'CHESS_REAP_DISCONNECTED_AFTER', 30 * 60)
+    if active_after is None:
+        active_after = getattr(settings, 'CHESS_REAP_ACTIVE_AFTER', 6 * 60 * 60 + 30 * 60)
+    with transaction.atomic():
+        stale = stale_games(now, waiting_after, disconnected_after, active_after)
+        reaped = [
+            {
+                'room_id': room_id,
+                'format': format,
+                'base': base,
+                'abandoned': abandoned_kind(status, player2),
+            }
+            for room_id, format, base, status, player2 in stale.select_for_update().values_list(
+                'room_id', 'format', 'game_clock__total_time', 'status', 'player2'
+            )
+        ]
+        if reaped and not dry_run:
+            room_ids = [game['room_id'] for game in reaped]
+            # still stale when updated (a player may just have come back where rows are not locked);
+            # the version bump makes any live copy of these games fail its next save and reload
+            updated = stale.filter(room_id__in=room_ids).update(
+                status='ended', over_type='abandoned', winner=None,
+                version=F('version') + 1, updated_at=now
+            )
+            if updated != len(reaped):
+                ended = set(Game.objects.filter(
+                    room_id__in=room_ids, over_type='abandoned', updated_at=now
+                ).values_list('room_id', flat=True))
+                reaped = [game for game in reaped if game['room_id'] in ended]
+    return reaped
+
+
+async def reap(channel_layer=None, **options):
+    """Reap the stale games, forget their live state here and tell the lobby in one message"""
+    if writer.depth:
+        # a queued write may be a player coming back
+        await writer.flush()
+    reaped = await database_sync_to_async(reap_games)(**options)
+    if reaped and not options.get('dry_run'):
+        for game in reaped:
+            registry.evict(game['room_id'])
+        await lobby.publish_removed(channel_layer or get_channel_layer(), [
+            {'game_id': game['room_id'], 'format': game['format'], 'clock': {'base': game['base']}}
+            for game in reaped
+        ])
+    return reaped
+
+
+class Reaper:
+    """Optional in-process reaping every CHESS_REAP_INTERVAL seconds (0: only `manage.py reap_games`)"""
+
+    def __init__(self, interval=None):
+        if interval is None:
+            interval = getattr(settings, 'CHESS_REAP_INTERVAL', 0)
+        self.interval = interval
+        self.task = None
+        self.reaped = 0
+        self.runs = 0
+
+    def start(self):
+        """Start the periodic task on the running loop, if enabled and not running yet"""
+        if self.interval > 0 and (self.task is None or self.task.done()):
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                reaped = await reap()
+            except Exception:
+                logger.exception("reaping stale games failed")
+                continue
+            self.runs += 1
+            self.reaped += len(reaped)
+            if reaped:
+                logger.info("reaped %d stale games", len(reaped))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def stats(self):
+        return {'runs': self.runs, 'reaped': self.reaped}
+
+
+reaper = Reaper()
@@ -1,7 +1,14 @@
 from django.urls import re_path
 from . import consumers
+from .actions import shard_channels
 
 websocket_urlpatterns = [
     re_path(r'ws/chess/$', consumers.ChessRoomConsumer.as_asgi()),   # consumer for showing availabe room
     re_path(r"ws/chess/(?P<game_id>\w+)/$", consumers.ChessConsumer.as_asgi()),
-]
\ No newline at end of file
+    re_path(r"ws/chess/(?P<game_id>\w+)/watch/$", consumers.SpectatorConsumer.as_asgi()),
+]
+
+# game worker shards (CHESS_GAME_SHARDS), served by `python manage.py runworker <channel>...`
+channel_routes = {
+    channel: consumers.GameWorkerConsumer.as_asgi() for channel in shard_channels()
+}
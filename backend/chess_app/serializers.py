@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import Game, Move, Clock
+from .models import Game, Move, Clock, unpack_move, unpack_values
 
 class GameSerializer(serializers.ModelSerializer):
     player1 = serializers.SlugRelatedField(
@@ -10,10 +10,10 @@ class GameSerializer(serializers.ModelSerializer):
         read_only=True,
         slug_field="username"
     )
-    game_moves = serializers.SlugRelatedField(
-        many=True,
+    game_moves = serializers.ListField(
+        source='moves',
         read_only=True,
-        slug_field='move'
+        child=serializers.CharField()
     )
     game_clock = serializers.SlugRelatedField(
         read_only=True,
@@ -23,3 +23,32 @@ class GameSerializer(serializers.ModelSerializer):
     class Meta:
         model = Game
         fields = ['room_id', 'player1', 'player1_color', 'player2', 'player2_color', 'current_turn', 'fen', 'status', 'winner', 'over_type', 'format', 'game_moves', 'game_clock']
+
+
+# GameSerializer output built from one values() query, without model instances
+GAME_LIST_VALUES = [
+    'room_id', 'player1__username', 'player1_color', 'player2__username', 'player2_color', 'current_turn',
+    'fen', 'status', 'winner', 'over_type', 'format', 'moves_packed', 'game_clock__started_at',
+    'created_at', 'updated_at', 'version'
+]
+
+
+def game_list_data(rows):
+    return [
+        {
+            'room_id': row['room_id'],
+            'player1': row['player1__username'],
+            'player1_color': row['player1_color'],
+            'player2': row['player2__username'],
+            'player2_color': row['player2_color'],
+            'current_turn': row['current_turn'],
+            'fen': row['fen'],
+            'status': row['status'],
+            'winner': row['winner'],
+            'over_type': row['over_type'],
+            'format': row['format'],
+            'game_moves': [unpack_move(code).uci() for code in unpack_values('H', row['moves_packed'])],
+            'game_clock': row['game_clock__started_at'],
+        }
+        for row in rows
+    ]
@@ -0,0 +1,230 @@
+# spectators.py
+import asyncio
+import json
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import clock as clocks  # imports this module too, only used at call time
+from .live import registry
+from .metrics import metrics
+from .tasks import spawn
+
+
+def watch_group(game_id):
+    return f'watch_{game_id}'
+
+
+def connected_frame(frame):
+    """A relayed frame as a new spectator's first one: the same state, without the moves
+    of a previous frame it never saw"""
+    content = json.loads(frame)
+    content['game'].update({'from_ply': None, 'moves': None})
+    content['message']['info'] = 'connected'
+    return json.dumps(content)
+
+
+def watch_frame(live, from_ply=None, info='update'):
+    """What spectators see of a game: its whole current state, plus the moves after
+    from_ply when they are known (a spectator that missed frames still has the fen)"""
+    game = live.game
+    moves = live.moves_since(from_ply) if from_ply is not None and from_ply <= live.ply else None
+    return json.dumps({
+        'game': {
+            'game_id': game.room_id,
+            'fen': game.fen,
+            'ply': live.ply,
+            'from_ply': from_ply if moves is not None else None,
+            'moves': [move['move'] for move in moves] if moves is not None else None,
+            'player1': game.player1.username if game.player1 else None,
+            'player1_color': game.player1_color,
+            'player2': game.player2.username if game.player2 else None,
+            'player2_color': game.player2_color,
+            'current_turn': game.current_turn,
+            'status': game.status,
+            'winner': game.winner,
+            'over_type': game.over_type,
+            'clock': clocks.clock_payload(live),
+        },
+        'message': {
+            'type': 'watch',
+            'info': info
+        }
+    })
+
+
+class WatchHub:
+    """Spectator fan-out, kept off the players' path
+
+    Where a game is played, publish() only marks it changed; at most once per tick
+    one frame with the latest state (and the moves since the last frame) is sent to
+    the game's watch group. Each process is a single member of that group and hands
+    the frame to its own spectator sockets, yielding to the event loop every chunk
+    sockets. A socket keeps only the newest frame it has not sent yet.
+
+    A new spectator starts from the game's live state when it is played here, else
+    from the newest frame relayed to this process; only the first spectator of a game
+    the process has no frame of yet waits for load().
+    """
+
+    def __init__(self, tick=None, chunk=None):
+        if tick is None:
+            tick = getattr(settings, 'CHESS_WATCH_TICK', 0.25)
+        if chunk is None:
+            chunk = getattr(settings, 'CHESS_WATCH_CHUNK', 10)
+        self.tick = tick
+        self.chunk = chunk
+        # publishing side
+        self.changed = {}  # room_id -> live game to publish at the next tick
+        self.published = {}  # room_id -> ply of the last frame
+        self.timer = None
+        self.tasks = set()  # flushes running
+        # receiving side
+        self.watchers = {}  # room_id -> set of this process' spectator sockets
+        self.relays = {}  # room_id -> (task receiving the watch group for this process, future set once subscribed)
+        self.latest = {}  # room_id -> newest frame not handed to the sockets yet
+        self.fanning = {}  # room_id -> task handing frames to the sockets
+        self.actions = 0  # player actions running in this process, the fan-out lets them go first
+        self.frames = {}  # room_id -> (ply, frame, connected_frame or None) newest frame relayed here
+        self.loading = {}  # room_id -> task loading the first frame of a game
+        # metrics
+        self.frames_published = 0
+        self.frames_delivered = 0
+        self.frames_dropped = 0
+        self.fan_out_waits = 0
+
+    def clear(self):
+        """Forget the timer, relays and sockets (tests and benchmarks, before a new event loop)"""
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer, self.changed, self.watchers, self.tasks = None, {}, {}, set()
+        self.relays, self.latest, self.fanning, self.frames, self.loading = {}, {}, {}, {}, {}
+
+    def publish(self, live):
+        """Note that a game changed, spectators get it with the next tick"""
+        self.changed[live.game.room_id] = live
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.tick, lambda: spawn(self.flush(), self.tasks))
+
+    async def flush(self):
+        self.timer = None
+        changed, self.changed = self.changed, {}
+        channel_layer = metrics.timed_layer(get_channel_layer())
+        for room_id, live in changed.items():
+            frame = watch_frame(live, self.published.get(room_id))
+            if live.ended_at is None:
+                self.published[room_id] = live.ply
+            else:
+                self.published.pop(room_id, None)
+            await channel_layer.group_send(watch_group(room_id), {'type': 'watch.frame', 'frame': frame, 'ply': live.ply})
+            self.frames_published += 1
+
+    async def add(self, room_id, watcher):
+        """Hand the game's frames to watcher.offer(), from the next one published on"""
+        self.watchers.setdefault(room_id, set()).add(watcher)
+        if room_id not in self.relays:
+            loop = asyncio.get_running_loop()
+            subscribed = loop.create_future()
+            self.relays[room_id] = (loop.create_task(self.relay(room_id, subscribed)), subscribed)
+        await asyncio.shield(self.relays[room_id][1])
+
+    async def discard(self, room_id, watcher):
+        watchers = self.watchers.get(room_id)
+        if watchers is None:
+            return
+        watchers.discard(watcher)
+        if not watchers:
+            del self.watchers[room_id]
+            self.frames.pop(room_id, None)
+            relay, _ = self.relays.pop(room_id, (None, None))
+            if relay is not None:
+                relay.cancel()
+
+    async def relay(self, room_id, subscribed):
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        try:
+            await channel_layer.group_add(watch_group(room_id), channel)
+            subscribed.set_result(None)
+            while True:
+                message = await channel_layer.receive(channel)
+                known = self.frames.get(room_id)
+                if known is None or message['ply'] >= known[0]:
+                    self.frames[room_id] = (message['ply'], message['frame'], None)
+                if self.latest.get(room_id) is not None:
+                    # the sockets have not all had the previous frame yet, it is skipped
+                    self.frames_dropped += 1
+                self.latest[room_id] = message['frame']
+                if room_id not in self.fanning:
+                    self.fanning[room_id] = asyncio.get_running_loop().create_task(self.fan_out(room_id))
+        finally:
+            if not subscribed.done():
+                subscribed.cancel()
+            await channel_layer.group_discard(watch_group(room_id), channel)
+
+    async def snapshot(self, room_id, load):
+        """The first frame of a new spectator (None if the game does not exist); load(room_id)
+        returns that of a game neither played nor relayed here, as (ply, frame)"""
+        live = registry.games.get(room_id)
+        if live is not None:
+            return watch_frame(live, info='connected')
+        if room_id not in self.frames:
+            loading = self.loading.get(room_id)
+            if loading is None:
+                loading = self.loading[room_id] = asyncio.ensure_future(load(room_id))
+            try:
+                loaded = await asyncio.shield(loading)
+            finally:
+                if loading.done() and self.loading.get(room_id) is loading:
+                    del self.loading[room_id]
+            if loaded is None:
+                return None
+            if room_id not in self.watchers:
+                # every spectator left meanwhile, nothing keeps the frame up to date
+                return loaded[1]
+            known = self.frames.get(room_id)
+            if known is None or loaded[0] > known[0]:
+                # a frame relayed in the meantime is at least as new
+                self.frames[room_id] = (loaded[0], loaded[1], loaded[1])
+        ply, frame, connected = self.frames[room_id]
+        if connected is None:
+            # once per relayed frame, however many spectators connect meanwhile
+            connected = connected_frame(frame)
+            self.frames[room_id] = (ply, frame, connected)
+        return connected
+
+    async def fan_out(self, room_id):
+        try:
+            while self.latest.get(room_id) is not None:
+                frame = self.latest.pop(room_id)
+                deadline = time.monotonic() + self.tick
+                for index, watcher in enumerate(list(self.watchers.get(room_id, ()))):
+                    if watcher.offer(frame):
+                        self.frames_dropped += 1
+                    self.frames_delivered += 1
+                    if index % self.chunk == self.chunk - 1:
+                        await self.yield_to_players(deadline)
+        finally:
+            del self.fanning[room_id]
+
+    async def yield_to_players(self, deadline):
+        """These sockets send the frame now; the next ones wait while player actions run
+        here, until deadline at the latest (spectators are a tick behind at worst)"""
+        await asyncio.sleep(0)
+        while self.actions and time.monotonic() < deadline:
+            await asyncio.sleep(0.001)
+            self.fan_out_waits += 1
+
+    def stats(self):
+        return {
+            'watched_games': len(self.watchers),
+            'spectators': sum(len(watchers) for watchers in self.watchers.values()),
+            'frames_published': self.frames_published,
+            'frames_delivered': self.frames_delivered,
+            'frames_dropped': self.frames_dropped,
+            'fan_out_waits': self.fan_out_waits,
+        }
+
+
+watch = WatchHub()
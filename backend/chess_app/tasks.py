@@ -0,0 +1,14 @@
+# tasks.py
+import asyncio
+
+
+def spawn(coroutine, tasks):
+    """Run coroutine in a task held in the set tasks until it is done
+
+    The event loop only keeps weak references to its tasks, a pending task nothing
+    else refers to may be garbage collected before it runs.
+    """
+    task = asyncio.get_running_loop().create_task(coroutine)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
@@ -1,3 +1,2105 @@
-from django.test import TestCase
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import http_date
+from django.contrib.auth.models import User, update_last_login
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import F
+from rest_framework.authtoken.models import Token
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+import asyncio
+import io
+import importlib.util
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+from collections import deque
+from datetime import timedelta
+
+import chess
+from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from channels.routing import ChannelNameRouter
+from channels.testing import WebsocketCommunicator
+from channels.worker import Worker
+
+from . import clock as clocks
+from .actions import shard_channel, shard_channels
+from .apiviews import GamePagination, filter_games
+from .consumers import ChessConsumer, ChessRoomConsumer, GameWorkerConsumer, SpectatorConsumer, load_watch_frame
+from .layers import SQLiteChannelLayer
+from .live import LiveGame, load_game, registry
+from .lobby import BASE_BANDS, FORMATS, Lobby, LobbyFilter, lobby, waiting_games
+from .metrics import Histogram, metrics
+from .middlewares import TokenAuthMiddleWare, TokenCache, token_cache
+from .management.commands.bench_consumers import receive_frame, scripted_moves, with_user
+from .models import MAX_MOVE_DELTA, Game, Clock, Move, pack_move, pack_values, unpack_move, unpack_values
+from .persistence import StaleWrite, flush_on_exit, lifespan, save_game, writer
+from .presence import presence
+from .profiling import profiler
+from . import protocol
+from .protocol import V1, V2, V2_MSGPACK, encoded_frames, event_frame, game_event, negotiate
+from .ratelimit import TokenBucket, limiter
+from .reaper import reap, reap_games
+from .serializers import GAME_LIST_VALUES
+from .spectators import watch, watch_group
 
 # Create your tests here.
+
+
+def clear_live_state():
+    """Forget the games, timers and sockets the previous test left on its event loop"""
+    registry.clear()
+    clocks.scheduler.clear()
+    presence.clear()
+    watch.clear()
+
+
+class PlayersTestCase(TransactionTestCase):
+    """Base class for the tests of white and black playing with fresh live state"""
+
+    game_id = None  # the game socket() connects to by default
+
+    def setUp(self):
+        clear_live_state()
+        self.white = User.objects.create_user('white', password='x')
+        self.black = User.objects.create_user('black', password='x')
+
+    def tearDown(self):
+        clear_live_state()
+
+    def socket(self, user, game_id=None):
+        game_id = game_id or self.game_id
+        return WebsocketCommunicator(with_user(ChessConsumer.as_asgi(), user, game_id), f'/ws/chess/{game_id}/')
+
+
+class GetGamesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='x')
+        cls.bob = User.objects.create_user('bob', password='x')
+        cls.token = Token.objects.create(user=cls.alice)
+        for index in range(30):
+            game = Game(
+                room_id=f'game{index:02}',
+                player1=cls.alice if index % 2 else cls.bob,
+                player2=cls.bob if index % 2 else None,
+                status='active' if index % 2 else 'waiting',
+                format='bullet' if index % 3 == 0 else 'rapid',
+            )
+            for move in ['e2e4', 'e7e5', 'g1f3']:
+                game.append_move(chess.Move.from_uci(move), 1000)
+            game.save()
+            Clock.objects.create(game=game)
+
+    def get(self, path='/chess/', **headers):
+        return self.client.get(path, HTTP_AUTHORIZATION=f'Token {self.token.key}', **headers)
+
+    def test_query_budget(self):
+        # token lookup + one query for the page, whatever the page size
+        with self.assertNumQueries(2):
+            response = self.get('/chess/?limit=25')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 25)
+        with self.assertNumQueries(2):
+            self.get('/chess/?limit=5&status=active&formats=bullet&player=alice')
+
+    def test_pages_cover_every_game_once(self):
+        seen, path = [], '/chess/?limit=7'
+        while path:
+            page = self.get(path).json()
+            seen += [game['room_id'] for game in page['results']]
+            path = page['next']
+        self.assertEqual(sorted(seen), sorted(Game.objects.values_list('room_id', flat=True)))
+        self.assertEqual(len(seen), len(set(seen)))
+
+    def test_game_fields(self):
+        game = self.get('/chess/?limit=1').json()['results'][0]
+        self.assertEqual(game['room_id'], 'game29')
+        self.assertEqual(game['player1'], 'alice')
+        self.assertEqual(game['game_moves'], ['e2e4', 'e7e5', 'g1f3'])
+        self.assertIsNotNone(game['game_clock'])
+
+    def test_filters(self):
+        games = self.get('/chess/?limit=100&status=waiting&formats=bullet').json()['results']
+        self.assertTrue(games)
+        self.assertTrue(all(game['status'] == 'waiting' and game['format'] == 'bullet' for game in games))
+        games = self.get('/chess/?limit=100&player=alice').json()['results']
+        self.assertEqual(len(games), 15)
+        self.assertEqual(self.get('/chess/?status=paused').status_code, 400)
+
+    def test_not_modified(self):
+        response = self.get('/chess/?status=active')
+        etag = response['ETag']
+        self.assertEqual(self.get('/chess/?status=active', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # the newest updated_at of a page says nothing of games that left it
+        self.assertNotIn('Last-Modified', response)
+        self.assertEqual(self.get('/chess/?status=active', HTTP_IF_MODIFIED_SINCE=http_date()).status_code, 200)
+
+        game = Game.objects.get(room_id='game01')
+        game.status = 'ended'
+        game.save(update_fields=['status', 'updated_at'])
+        self.assertEqual(self.get('/chess/?status=active,ended', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        response = self.get('/chess/?status=active', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class GameRegistryTests(PlayersTestCase):
+    """Live games are loaded from the database once and kept until idle or ended for long enough"""
+
+    def setUp(self):
+        super().setUp()
+        # both players away, so no clock runs
+        game = Game(room_id='cached', player1=self.white, player2=self.black, status='waiting')
+        for move in ['e2e4', 'e7e5']:
+            game.append_move(chess.Move.from_uci(move), 1000)
+        game.fen = 'rnbqkbnr/pppp1ppp/8/4p3/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 2'
+        game.save()
+        Clock.objects.create(game=game)
+
+    def test_hit_and_miss(self):
+        async def run():
+            hits, misses = registry.hits, registry.misses
+            self.assertIsNone(await registry.get('nowhere'))
+            self.assertNotIn('nowhere', registry)
+            # concurrent misses share one load
+            first, second = await asyncio.gather(registry.get('cached'), registry.get('cached'))
+            self.assertIs(first, second)
+            self.assertEqual((first.ply, first.board.fen()), (2, first.game.fen))
+            self.assertEqual(first.game.player1.username, 'white')
+            self.assertIs(await registry.get('cached'), first)
+            self.assertEqual((registry.hits - hits, registry.misses - misses), (1, 3))
+
+        with CaptureQueriesContext(connection) as queries:
+            async_to_sync(run)()
+        # the unknown room and one load of the game
+        self.assertEqual(len(queries), 2)
+
+    def test_sweep(self):
+        async def run():
+            await registry.get('cached')
+            now = time.monotonic()
+            self.assertEqual(registry.sweep(now), 0)
+            self.assertEqual(registry.sweep(now + registry.idle_timeout), 1)
+            self.assertNotIn('cached', registry)
+
+            live = await registry.get('cached')
+            live.end()
+            self.assertEqual(registry.stats()['active'], 0)
+            self.assertEqual(registry.sweep(time.monotonic()), 0)
+            self.assertEqual(registry.sweep(time.monotonic() + registry.ended_timeout), 1)
+            self.assertEqual(len(registry), 0)
+
+        async_to_sync(run)()
+
+    def test_junk_move(self):
+        async def run():
+            sockets = [
+                WebsocketCommunicator(with_user(ChessConsumer.as_asgi(), user, 'junk'), '/ws/chess/junk/')
+                for user in (self.white, self.black)
+            ]
+            for socket in sockets:
+                await socket.connect()
+                await socket.receive_json_from()
+            await sockets[0].send_json_to({'action': 'create_game', 'base': 60000, 'increment': 0})
+            await sockets[0].receive_json_from()
+            await sockets[1].send_json_to({'action': 'join_game'})
+            for socket in sockets:
+                await socket.receive_json_from()
+            live = registry.games['junk']
+            misses = registry.misses
+            for move in ('zz', 5, None, ['e2e4'], 'e2e5'):
+                await sockets[0].send_json_to({'action': 'make_move', 'move': move})
+                self.assertEqual((await sockets[0].receive_json_from())['message']['error'], 'illegal move')
+            # the live game was not evicted, nor reloaded
+            self.assertIs(registry.games['junk'], live)
+            self.assertEqual((registry.misses, live.ply), (misses, 0))
+            for socket in sockets:
+                await socket.disconnect()
+
+        async_to_sync(run)()
+
+
+class WriteBehindTests(PlayersTestCase):
+    """Queued game and clock writes are merged, flushed in batches and at shutdown, and never
+    overwrite a version another writer saved in between"""
+
+    def setUp(self):
+        super().setUp()
+        self.saved = (writer.enabled, writer.flush_interval, writer.max_batch)
+        writer.enabled, writer.flush_interval, writer.max_batch = True, 60, 200
+        game = Game.objects.create(room_id='queued', player1=self.white, player2=self.black, status='active')
+        Clock.objects.create(game=game, clock1=60000, clock2=60000)
+
+    def tearDown(self):
+        writer.cancel_timer()
+        writer.take()
+        writer.enabled, writer.flush_interval, writer.max_batch = self.saved
+        super().tearDown()
+
+    async def play(self, live, moves):
+        for move in moves:
+            live.push(chess.Move.from_uci(move))
+            live.game.fen = live.board.fen()
+            live.clock.clock1 -= 1000
+            await save_game(live.game, ['fen', 'moves_packed', 'move_times', 'updated_at'])
+            await clocks.save_clock(live)
+
+    def test_coalesced_flush(self):
+        async def run():
+            live = await registry.get('queued')
+            await self.play(live, ['e2e4', 'e7e5', 'g1f3'])
+            self.assertEqual((writer.depth, writer.pending('queued')), (2, True))
+            self.assertEqual((await Game.objects.aget(room_id='queued')).version, 0)
+
+            rows = writer.rows_written
+            self.assertEqual(await writer.flush(), 2)
+            self.assertEqual(writer.rows_written - rows, 2)
+            self.assertFalse(writer.pending('queued'))
+
+        async_to_sync(run)()
+        game = Game.objects.get(room_id='queued')
+        self.assertEqual((game.moves, game.version), (['e2e4', 'e7e5', 'g1f3'], 3))
+        self.assertEqual(Clock.objects.get(game=game).clock1, 57000)
+
+    def test_flush_triggers(self):
+        async def run():
+            writer.flush_interval = 0.05
+            live = await registry.get('queued')
+            await self.play(live, ['e2e4'])
+            await asyncio.sleep(0.2)
+            self.assertEqual(writer.depth, 0)
+            self.assertEqual((await Game.objects.aget(room_id='queued')).moves, ['e2e4'])
+
+            writer.flush_interval, writer.max_batch = 60, 2
+            await self.play(live, ['e7e5'])
+            await asyncio.sleep(0.05)  # the game and its clock fill a batch
+            self.assertEqual(writer.depth, 0)
+            self.assertEqual((await Game.objects.aget(room_id='queued')).version, 2)
+
+        async_to_sync(run)()
+
+    def test_flush_at_shutdown(self):
+        async def run():
+            live = await registry.get('queued')
+            await self.play(live, ['e2e4'])
+            messages = iter([{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+            sent = []
+
+            async def receive():
+                return next(messages)
+
+            async def send(message):
+                sent.append(message['type'])
+
+            await lifespan({'type': 'lifespan'}, receive, send)
+            self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+            self.assertEqual(writer.depth, 0)
+            await self.play(live, ['e7e5'])
+
+        async_to_sync(run)()
+        self.assertEqual(Game.objects.get(room_id='queued').moves, ['e2e4'])
+        # what is left when the process exits
+        flush_on_exit()
+        self.assertEqual(writer.depth, 0)
+        self.assertEqual(Game.objects.get(room_id='queued').moves, ['e2e4', 'e7e5'])
+
+    def test_stale_write_dropped(self):
+        async def run():
+            live = await registry.get('queued')
+            await self.play(live, ['e2e4'])
+            # the reaper (or another shard) saves the game before the flush
+            await Game.objects.filter(room_id='queued').aupdate(status='ended', version=F('version') + 1)
+            stale_writes = writer.stale_writes
+            with self.assertLogs('chess_app.persistence', 'WARNING'):
+                await writer.flush()
+            self.assertEqual(writer.stale_writes - stale_writes, 1)
+            self.assertNotIn('queued', registry)
+            reloaded = await registry.get('queued')
+            self.assertEqual((reloaded.game.status, reloaded.ply, reloaded.clock.clock1), ('ended', 0, 60000))
+
+        async_to_sync(run)()
+        game = Game.objects.get(room_id='queued')
+        self.assertEqual((game.status, game.moves, game.version), ('ended', [], 1))
+
+
+class ClockTests(PlayersTestCase):
+    """Clocks run on the server: moves are charged with the increment added, the flag falls on
+    time, also for a game that left the registry in between"""
+
+    game_id = 'timed'
+
+    def test_scheduler_keeps_callbacks(self):
+        async def run():
+            release = asyncio.Event()
+            fired = []
+
+            async def callback(room_id):
+                await release.wait()
+                fired.append(room_id)
+
+            scheduler = clocks.FlagScheduler(callback)
+            scheduler.schedule('early', time.monotonic())
+            scheduler.schedule('late', time.monotonic() + 60)
+            await asyncio.sleep(0.05)
+            # the pending callback is held until it is done, not left to the garbage collector
+            self.assertEqual(len(scheduler.tasks), 1)
+            release.set()
+            await asyncio.sleep(0.01)
+            self.assertEqual((fired, scheduler.tasks, len(scheduler)), (['early'], set(), 1))
+            scheduler.clear()
+            self.assertEqual((len(scheduler), scheduler.timer), (0, None))
+
+        async_to_sync(run)()
+
+    async def start(self, base, increment=0):
+        white, black = self.socket(self.white), self.socket(self.black)
+        for socket in (white, black):
+            await socket.connect()
+            await socket.receive_json_from()
+        await white.send_json_to({'action': 'create_game', 'base': base, 'increment': increment})
+        await white.receive_json_from()
+        await black.send_json_to({'action': 'join_game'})
+        for socket in (white, black):
+            await socket.receive_json_from()
+        return white, black
+
+    async def move(self, mover, move, sockets):
+        await mover.send_json_to({'action': 'make_move', 'move': move})
+        return [await socket.receive_json_from() for socket in sockets][0]
+
+    def live_game(self, fen, current_turn):
+        game = Game(room_id='unit', player1=self.white, player2=self.black, status='active', current_turn=current_turn)
+        return LiveGame(game, Clock(game=game, clock1=1000, clock2=1000, incremental_time=500), chess.Board(fen))
+
+    def test_increment(self):
+        async def run():
+            white, black = await self.start(60000, 2000)
+            # white's clock starts after the first move
+            moved = await self.move(white, 'e2e4', (white, black))
+            self.assertEqual((moved['game']['clock']['clock1'], moved['game']['clock']['clock2']), (62000, 60000))
+            await asyncio.sleep(0.2)
+            moved = await self.move(black, 'e7e5', (white, black))
+            self.assertGreater(moved['game']['clock']['clock2'], 61000)
+            self.assertLessEqual(moved['game']['clock']['clock2'], 61800)
+            for socket in (white, black):
+                await socket.disconnect()
+
+        async_to_sync(run)()
+        self.assertLessEqual(Clock.objects.get(game_id='timed').clock2, 61800)
+
+    def test_flag_fall(self):
+        async def run():
+            white, black = await self.start(300)
+            await self.move(white, 'e2e4', (white, black))
+            timeout = await black.receive_json_from(timeout=2)
+            self.assertEqual(timeout['message']['info'], 'timeout')
+            self.assertEqual((timeout['game']['winner'], timeout['game']['clock']['clock2']), ('player1', 0))
+            await white.receive_json_from()
+            for socket in (white, black):
+                await socket.disconnect()
+
+        async_to_sync(run)()
+        game = Game.objects.get(room_id='timed')
+        self.assertEqual((game.status, game.over_type, game.winner), ('ended', 'timeout', 'player1'))
+
+    def test_flag_fall_after_eviction(self):
+        async def run():
+            white, black = await self.start(500)
+            await self.move(white, 'e2e4', (white, black))
+            # a failed save (or a stale write) drops the live game
+            registry.evict('timed')
+            timeout = await black.receive_json_from(timeout=2)
+            self.assertEqual((timeout['message']['info'], timeout['game']['winner']), ('timeout', 'player1'))
+            await white.receive_json_from()
+            for socket in (white, black):
+                await socket.disconnect()
+
+        async_to_sync(run)()
+        self.assertEqual(Game.objects.get(room_id='timed').over_type, 'timeout')
+
+    def test_restored_turn_is_charged(self):
+        async def run():
+            white, black = await self.start(60000)
+            await self.move(white, 'e2e4', (white, black))
+            registry.evict('timed')
+            await asyncio.sleep(0.3)
+            moved = await self.move(black, 'e7e5', (white, black))
+            self.assertLessEqual(moved['game']['clock']['clock2'], 59700)
+            self.assertGreater(moved['game']['clock']['clock2'], 58000)
+            # a game with a running clock is not swept as idle
+            live = registry.games['timed']
+            self.assertIsNotNone(live.turn_started)
+            self.assertEqual(registry.sweep(time.monotonic() + registry.idle_timeout), 0)
+            for socket in (white, black):
+                await socket.disconnect()
+
+        async_to_sync(run)()
+
+    def test_charge_and_pause(self):
+        async def run():
+            live = self.live_game(chess.STARTING_FEN, 'player1')
+            clocks.start_turn(live, now=100.0)
+            self.assertEqual(clocks.remaining(live, now=100.4), 600)
+            self.assertTrue(clocks.charge_move(live, now=100.4))
+            self.assertEqual((live.clock.clock1, live.turn_started), (1100, None))
+
+            live.game.current_turn = 'player2'
+            clocks.start_turn(live, now=200.0)
+            clocks.pause(live, now=200.25)
+            self.assertEqual((live.clock.clock2, live.turn_started), (750, None))
+            clocks.start_turn(live, now=300.0)
+            # flagged before moving: no increment
+            self.assertFalse(clocks.charge_move(live, now=301.0))
+            self.assertEqual(live.clock.clock2, 0)
+            self.assertEqual(len(clocks.scheduler), 0)
+
+        async_to_sync(run)()
+
+    def test_timeout_against_bare_king_is_a_draw(self):
+        # white flags, black has only its king left
+        live = self.live_game('4k3/8/8/8/8/8/8/4K2Q w - - 0 1', 'player1')
+        clocks.timeout(live)
+        self.assertEqual((live.game.status, live.game.over_type, live.game.winner), ('ended', 'timeout', None))
+        self.assertEqual(live.clock.clock1, 0)
+        # black flags and white can still mate
+        live = self.live_game('4k3/8/8/8/8/8/8/4K2Q b - - 0 1', 'player2')
+        clocks.timeout(live)
+        self.assertEqual((live.game.winner, live.clock.clock2), ('player1', 0))
+        self.assertIsNotNone(live.ended_at)
+
+    def test_invalid_clock_settings(self):
+        async def run():
+            socket = self.socket(self.white)
+            await socket.connect()
+            await socket.receive_json_from()
+            for base, increment in (('abc', 0), (60000, -1), (0, 0), (True, 0), (10 ** 12, 0), (60000, [1])):
+                await socket.send_json_to({'action': 'create_game', 'base': base, 'increment': increment})
+                reply = await socket.receive_json_from()
+                self.assertEqual(reply['message']['info'], 'invalid', (base, increment))
+                self.assertIn('base must be', reply['message']['error'])
+            # whole milliseconds given as a string are read as a number
+            await socket.send_json_to({'action': 'create_game', 'base': '60000', 'increment': '1000'})
+            self.assertEqual((await socket.receive_json_from())['game']['clock'], {'base': 60000, 'increment': 1000})
+            await socket.disconnect()
+
+        # a create_game costs a socket half its burst
+        enabled, limiter.enabled = limiter.enabled, False
+        try:
+            async_to_sync(run)()
+        finally:
+            limiter.enabled = enabled
+        self.assertEqual(Game.objects.count(), 1)
+
+
+class RepetitionTests(PlayersTestCase):
+    """Repetitions counted by Zobrist key agree with python-chess; fivefold ends the game,
+    threefold is claimed"""
+
+    SHUFFLE = ['g1f3', 'g8f6', 'f3g1', 'f6g8']
+
+    def assertSameAsBoard(self, live):
+        board = live.board
+        for count in (2, 3, 4, 5):
+            self.assertEqual(live.repetitions[live.key] >= count, board.is_repetition(count), board.move_stack)
+        self.assertEqual(live.can_claim_threefold(), board.can_claim_threefold_repetition(), board.move_stack)
+        self.assertEqual(live.can_claim_draw(), board.can_claim_draw(), board.move_stack)
+
+    def test_counter_matches_board(self):
+        # repetitions on both sides of pawn moves and captures, which start the count over
+        line = (
+            self.SHUFFLE * 2 + ['e2e4', 'd7d5'] + self.SHUFFLE + ['g1f3'] + ['e4d5']
+            + ['g8f6', 'f3g1', 'f6g8', 'g1f3'] * 3 + ['d8d5', 'b1c3', 'd5d8', 'c3b1', 'd8d5']
+        )
+        live = LiveGame(Game(room_id='unit'), None)
+        for move in line:
+            live.play(chess.Move.from_uci(move), None)
+            self.assertSameAsBoard(live)
+        for seed in range(5):
+            live = LiveGame(Game(room_id='unit'), None)
+            for move in scripted_moves(80, seed=seed):
+                live.play(chess.Move.from_uci(move), None)
+                self.assertSameAsBoard(live)
+
+    def test_fivefold_ends_the_game(self):
+        live = LiveGame(Game(room_id='unit'), None)
+        for ply, move in enumerate(self.SHUFFLE * 4, start=1):
+            live.play(chess.Move.from_uci(move), None)
+            if ply < 16:
+                self.assertIsNone(live.outcome(), ply)
+        self.assertEqual(live.outcome().termination, chess.Termination.FIVEFOLD_REPETITION)
+
+    def test_claim_threefold(self):
+        async def run():
+            white = WebsocketCommunicator(with_user(ChessConsumer.as_asgi(), self.white, 'again'), '/ws/chess/again/')
+            black = WebsocketCommunicator(with_user(ChessConsumer.as_asgi(), self.black, 'again'), '/ws/chess/again/')
+            for socket in (white, black):
+                await socket.connect()
+                await socket.receive_json_from()
+            await white.send_json_to({'action': 'create_game', 'base': 60000, 'increment': 0})
+            await white.receive_json_from()
+            await black.send_json_to({'action': 'join_game'})
+            for socket in (white, black):
+                await socket.receive_json_from()
+
+            await white.send_json_to({'action': 'claim_draw'})
+            self.assertEqual((await white.receive_json_from())['message']['error'], 'no draw to claim')
+            for ply, move in enumerate(self.SHUFFLE * 2, start=1):
+                mover = (white, black)[(ply - 1) % 2]
+                await mover.send_json_to({'action': 'make_move', 'move': move})
+                for socket in (white, black):
+                    moved = await socket.receive_json_from()
+                # the start position a third time does not end the game by itself
+                self.assertEqual(moved['game']['status'], 'active')
+                if ply == 7:
+                    await white.send_json_to({'action': 'claim_draw'})
+                    self.assertEqual((await white.receive_json_from())['message']['error'], 'not your turn')
+
+            await white.send_json_to({'action': 'claim_draw'})
+            for socket in (white, black):
+                claimed = await socket.receive_json_from()
+                self.assertEqual(claimed['message']['info'], 'draw_claimed')
+                self.assertEqual((claimed['game']['status'], claimed['game']['over_type']), ('ended', 'draw'))
+            for socket in (white, black):
+                await socket.disconnect()
+
+        async_to_sync(run)()
+        game = Game.objects.get(room_id='again')
+        self.assertEqual((game.status, game.over_type, game.winner, game.move_count), ('ended', 'draw', None, 8))
+
+
+def lobby_event(game_id, info='available', format='bullet', base=60000):
+    """A game.update event as GameActions publishes it"""
+    game = {'game_id': game_id}
+    if info == 'available':
+        game.update({
+            'format': format, 'clock': {'base': base, 'increment': 0, 'started': '2026-01-01T00:00:00+00:00'},
+            'player1': 'white', 'player1_color': 'white', 'player2_color': 'black',
+        })
+    return {'type': 'game.update', 'game': game, 'message': {'type': 'all', 'info': info, 'player': {}}}
+
+
+class LobbyTests(PlayersTestCase):
+    """The lobby snapshot, its versioned deltas, and keeping every process' copy in step"""
+
+    game_id = 'listed'
+
+    def setUp(self):
+        super().setUp()
+        lobby.games.clear()
+        lobby.loaded_at = None
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        super().tearDown()
+        lobby.games.clear()
+        lobby.loaded_at = None
+        self.dir.cleanup()
+
+    def test_snapshot_and_deltas(self):
+        snapshot = Lobby(history=3, refresh_interval=60)
+        for game_id in ('a', 'b'):
+            snapshot.apply(lobby_event(game_id))
+        self.assertEqual(snapshot.apply(lobby_event('a')), 2)  # nothing new
+        self.assertEqual(snapshot.apply(lobby_event('c', format='classic', base=1800000)), 3)
+        self.assertEqual(snapshot.apply(lobby_event('a', 'unavailable')), 4)
+        version, games = snapshot.snapshot()
+        self.assertEqual((version, sorted(entry['game_id'] for entry in games)), (4, ['b', 'c']))
+
+        self.assertEqual(snapshot.changes_since(4), [])
+        self.assertEqual([(change['version'], change['game_id']) for change in snapshot.changes_since(2)], [(3, 'c'), (4, 'a')])
+        self.assertEqual(len(snapshot.changes_since(1)), 3)
+        self.assertIsNone(snapshot.changes_since(0))  # the first change left the log
+        self.assertIsNone(snapshot.changes_since(5))
+        # a filtered client is only told about matching games, but of every removal
+        bullet = LobbyFilter(['bullet'])
+        self.assertEqual([change['game_id'] for change in snapshot.changes_since(2, bullet)], ['a'])
+        self.assertEqual([entry['game_id'] for entry in snapshot.snapshot(bullet)[1]], ['b'])
+        self.assertEqual(snapshot.apply({'type': 'games.removed', 'game_ids': ['b', 'x'], 'message': {}}), 5)
+
+    def test_sync(self):
+        async def run():
+            socket = WebsocketCommunicator(with_user(ChessRoomConsumer.as_asgi(), self.white, None), '/ws/chess/')
+            await socket.connect()
+            connected = await socket.receive_json_from()
+            self.assertEqual(connected['games'], [])
+            first = connected['version']
+
+            await lobby.publish(get_channel_layer(), lobby_event('g1'))
+            announced = await socket.receive_json_from()
+            self.assertEqual((announced['game']['game_id'], announced['version']), ('g1', first + 1))
+
+            await socket.send_json_to({'action': 'sync', 'version': first})
+            synced = await socket.receive_json_from()
+            self.assertEqual((synced['message']['info'], synced['version']), ('changes', first + 1))
+            self.assertEqual([change['game_id'] for change in synced['changes']], ['g1'])
+            # not a version this socket was sent: from another process, or from the future
+            for version in (first - 1, first + 10, 'x'):
+                await socket.send_json_to({'action': 'sync', 'version': version})
+                synced = await socket.receive_json_from()
+                self.assertEqual(synced['message']['info'], 'snapshot', version)
+                self.assertEqual([game['game_id'] for game in synced['games']], ['g1'])
+            # not requests: ignored, the socket stays usable
+            for frame in ('[]', '5', 'null', '{', '"sync"'):
+                await socket.send_to(text_data=frame)
+            await socket.send_to(bytes_data=b'\xff\x00')
+            await socket.send_to(bytes_data=json.dumps({'action': 'sync', 'version': first + 1}).encode())
+            self.assertEqual((await socket.receive_json_from())['changes'], [])
+            await socket.disconnect()
+
+        async_to_sync(run)()
+
+    def test_status_changes_published(self):
+        async def run():
+            grace, presence.grace = presence.grace, 0
+            socket = WebsocketCommunicator(with_user(ChessRoomConsumer.as_asgi(), self.white, None), '/ws/chess/')
+            await socket.connect()
+            await socket.receive_json_from()
+
+            async def heard():
+                update = await socket.receive_json_from()
+                self.assertEqual(update['game']['game_id'], 'listed')
+                return update['message']['info'], update['game'].get('player2')
+
+            try:
+                white, second = self.socket(self.white), self.socket(self.black)
+                for each in (white, second):
+                    await each.connect()
+                    await each.receive_json_from()
+                await white.send_json_to({'action': 'create_game', 'base': 60000, 'increment': 0})
+                self.assertEqual(await heard(), ('available', None))
+                await second.send_json_to({'action': 'join_game'})
+                self.assertEqual(await heard(), ('unavailable', 'black'))
+                # black drops: listed again, until back
+                await second.disconnect()
+                self.assertEqual(await heard(), ('available', 'black'))
+                second = self.socket(self.black)
+                await second.connect()
+                await second.receive_json_from()
+                await second.send_json_to({'action': 'join_game'})
+                self.assertEqual(await heard(), ('unavailable', 'black'))
+                await second.disconnect()
+                self.assertEqual(await heard(), ('available', 'black'))
+                await white.send_json_to({'action': 'resign_game'})
+                self.assertEqual(await heard(), ('unavailable', 'black'))
+                await white.disconnect()
+                self.assertTrue(await socket.receive_nothing())
+                # this process' snapshot followed the published events
+                self.assertNotIn('listed', lobby.games)
+            finally:
+                presence.grace = grace
+                await socket.disconnect()
+
+        async_to_sync(run)()
+
+    def test_events_of_other_processes(self):
+        path = os.path.join(self.dir.name, 'channels.sqlite3')
+
+        async def run():
+            # two layers on one file and two snapshots stand in for two processes
+            first, second = [SQLiteChannelLayer(path, poll_interval=0.005) for _ in range(2)]
+            here, there = Lobby(refresh_interval=60), Lobby(refresh_interval=60)
+            await there.listen(second)
+            there.version = 100  # numbered independently
+
+            async def applied(count):
+                for _ in range(200):
+                    if there.events_applied >= count:
+                        return
+                    await asyncio.sleep(0.01)
+                self.fail(f'{count} events not applied')
+
+            await here.publish(first, lobby_event('g1'))
+            await here.publish(first, lobby_event('g2', format='rapid', base=600000))
+            await applied(2)
+            self.assertEqual(sorted(there.games), ['g1', 'g2'])
+            self.assertEqual([change['game_id'] for change in there.changes_since(100)], ['g1', 'g2'])
+            await here.publish(first, lobby_event('g1', 'unavailable'))
+            await here.publish_removed(first, [{'game_id': 'g2', 'format': 'rapid', 'clock': {'base': 600000}}])
+            await applied(4)
+            self.assertEqual((there.games, there.version), ({}, 104))
+            self.assertEqual((here.games, here.version), ({}, 4))
+            there.listener.cancel()
+            for layer in (first, second):
+                await layer.close()
+
+        async_to_sync(run)()
+
+
+class LobbySubscriptionTests(TransactionTestCase):
+    """Filtered lobby sockets only join the bucket groups their filter can match"""
+
+    def setUp(self):
+        lobby.games.clear()
+        lobby.loaded_at = None
+        self.white = User.objects.create_user('white', password='x')
+
+    def tearDown(self):
+        lobby.games.clear()
+        lobby.loaded_at = None
+
+    def test_filter(self):
+        with self.assertRaises(ValueError):
+            LobbyFilter.from_request({'formats': ['blitz']})
+        with self.assertRaises(ValueError):
+            LobbyFilter.from_request({'base': [600000, 60000]})
+        quick = LobbyFilter.from_request({'formats': ['bullet', 'bliz'], 'base': [0, 180000], 'increment': [0, 0]})
+        self.assertEqual(quick.groups(), [
+            'available_games.bliz.0', 'available_games.bliz.1', 'available_games.bullet.0', 'available_games.bullet.1'
+        ])
+        self.assertTrue(quick.matches(lobby_event('a')['game'] | {'clock': {'base': 60000, 'increment': 0}}))
+        self.assertFalse(quick.matches({'format': 'bullet', 'clock': {'base': 60000, 'increment': 1000}}))
+        self.assertFalse(quick.matches({'format': 'rapid', 'clock': {'base': 60000, 'increment': 0}}))
+        self.assertEqual(len(LobbyFilter().groups()), len(FORMATS) * (len(BASE_BANDS) + 1))
+
+    def test_subscribe(self):
+        async def run():
+            layer = get_channel_layer()
+            socket = WebsocketCommunicator(with_user(ChessRoomConsumer.as_asgi(), self.white, None), '/ws/chess/')
+            await socket.connect()
+            await socket.receive_json_from()
+            await lobby.publish(layer, lobby_event('slow', format='classic', base=1800000))
+            await socket.receive_json_from()
+
+            await socket.send_json_to({'action': 'subscribe', 'formats': 'bullet'})
+            self.assertEqual((await socket.receive_json_from())['message']['info'], 'invalid')
+            await socket.send_json_to({'action': 'subscribe', 'formats': ['bullet'], 'base': [0, 120000]})
+            subscribed = await socket.receive_json_from()
+            self.assertEqual((subscribed['message']['info'], subscribed['games']), ('subscribed', []))
+
+            await lobby.publish(layer, lobby_event('fast', base=60000))
+            await lobby.publish(layer, lobby_event('other', format='rapid', base=600000))
+            # same bucket, past the base asked for
+            await lobby.publish(layer, lobby_event('longer', base=150000))
+            self.assertEqual((await socket.receive_json_from())['game']['game_id'], 'fast')
+            self.assertTrue(await socket.receive_nothing(0.1))
+            await lobby.publish(layer, lobby_event('fast', 'unavailable'))
+            self.assertEqual((await socket.receive_json_from())['message']['info'], 'unavailable')
+
+            await socket.send_json_to({'action': 'unsubscribe'})
+            unsubscribed = await socket.receive_json_from()
+            self.assertEqual(sorted(game['game_id'] for game in unsubscribed['games']), ['longer', 'other', 'slow'])
+            await lobby.publish(layer, lobby_event('any', format='rapid', base=600000))
+            self.assertEqual((await socket.receive_json_from())['game']['game_id'], 'any')
+            await socket.disconnect()
+
+        async_to_sync(run)()
+
+
+class TokenCacheTests(TransactionTestCase):
+    """Websocket tokens are looked up once per ttl and forgotten on logout or a change of their user"""
+
+    def setUp(self):
+        token_cache.clear()
+        self.user = User.objects.create_user('white', password='x')
+        self.token = Token.objects.create(user=self.user)
+
+    def tearDown(self):
+        token_cache.clear()
+
+    def authenticate(self, key):
+        async def app(scope, receive, send):
+            return scope['user']
+
+        return async_to_sync(TokenAuthMiddleWare(app))({'query_string': f'token={key}'.encode()}, None, None)
+
+    def test_hit(self):
+        hits, misses = token_cache.hits, token_cache.misses
+        self.assertEqual(self.authenticate(self.token.key), self.user)
+        self.assertEqual(self.authenticate(self.token.key), self.user)
+        self.assertEqual((token_cache.hits - hits, token_cache.misses - misses), (1, 1))
+        self.assertFalse(self.authenticate('nosuchtoken').is_authenticated)
+        # unknown tokens are not cached
+        self.assertEqual(len(token_cache), 1)
+
+    def test_expiry_and_size(self):
+        cache = TokenCache(maxsize=2, ttl=0.05)
+        cache.set('a', self.user)
+        self.assertEqual(cache.get('a'), self.user)
+        time.sleep(0.06)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual((len(cache), cache.keys_by_user), (0, {}))
+        for key in ('b', 'c'):
+            cache.set(key, self.user)
+        cache.get('b')
+        cache.set('d', self.user)  # the least recently used goes
+        self.assertEqual(list(cache.entries), ['b', 'd'])
+        self.assertEqual(cache.keys_by_user, {self.user.pk: {'b', 'd'}})
+
+    def test_logout(self):
+        self.authenticate(self.token.key)
+        self.token.delete()
+        self.assertIsNone(token_cache.get(self.token.key))
+        self.assertFalse(self.authenticate(self.token.key).is_authenticated)
+
+    def test_user_changes(self):
+        other = User.objects.create_user('black', password='x')
+        self.authenticate(self.token.key)
+        self.authenticate(Token.objects.create(user=other).key)
+        # logging in only stamps last_login
+        update_last_login(None, self.user)
+        self.assertEqual(len(token_cache), 2)
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(token_cache.get(self.token.key))
+        self.assertEqual(list(token_cache.keys_by_user), [other.pk])
+
+    def test_invalidated_from_another_thread(self):
+        cache, errors = TokenCache(maxsize=500, ttl=60), []
+        users = [User(pk=pk, username=f'user{pk}') for pk in range(50)]
+
+        def invalidate():
+            try:
+                for index in range(20000):
+                    cache.invalidate_user(index % 50)
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=invalidate)
+        thread.start()
+        for index in range(20000):
+            cache.set(f'key{index % 700}', users[index % 50])
+            cache.get(f'key{(index * 7) % 700}')
+        thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(sum(len(keys) for keys in cache.keys_by_user.values()), len(cache))
+
+
+class ResyncTests(PlayersTestCase):
+    """A reconnecting player gets the moves after the last ply it saw, or the fen when that is
+    too far back or unknown"""
+
+    game_id = 'resync'
+
+    def setUp(self):
+        super().setUp()
+        self.grace, presence.grace = presence.grace, 60
+
+    def tearDown(self):
+        presence.grace = self.grace
+        super().tearDown()
+
+    async def rejoin(self, last_ply):
+        socket = self.socket(self.black)
+        await socket.connect()
+        await socket.receive_json_from()
+        await socket.send_json_to({'action': 'join_game', 'last_ply': last_ply})
+        frames = {}
+        for _ in range(2):
+            frame = await socket.receive_json_from()
+            frames[frame['message']['info']] = frame['game']
+        await socket.disconnect()
+        return frames['resync']
+
+    def test_moves_since(self):
+        live = LiveGame(Game(room_id='unit'), None)
+        for move in ('e2e4', 'e7e5', 'g1f3'):
+            live.play(chess.Move.from_uci(move), None)
+        self.assertEqual([(move['ply'], move['move']) for move in live.moves_since(1)], [(2, 'e7e5'), (3, 'g1f3')])
+        self.assertEqual(live.moves_since(3), [])
+        # restored from the fen, the moves before it are unknown
+        restored = LiveGame(Game(room_id='unit'), None, live.board.copy(stack=False))
+        restored.ply_offset = 3
+        restored.play(chess.Move.from_uci('b8c6'), None)
+        self.assertIsNone(restored.moves_since(2))
+        self.assertEqual(restored.moves_since(3), [{'ply': 4, 'move': 'b8c6', 'played_at': None}])
+
+    @override_settings(CHESS_RESYNC_MAX_MOVES=3)
+    def test_reconnect(self):
+        async def run():
+            white, black = self.socket(self.white), self.socket(self.black)
+            for socket in (white, black):
+                await socket.connect()
+                await socket.receive_json_from()
+            await white.send_json_to({'action': 'create_game', 'base': 60000, 'increment': 0})
+            await white.receive_json_from()
+            await black.send_json_to({'action': 'join_game'})
+            for socket in (white, black):
+                await socket.receive_json_from()
+            for ply, move in enumerate(('e2e4', 'e7e5', 'g1f3', 'b8c6', 'f1c4'), start=1):
+                await (white, black)[(ply - 1) % 2].send_json_to({'action': 'make_move', 'move': move})
+                for socket in (white, black):
+                    await socket.receive_json_from()
+
+            resync = await self.rejoin(3)
+            self.assertEqual((resync['ply'], resync['from_ply']), (5, 3))
+            self.assertEqual([move['move'] for move in resync['moves']], ['b8c6', 'f1c4'])
+            self.assertIsNotNone(resync['moves'][0]['played_at'])
+            self.assertEqual(await self.rejoin(5), {'game_id': 'resync', 'ply': 5, 'from_ply': 5, 'moves': []})
+            # more than CHESS_RESYNC_MAX_MOVES behind, ahead of the game, or not a ply
+            for last_ply in (1, 9, 'x'):
+                resync = await self.rejoin(last_ply)
+                self.assertTrue(resync['snapshot'], last_ply)
+                self.assertEqual(resync['fen'], registry.games['resync'].board.fen())
+            # true is not ply 1: resyncing from 0 takes more than CHESS_RESYNC_MAX_MOVES moves
+            with self.settings(CHESS_RESYNC_MAX_MOVES=4):
+                self.assertTrue((await self.rejoin(True))['snapshot'])
+            for socket in (white, black):
+                await socket.disconnect()
+
+        async_to_sync(run)()
+
+
+class PackedMovesTests(TransactionTestCase):
+    """Game.moves_packed / move_times round-trip every move, and migrations 0007/0008 pack the
+    existing Move rows in play order"""
+
+    def test_round_trip(self):
+        promotions = [chess.Move.from_uci(uci) for uci in ('a7a8q', 'a2b1n', 'a8b8r', 'b1d2b')]
+        for move in promotions + [chess.Move.from_uci('h1g1'), chess.Move(chess.H8, chess.A1)]:
+            self.assertEqual(unpack_move(pack_move(move)), move)
+        self.assertLess(max(pack_move(move) for move in promotions), 2 ** 16)
+        self.assertEqual(unpack_values('I', pack_values('I', [0, 1, MAX_MOVE_DELTA])), [0, 1, MAX_MOVE_DELTA])
+        self.assertEqual(pack_values('H', [0x0102]), b'\x02\x01')
+        self.assertEqual(unpack_values('H', b''), [])
+
+    def test_append_move(self):
+        game = Game(room_id='packed')
+        self.assertEqual((game.moves, game.move_count), ([], 0))
+        for uci, delta in (('e2e4', 1500), ('e7e5', -20), ('g1f3', 2 ** 40)):
+            game.append_move(chess.Move.from_uci(uci), delta)
+        self.assertEqual(game.moves, ['e2e4', 'e7e5', 'g1f3'])
+        self.assertEqual(game.move_count, 3)
+        self.assertEqual(game.move_deltas, [1500, 0, MAX_MOVE_DELTA])
+        # the decoded moves are cached until the packed bytes change
+        self.assertIs(game.moves, game.moves)
+        game.append_move(chess.Move.from_uci('b8c6'), 0)
+        self.assertEqual(game.moves[-1], 'b8c6')
+        started = timezone.now()
+        self.assertEqual(game.played_times(started)[:2], [started + timedelta(milliseconds=1500)] * 2)
+        self.assertEqual(game.played_times(None), [None] * 4)
+        game.save()
+        saved = Game.objects.get(room_id='packed')
+        self.assertEqual((saved.moves, saved.move_deltas), (game.moves, game.move_deltas))
+
+    def test_migrations(self):
+        executor = MigrationExecutor(connection)
+        before, after = [('chess_app', '0006_game_over_type_timeout')], [('chess_app', '0008_game_packed_moves')]
+        try:
+            executor.migrate(before)
+            executor.loader.build_graph()
+            apps = executor.loader.project_state(before).apps
+            Game, Clock, Move = (apps.get_model('chess_app', name) for name in ('Game', 'Clock', 'Move'))
+            started = timezone.now() - timedelta(minutes=5)
+            played = Game.objects.create(room_id='played')
+            Clock.objects.create(game=played)
+            Clock.objects.filter(game=played).update(started_at=started)
+            Game.objects.create(room_id='unclocked')
+            Game.objects.create(room_id='empty')
+            # inserted out of order: the plies follow played_at
+            for offset, uci in ((3, 'g1f3'), (1, 'e2e4'), (2, 'e7e5')):
+                Move.objects.create(game=played, move=uci, played_at=started + timedelta(seconds=offset))
+            Move.objects.create(game_id='unclocked', move='d2d4', played_at=started)
+            Move.objects.create(game_id='unclocked', move='h2h1q', played_at=started)
+
+            executor = MigrationExecutor(connection)
+            executor.migrate(after)
+            apps = executor.loader.project_state(after).apps
+            Game, Move = apps.get_model('chess_app', 'Game'), apps.get_model('chess_app', 'Move')
+            self.assertEqual(list(Move.objects.filter(game_id='played').order_by('ply').values_list('ply', 'move')),
+                             [(1, 'e2e4'), (2, 'e7e5'), (3, 'g1f3')])
+            games = {game.room_id: game for game in Game.objects.all()}
+            played = games['played']
+            self.assertEqual([unpack_move(code).uci() for code in unpack_values('H', played.moves_packed)], ['e2e4', 'e7e5', 'g1f3'])
+            self.assertEqual(unpack_values('I', played.move_times), [1000, 1000, 1000])
+            # without a clock the first delta is unknown
+            self.assertEqual([unpack_move(code).uci() for code in unpack_values('H', games['unclocked'].moves_packed)], ['d2d4', 'h2h1q'])
+            self.assertEqual(unpack_values('I', games['unclocked'].move_times), [0, 0])
+            self.assertEqual(bytes(games['empty'].moves_packed), b'')
+        finally:
+            executor = MigrationExecutor(connection)
+            executor.migrate(executor.loader.graph.leaf_nodes())
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'plans are checked with EXPLAIN QUERY PLAN')
+class QueryPlanTests(TestCase):
+    """The hot queries must not fall back to a full table scan (or, when one index can serve
+    the filter and the order, to sorting the rows)"""
+
+    FULL_SCAN = re.compile(r'\bSCAN chess_app_\w+\b(?! USING)')
+
+    def games_page(self, **params):
+        request = Request(APIRequestFactory().get('/chess/', params))
+        games = filter_games(request).values(*GAME_LIST_VALUES).order_by(*GamePagination.ordering)
+        return games[:GamePagination.page_size + 1]
+
+    def assertPlan(self, queryset, sorted_by_index=True):
+        plan = queryset.explain()
+        self.assertIsNone(self.FULL_SCAN.search(plan), plan)
+        if sorted_by_index:
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_lobby(self):
+        self.assertPlan(waiting_games())
+
+    def test_games_pages(self):
+        self.assertPlan(self.games_page())
+        self.assertPlan(self.games_page(status='waiting'))
+        self.assertPlan(self.games_page(formats='bullet'))
+        # several values or either player: index searches, then a sort of the matching rows
+        self.assertPlan(self.games_page(status='waiting,active'), sorted_by_index=False)
+        self.assertPlan(self.games_page(player='alice'), sorted_by_index=False)
+
+    def test_move_history(self):
+        self.assertPlan(Move.objects.filter(game_id='game').order_by('ply'))
+
+
+class ConcurrentWriteTests(PlayersTestCase):
+    """Workers holding their own copy of a game must never overwrite each other's moves"""
+
+    def setUp(self):
+        super().setUp()
+        game = Game.objects.create(room_id='stress', player1=self.white, player2=self.black, status='active')
+        Clock.objects.create(game=game)
+
+    def test_concurrent_moves_apply_once(self):
+        line = scripted_moves(40, seed=3)
+        conflicts = 0
+
+        async def worker():
+            nonlocal conflicts
+            while True:
+                live = await load_game('stress')
+                if live.ply >= len(line):
+                    return
+                live.push(chess.Move.from_uci(line[live.ply]))
+                live.game.fen = live.board.fen()
+                await asyncio.sleep(0)  # let the other workers read the same version
+                try:
+                    await save_game(live.game, ['fen', 'moves_packed', 'move_times', 'updated_at'])
+                except StaleWrite:
+                    conflicts += 1
+
+        async def run():
+            await asyncio.gather(*(worker() for _ in range(8)))
+
+        async_to_sync(run)()
+        game = Game.objects.get(room_id='stress')
+        self.assertEqual(game.moves, line)
+        self.assertEqual(game.version, len(line))
+        self.assertEqual(game.fen, load_game.func('stress').board.fen())
+        self.assertGreater(conflicts, 0)
+
+    def test_stale_live_game_is_reloaded(self):
+        async def run():
+            white = WebsocketCommunicator(with_user(ChessConsumer.as_asgi(), self.white, 'stress'), '/ws/chess/stress/')
+            black = WebsocketCommunicator(with_user(ChessConsumer.as_asgi(), self.black, 'stress'), '/ws/chess/stress/')
+            for socket in (white, black):
+                await socket.connect()
+                await socket.receive_json_from()
+            await white.send_json_to({'action': 'make_move', 'move': 'e2e4'})
+            for socket in (white, black):
+                self.assertEqual((await socket.receive_json_from())['message']['info'], 'moved')
+
+            # another worker plays black's reply behind this process' live game
+            other = await load_game('stress')
+            other.push(chess.Move.from_uci('e7e5'))
+            other.game.fen = other.board.fen()
+            other.game.current_turn = 'player1'
+            await save_game(other.game, ['fen', 'current_turn', 'moves_packed', 'move_times'])
+
+            await black.send_json_to({'action': 'make_move', 'move': 'e7e5'})
+            self.assertEqual((await black.receive_json_from())['message']['error'], 'not your turn')
+            await white.send_json_to({'action': 'make_move', 'move': 'g1f3'})
+            moved = await white.receive_json_from()
+            self.assertEqual(moved['game']['ply'], 3)
+            for socket in (white, black):
+                await socket.disconnect()
+
+        async_to_sync(run)()
+        game = Game.objects.get(room_id='stress')
+        self.assertEqual(game.moves, ['e2e4', 'e7e5', 'g1f3'])
+
+
+@override_settings(CHESS_GAME_SHARDS=2)
+class GameShardTests(PlayersTestCase):
+    """Sockets forward their actions to the worker owning the game over the channel layer"""
+
+    def setUp(self):
+        super().setUp()
+        # the disconnects below are saved right away
+        self.grace, presence.grace = presence.grace, 0
+
+    def tearDown(self):
+        presence.grace = self.grace
+        super().tearDown()
+
+    def test_shard_channel_is_stable(self):
+        self.assertEqual(shard_channels(), ['chess-games-0', 'chess-games-1'])
+        self.assertIn(shard_channel('room1'), shard_channels())
+        self.assertEqual(shard_channel('room1'), shard_channel('room1'))
+        with self.settings(CHESS_GAME_SHARDS=0):
+            self.assertIsNone(shard_channel('room1'))
+
+    def test_actions_run_on_the_owning_worker(self):
+        async def run():
+            white = WebsocketCommunicator(with_user(ChessConsumer.as_asgi(), self.white, 'shard'), '/ws/chess/shard/')
+            black = WebsocketCommunicator(with_user(ChessConsumer.as_asgi(), self.black, 'shard'), '/ws/chess/shard/')
+            for socket in (white, black):
+                await socket.connect()
+                await socket.receive_json_from()
+
+            # nobody serves the shard yet, the action waits on its channel
+            await white.send_json_to({'action': 'create_game', 'base': 60000, 'increment': 0})
+            self.assertTrue(await white.receive_nothing(0.2))
+
+            router = ChannelNameRouter({channel: GameWorkerConsumer.as_asgi() for channel in shard_channels()})
+            worker = Worker(router, shard_channels(), get_channel_layer())
+            serving = asyncio.ensure_future(worker.handle())
+            try:
+                self.assertEqual((await white.receive_json_from(2))['message']['info'], 'created')
+                await black.send_json_to({'action': 'join_game'})
+                self.assertEqual((await black.receive_json_from(2))['message']['info'], 'joined')
+                await white.receive_json_from(2)
+                for move in ['e2e4', 'e7e5']:
+                    socket = white if move == 'e2e4' else black
+                    await socket.send_json_to({'action': 'make_move', 'move': move})
+                    for socket in (white, black):
+                        self.assertEqual((await socket.receive_json_from(2))['game']['move'], move)
+                await white.send_json_to({'action': 'make_move', 'move': 'e2e4'})
+                self.assertEqual((await white.receive_json_from(2))['message']['error'], 'illegal move')
+                # a spectator's first frame comes from the owning worker's live game
+                misses = registry.misses
+                ply, frame = await load_watch_frame('shard')
+                frame = json.loads(frame)
+                self.assertEqual((ply, frame['game']['ply'], frame['message']['info']), (2, 2, 'connected'))
+                self.assertEqual(registry.misses, misses)
+                self.assertIsNone(await load_watch_frame('nowhere'))
+                for socket in (white, black):
+                    await socket.disconnect()
+                await asyncio.sleep(0.1)  # let the worker save the disconnects
+            finally:
+                serving.cancel()
+                for instance in worker.application_instances.values():
+                    instance['future'].cancel()
+
+        async_to_sync(run)()
+        game = Game.objects.get(room_id='shard')
+        self.assertEqual(game.moves, ['e2e4', 'e7e5'])
+        self.assertEqual(game.status, 'waiting')
+        self.assertFalse(game.player1_connected or game.player2_connected)
+
+
+class SQLiteChannelLayerTests(SimpleTestCase):
+    """Two layers on one file stand in for two processes"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'channels.sqlite3')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def layer(self, **config):
+        return SQLiteChannelLayer(self.path, poll_interval=0.005, **config)
+
+    def test_send_between_processes(self):
+        async def run():
+            first, second = self.layer(), self.layer()
+            channel = await first.new_channel()
+            await second.send(channel, {'type': 'game.send', 'n': 1})
+            self.assertEqual(await asyncio.wait_for(first.receive(channel), 2), {'type': 'game.send', 'n': 1})
+            await second.send('chess-games-0', {'type': 'game.action'})
+            self.assertEqual(await asyncio.wait_for(first.receive('chess-games-0'), 2), {'type': 'game.action'})
+            await first.close()
+
+        async_to_sync(run)()
+
+    def test_group_send_reaches_every_process(self):
+        async def run():
+            first, second = self.layer(), self.layer()
+            channels = [await first.new_channel(), await second.new_channel()]
+            for layer, channel in zip((first, second), channels):
+                await layer.group_add('game_1', channel)
+            await first.group_send('game_1', {'type': 'game.send'})
+            for layer, channel in zip((first, second), channels):
+                self.assertEqual(await asyncio.wait_for(layer.receive(channel), 2), {'type': 'game.send'})
+            await second.group_discard('game_1', channels[1])
+            await first.group_send('game_1', {'type': 'game.send', 'n': 2})
+            self.assertEqual((await asyncio.wait_for(first.receive(channels[0]), 2))['n'], 2)
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(second.receive(channels[1]), 0.1)
+            for layer in (first, second):
+                await layer.close()
+
+        async_to_sync(run)()
+
+    def test_group_membership_expires(self):
+        async def run():
+            layer = self.layer(group_expiry=0.05)
+            channel = await layer.new_channel()
+            await layer.group_add('game_1', channel)
+            await asyncio.sleep(0.1)
+            await layer.group_send('game_1', {'type': 'game.send'})
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(layer.receive(channel), 0.1)
+            await layer.close()
+
+        async_to_sync(run)()
+
+    def test_capacity(self):
+        async def run():
+            layer = self.layer(capacity=2)
+            channel = await layer.new_channel()
+            await layer.group_add('game_1', channel)
+            await layer.send(channel, {'type': 'a'})
+            await layer.send(channel, {'type': 'b'})
+            with self.assertRaises(ChannelFull):
+                await layer.send(channel, {'type': 'c'})
+            await layer.group_send('game_1', {'type': 'd'})
+            self.assertEqual(layer.stats()['messages_dropped'], 1)
+
+        async_to_sync(run)()
+
+    def test_group_sends_are_batched(self):
+        async def run():
+            layer = self.layer()
+            channel = await layer.new_channel()
+            await layer.group_add('game_1', channel)
+            batches = layer.batches
+            await asyncio.gather(*(layer.group_send('game_1', {'type': 'game.send', 'n': n}) for n in range(50)))
+            self.assertLess(layer.batches - batches, 5)
+            received = [(await asyncio.wait_for(layer.receive(channel), 2))['n'] for _ in range(50)]
+            self.assertEqual(received, list(range(50)))
+            await layer.close()
+
+        async_to_sync(run)()
+
+
+@unittest.skipUnless(
+    importlib.util.find_spec('uvicorn') and importlib.util.find_spec('websockets'),
+    'needs uvicorn and websockets'
+)
+class MultiProcessTests(SimpleTestCase):
+    """Two uvicorn processes and a game shard worker sharing the SQLite channel layer"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.env = dict(
+            os.environ,
+            DJANGO_DB_NAME=os.path.join(self.dir.name, 'db.sqlite3'),
+            DJANGO_CHANNEL_LAYER='sqlite',
+            DJANGO_CHANNEL_LAYER_PATH=os.path.join(self.dir.name, 'channels.sqlite3'),
+            DJANGO_CHESS_GAME_SHARDS='1',
+        )
+        self.processes = []
+        self.manage('migrate', '-v', '0')
+        self.manage('shell', '-c', (
+            'from django.contrib.auth.models import User\n'
+            'from rest_framework.authtoken.models import Token\n'
+            'for name in ("white", "black"):\n'
+            '    Token.objects.create(key=name * 5, user=User.objects.create_user(name, password="x"))\n'
+        ))
+        self.ports = [self.free_port(), self.free_port()]
+        for port in self.ports:
+            self.start(sys.executable, '-m', 'uvicorn', 'backend.asgi:application', '--port', str(port), '--log-level', 'warning')
+        self.start(sys.executable, 'manage.py', 'runworker', 'chess-games-0')
+        for port in self.ports:
+            self.wait_for(port)
+
+    def tearDown(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait(10)
+        self.dir.cleanup()
+
+    def manage(self, *args):
+        subprocess.run([sys.executable, 'manage.py', *args], cwd=settings.BASE_DIR, env=self.env, check=True)
+
+    def start(self, *command):
+        self.processes.append(subprocess.Popen(command, cwd=settings.BASE_DIR, env=self.env))
+
+    @staticmethod
+    def free_port():
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    @staticmethod
+    def wait_for(port, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', port), 0.2).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise TimeoutError(f'nothing listening on {port}')
+
+    def test_players_on_different_processes(self):
+        from websockets.asyncio.client import connect
+
+        first, second = self.ports
+
+        async def receive(socket):
+            return json.loads(await asyncio.wait_for(socket.recv(), 10))
+
+        async def run():
+            async with connect(f'ws://127.0.0.1:{second}/ws/chess/?token={"black" * 5}') as lobby_socket, \
+                    connect(f'ws://127.0.0.1:{first}/ws/chess/mp1/?token={"white" * 5}') as white, \
+                    connect(f'ws://127.0.0.1:{second}/ws/chess/mp1/?token={"black" * 5}') as black:
+                connected = await receive(lobby_socket)
+                await receive(white)
+                await receive(black)
+
+                await white.send(json.dumps({'action': 'create_game', 'base': 60000, 'increment': 0, 'format': 'bullet'}))
+                self.assertEqual((await receive(white))['message']['info'], 'created')
+                announced = await receive(lobby_socket)
+                self.assertEqual((announced['game']['game_id'], announced['message']['info']), ('mp1', 'available'))
+                # the second process applied the first one's event to its own snapshot
+                await lobby_socket.send(json.dumps({'action': 'sync', 'version': connected['version']}))
+                synced = await receive(lobby_socket)
+                self.assertEqual([change['game_id'] for change in synced['changes']], ['mp1'])
+
+                await black.send(json.dumps({'action': 'join_game'}))
+                self.assertEqual((await receive(black))['message']['info'], 'joined')
+                self.assertEqual((await receive(white))['message']['info'], 'joined')
+
+                for mover, move in ((white, 'e2e4'), (black, 'e7e5'), (white, 'g1f3')):
+                    await mover.send(json.dumps({'action': 'make_move', 'move': move}))
+                    for player in (white, black):
+                        self.assertEqual((await receive(player))['game']['move'], move)
+
+        asyncio.run(run())
+
+
+class ProtocolTests(PlayersTestCase):
+    """Sockets asking for protocol v2 get moves as deltas, in JSON or MessagePack"""
+
+    def connect(self, user, subprotocols):
+        return WebsocketCommunicator(
+            with_user(ChessConsumer.as_asgi(), user, 'wire'), '/ws/chess/wire/', subprotocols=subprotocols
+        )
+
+    def test_v2_deltas(self):
+        async def run():
+            white, black = self.connect(self.white, ['chess.v2']), self.connect(self.black, ['chess.v2.msgpack', 'chess.v2'])
+            self.assertEqual((await white.connect())[1], 'chess.v2')
+            self.assertEqual((await black.connect())[1], 'chess.v2.msgpack')
+            self.assertEqual((await white.receive_json_from())['message']['protocol'], 'v2')
+            await black.receive_json_from()
+            await white.send_json_to({'action': 'create_game', 'base': 60000, 'increment': 0})
+            await white.receive_json_from()
+            await black.send_json_to({'action': 'join_game'})
+            for socket in (white, black):
+                self.assertEqual((await receive_frame(socket))[0]['message']['info'], 'joined')
+
+            for mover, move in zip((white, black, white, black), ('f2f3', 'e7e5', 'g2g4', 'd8h4')):
+                await mover.send_json_to({'action': 'make_move', 'move': move})
+                (text, _), (packed, _) = await receive_frame(white), await receive_frame(black)
+                self.assertEqual(text, packed)
+                self.assertEqual((text['t'], text['m']), ('moved', move))
+            self.assertEqual(text['p'], 4)
+            self.assertEqual((text['s'], text['w'], text['o']), ('ended', 'player2', 'checkmate'))
+            self.assertNotIn('fen', text)
+            for socket in (white, black):
+                await socket.disconnect()
+
+        async_to_sync(run)()
+
+    def test_negotiate(self):
+        offered = {'subprotocols': ['chess.v2.msgpack', 'chess.v2']}
+        self.assertEqual(negotiate({'subprotocols': ['chess.v3']}), (None, V1))
+        self.assertEqual(negotiate(offered), ('chess.v2.msgpack', V2_MSGPACK))
+        self.assertEqual(negotiate({'subprotocols': ['chess.v2', 'chess.v3']}), ('chess.v2', V2))
+
+    def test_frames_encoded_once(self):
+        encoded_frames.clear()
+        event = game_event({'game_id': 'wire'}, {'info': 'moved'}, {'t': 'moved', 'g': 'wire'})
+        text, _ = event_frame(event, V1)
+        self.assertEqual(json.loads(text), {'game': {'game_id': 'wire'}, 'message': {'info': 'moved'}})
+        # every socket gets its own copy of the event, they share the encoded frame
+        self.assertIs(event_frame(dict(event), V1)[0], text)
+        self.assertEqual(list(encoded_frames), [(event['id'], V1)])
+        self.assertEqual(json.loads(event_frame(event, V2)[0]), {'t': 'moved', 'g': 'wire'})
+        # without a delta v2 sockets get the v1 frame
+        other = game_event({'game_id': 'wire'}, {'info': 'resigned'})
+        self.assertIs(event_frame(other, V2)[0], event_frame(other, V1)[0])
+        self.assertEqual(len(encoded_frames), 3)
+        for _ in range(protocol.FRAME_CACHE_SIZE):
+            event_frame(game_event({}, {}), V1)
+        self.assertEqual(len(encoded_frames), protocol.FRAME_CACHE_SIZE)
+        self.assertNotIn((event['id'], V1), encoded_frames)
+
+    def test_v1_by_default(self):
+        async def run():
+            socket = self.connect(self.white, ['chess.v3'])
+            self.assertEqual(await socket.connect(), (True, None))
+            self.assertEqual((await socket.receive_json_from())['message']['protocol'], 'v1')
+            await socket.disconnect()
+
+        async_to_sync(run)()
+
+
+class SpectatorTests(PlayersTestCase):
+    """Spectators get one frame per tick with the moves played since the previous one"""
+
+    def setUp(self):
+        super().setUp()
+        self.fan = User.objects.create_user('fan', password='x')
+        self.tick, watch.tick = watch.tick, 0.3
+
+    def tearDown(self):
+        watch.tick = self.tick
+        super().tearDown()
+
+    def test_coalesced_frames(self):
+        async def run():
+            white = WebsocketCommunicator(with_user(ChessConsumer.as_asgi(), self.white, 'seen'), '/ws/chess/seen/')
+            black = WebsocketCommunicator(with_user(ChessConsumer.as_asgi(), self.black, 'seen'), '/ws/chess/seen/')
+            for socket in (white, black):
+                await socket.connect()
+                await socket.receive_json_from()
+            await white.send_json_to({'action': 'create_game', 'base': 60000, 'increment': 0})
+            await white.receive_json_from()
+            await black.send_json_to({'action': 'join_game'})
+            for socket in (white, black):
+                await socket.receive_json_from()
+
+            fan = WebsocketCommunicator(with_user(SpectatorConsumer.as_asgi(), self.fan, 'seen'), '/ws/chess/seen/watch/')
+            self.assertEqual((await fan.connect())[0], True)
+            snapshot = await fan.receive_json_from()
+            self.assertEqual(snapshot['message'], {'type': 'watch', 'info': 'connected'})
+            self.assertEqual((snapshot['game']['status'], snapshot['game']['ply']), ('active', 0))
+            # a spectator cannot play
+            await fan.send_json_to({'action': 'make_move', 'move': 'e2e4'})
+
+            for mover, move in zip((white, black, white, black), ('f2f3', 'e7e5', 'g2g4', 'd8h4')):
+                await mover.send_json_to({'action': 'make_move', 'move': move})
+                for socket in (white, black):
+                    await socket.receive_json_from()
+            frame = await fan.receive_json_from(timeout=2)
+            if frame['game']['ply'] < 4:
+                # the tick fell between the moves
+                frame = await fan.receive_json_from(timeout=2)
+            self.assertEqual(frame['game']['ply'], 4)
+            self.assertEqual((frame['game']['status'], frame['game']['over_type']), ('ended', 'checkmate'))
+            self.assertTrue(await fan.receive_nothing(timeout=0.5))
+            self.assertEqual(watch.stats()['spectators'], 1)
+            for socket in (white, black, fan):
+                await socket.disconnect()
+            self.assertEqual(watch.stats()['spectators'], 0)
+
+        async_to_sync(run)()
+
+    def test_snapshot_without_queries(self):
+        class Watcher:
+            def offer(self, frame):
+                return False
+
+        def frame(ply, info, **game):
+            return json.dumps({'game': dict(game, ply=ply), 'message': {'type': 'watch', 'info': info}})
+
+        async def run():
+            loads = []
+
+            async def load(room_id):
+                loads.append(room_id)
+                await asyncio.sleep(0.01)
+                return 3, frame(3, 'connected')
+
+            watchers = [Watcher(), Watcher()]
+            for watcher in watchers:
+                await watch.add('elsewhere', watcher)
+            # the game is played in another process: one load for every spectator connecting here
+            first, second = await asyncio.gather(watch.snapshot('elsewhere', load), watch.snapshot('elsewhere', load))
+            self.assertEqual((first, second), (frame(3, 'connected'), frame(3, 'connected')))
+            await get_channel_layer().group_send(watch_group('elsewhere'), {
+                'type': 'watch.frame', 'ply': 5, 'frame': frame(5, 'update', from_ply=3, moves=['e2e4', 'e7e5'])
+            })
+            for _ in range(100):
+                if watch.frames['elsewhere'][0] == 5:
+                    break
+                await asyncio.sleep(0.01)
+            # the next spectators start from the newest frame relayed here
+            self.assertEqual(
+                json.loads(await watch.snapshot('elsewhere', load)),
+                {'game': {'ply': 5, 'from_ply': None, 'moves': None}, 'message': {'type': 'watch', 'info': 'connected'}}
+            )
+            self.assertEqual(loads, ['elsewhere'])
+            for watcher in watchers:
+                await watch.discard('elsewhere', watcher)
+            self.assertNotIn('elsewhere', watch.frames)
+
+        async_to_sync(run)()
+
+    def test_latest_frame_only(self):
+        async def run():
+            sent, slow = [], asyncio.Event()
+
+            async def base_send(message):
+                await slow.wait()
+                sent.append(message['text'])
+
+            consumer = SpectatorConsumer()
+            consumer.pending, consumer.sender, consumer.base_send = None, None, base_send
+            self.assertFalse(consumer.offer('a'))
+            await asyncio.sleep(0)  # 'a' is being sent
+            self.assertFalse(consumer.offer('b'))
+            self.assertTrue(consumer.offer('c'))
+            slow.set()
+            await consumer.sender
+            self.assertEqual(sent, ['a', 'c'])
+            self.assertIsNone(consumer.sender)
+
+        async_to_sync(run)()
+
+
+class RateLimitTests(TransactionTestCase):
+    """Game sockets are throttled per socket and per user, and slow readers are dropped"""
+
+    def setUp(self):
+        clear_live_state()
+        limiter.clear()
+        self.user = User.objects.create_user('flood', password='x')
+
+    def tearDown(self):
+        clear_live_state()
+        limiter.clear()
+
+    def test_buckets(self):
+        sockets = [TokenBucket(5, 20, now=0) for _ in range(3)]
+        self.assertEqual(limiter.check(sockets[0], 1, 'create_game', now=0), 0)
+        self.assertEqual(limiter.check(sockets[0], 1, 'create_game', now=0), 0)
+        # the socket is empty
+        self.assertEqual(limiter.check(sockets[0], 1, 'make_move', now=0), 0.2)
+        for _ in range(10):
+            self.assertEqual(limiter.check(sockets[1], 1, 'join_game', now=0), 0)
+        # a fresh socket, but its user spent 40 tokens
+        self.assertEqual(limiter.check(sockets[2], 1, 'make_move', now=0), 0.1)
+        self.assertEqual(sockets[2].tokens, 20)
+        self.assertEqual(limiter.check(sockets[2], 2, 'make_move', now=0), 0)
+        self.assertEqual(limiter.check(sockets[2], 1, 'make_move', now=0.1), 0)
+
+    def test_flood(self):
+        async def run():
+            socket = WebsocketCommunicator(with_user(ChessConsumer.as_asgi(), self.user, 'flood'), '/ws/chess/flood/')
+            await socket.connect()
+            await socket.receive_json_from()
+            await socket.send_json_to({'action': 'shout', 'payload': 'x' * 1000})
+            reply = await socket.receive_json_from()
+            self.assertEqual(reply['message']['error'], 'Unknown action')
+            self.assertNotIn('x' * 1000, json.dumps(reply))
+
+            for _ in range(30):
+                await socket.send_json_to({'action': 'shout'})
+            replies = []
+            while not await socket.receive_nothing(timeout=0.2):
+                replies.append((await socket.receive_json_from())['message'])
+            # 20 tokens at 2 a message: 9 more answers, then a single notice
+            self.assertEqual(len(replies), 10)
+            self.assertEqual(replies[-1]['info'], 'limited')
+            self.assertGreater(limiter.stats()['limited_socket'], 0)
+
+            await socket.send_to(text_data='x' * 5000)
+            self.assertEqual((await socket.receive_output())['code'], 1009)
+
+        async_to_sync(run)()
+
+    def test_slow_reader_closed(self):
+        async def run():
+            written, stuck = [], asyncio.Event()
+
+            async def base_send(message):
+                if message['type'] == 'websocket.send':
+                    await stuck.wait()
+                written.append(message)
+
+            consumer = ChessConsumer()
+            consumer.outbox, consumer.sending, consumer.closing = deque(), None, False
+            consumer.base_send = base_send
+            overflows = limiter.send_overflows
+            for index in range(limiter.send_buffer + 2):
+                await consumer.send(text_data=str(index))
+            self.assertEqual(written, [{'type': 'websocket.close', 'code': 1013}])
+            self.assertEqual(limiter.send_overflows, overflows + 1)
+            self.assertFalse(consumer.outbox)
+            consumer.sending.cancel()
+
+        async_to_sync(run)()
+
+
+class ReaperTests(PlayersTestCase):
+    """Stale games are ended in one UPDATE, whatever their connected flags say, and leave the
+    lobby in one message"""
+
+    def setUp(self):
+        super().setUp()
+        lobby.games.clear()
+        lobby.loaded_at = None
+        now = timezone.now()
+        games = {
+            'left': ({}, 11),  # nobody joined, creator gone for 11 minutes
+            'bothgone': ({'player2': self.black}, 31),
+            'fresh': ({}, 5),
+            'creatorhere': ({'player1_connected': True}, 60),
+            'recentlyleft': ({'player2': self.black}, 15),
+            'playing': ({'status': 'active', 'player2': self.black}, 60),
+            # left set by a process that stopped before its players' leaves ran
+            'stuck': ({'player2': self.black, 'player1_connected': True, 'player2_connected': True}, 31),
+            'stuckplaying': ({'status': 'active', 'player2': self.black, 'player1_connected': True, 'player2_connected': True}, 7 * 60),
+        }
+        for room_id, (fields, minutes) in games.items():
+            game = Game.objects.create(room_id=room_id, player1=self.white, format='bliz', **fields)
+            Clock.objects.create(game=game, total_time=300000, incremental_time=0, clock1=300000, clock2=300000)
+            Game.objects.filter(room_id=room_id).update(updated_at=now - timedelta(minutes=minutes))
+
+    def tearDown(self):
+        super().tearDown()
+        lobby.games.clear()
+        lobby.loaded_at = None
+
+    def test_reap(self):
+        async def run():
+            socket = WebsocketCommunicator(with_user(ChessRoomConsumer.as_asgi(), self.white, None), '/ws/chess/')
+            await socket.connect()
+            listed = await socket.receive_json_from()
+            self.assertEqual(len(listed['games']), 6)
+
+            reaped = await reap()
+            self.assertEqual(sorted((game['room_id'], game['abandoned']) for game in reaped), [
+                ('bothgone', 'disconnected'), ('creatorhere', 'waiting'), ('left', 'waiting'),
+                ('stuck', 'disconnected'), ('stuckplaying', 'active'),
+            ])
+
+            removed = await socket.receive_json_from()
+            self.assertEqual(sorted(removed['game_ids']), ['bothgone', 'creatorhere', 'left', 'stuck', 'stuckplaying'])
+            self.assertEqual(removed['version'], lobby.version)
+            self.assertTrue(await socket.receive_nothing())
+            self.assertEqual(len(lobby.snapshot()[1]), 2)
+            await socket.disconnect()
+
+        async_to_sync(run)()
+        game = Game.objects.get(room_id='left')
+        self.assertEqual((game.status, game.over_type, game.version), ('ended', 'abandoned', 1))
+        self.assertEqual(Game.objects.get(room_id='fresh').status, 'waiting')
+        self.assertEqual(Game.objects.get(room_id='stuck').status, 'ended')
+        self.assertEqual(Game.objects.get(room_id='playing').status, 'active')
+
+        with CaptureQueriesContext(connection) as queries:
+            reaped = reap_games(waiting_after=60)
+        self.assertEqual([game['room_id'] for game in reaped], ['fresh'])
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('UPDATE')]), 1)
+
+        out = io.StringIO()
+        call_command('reap_games', '--disconnected-after', '60', '--dry-run', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Would reap 1 stale games (0 waiting, 1 disconnected, 0 active)')
+        self.assertEqual(Game.objects.get(room_id='recentlyleft').status, 'waiting')
+
+
+class PresenceTests(PlayersTestCase):
+    """A player who drops and comes back within the grace period costs no write, tabs are counted"""
+
+    game_id = 'flaky'
+
+    def setUp(self):
+        super().setUp()
+        self.grace, presence.grace = presence.grace, 0.3
+
+    def tearDown(self):
+        presence.grace = self.grace
+        super().tearDown()
+
+    async def start(self):
+        white, black = self.socket(self.white), self.socket(self.black)
+        for socket in (white, black):
+            await socket.connect()
+            await socket.receive_json_from()
+        await white.send_json_to({'action': 'create_game', 'base': 60000, 'increment': 0})
+        await white.receive_json_from()
+        await black.send_json_to({'action': 'join_game'})
+        for socket in (white, black):
+            await socket.receive_json_from()
+        await white.send_json_to({'action': 'make_move', 'move': 'e2e4'})
+        for socket in (white, black):
+            await socket.receive_json_from()
+        return white, black
+
+    async def rejoin(self, user):
+        socket = self.socket(user)
+        await socket.connect()
+        await socket.receive_json_from()
+        await socket.send_json_to({'action': 'join_game', 'last_ply': 1})
+        # the broadcast and the reply to this socket may come in either order
+        infos = {(await socket.receive_json_from())['message']['info'] for _ in range(2)}
+        self.assertEqual(infos, {'reconnected', 'resync'})
+        return socket
+
+    def test_reconnect_within_grace(self):
+        async def run():
+            white, black = await self.start()
+            version = (await Game.objects.aget(room_id='flaky')).version
+            await black.disconnect()
+            black = await self.rejoin(self.black)
+            await asyncio.sleep(0.5)
+            game = await Game.objects.aget(room_id='flaky')
+            self.assertEqual((game.status, game.player2_connected, game.version), ('active', True, version))
+            self.assertEqual(presence.stats()['resumed'], 1)
+
+            # gone for longer than the grace period
+            await black.disconnect()
+            await asyncio.sleep(0.5)
+            game = await Game.objects.aget(room_id='flaky')
+            self.assertEqual((game.status, game.player2_connected), ('waiting', False))
+            await white.disconnect()
+
+        async_to_sync(run)()
+
+    def test_tabs(self):
+        async def run():
+            white, black = await self.start()
+            second = await self.rejoin(self.black)
+            self.assertEqual(presence.connected('flaky', self.black.pk), 2)
+            await black.disconnect()
+            await asyncio.sleep(0.5)
+            game = await Game.objects.aget(room_id='flaky')
+            self.assertEqual((game.status, game.player2_connected), ('active', True))
+            self.assertEqual(presence.connected('flaky', self.black.pk), 1)
+            for socket in (white, second):
+                await socket.disconnect()
+
+        async_to_sync(run)()
+
+    def test_shutdown(self):
+        async def run():
+            presence.grace = 60
+            white, black = await self.start()
+            for socket in (white, black):
+                await socket.disconnect()
+            self.assertEqual(presence.stats()['pending_leaves'], 2)
+            messages = iter([{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+            sent = []
+
+            async def receive():
+                return next(messages)
+
+            async def send(message):
+                sent.append(message['type'])
+
+            # the server closed the sockets, then shuts down within the grace period
+            await lifespan({'type': 'lifespan'}, receive, send)
+            self.assertEqual(sent[-1], 'lifespan.shutdown.complete')
+            self.assertEqual(presence.stats()['pending_leaves'], 0)
+            game = await Game.objects.aget(room_id='flaky')
+            self.assertEqual((game.status, game.player1_connected, game.player2_connected), ('waiting', False, False))
+
+        async_to_sync(run)()
+
+
+class MetricsTests(PlayersTestCase):
+    """Websocket actions, sockets and queries show up at GET /chess/metrics/"""
+
+    game_id = 'metered'
+
+    def setUp(self):
+        super().setUp()
+        metrics.clear()
+
+    def test_histogram(self):
+        histogram = Histogram('chess_test_seconds', "Test", ('action',), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, 'make_move')
+        self.assertEqual(histogram.render()[2:], [
+            'chess_test_seconds_bucket{action="make_move",le="0.1"} 2',
+            'chess_test_seconds_bucket{action="make_move",le="1"} 3',
+            'chess_test_seconds_bucket{action="make_move",le="+Inf"} 4',
+            'chess_test_seconds_sum{action="make_move"} 3.65',
+            'chess_test_seconds_count{action="make_move"} 4',
+        ])
+
+    def test_threads(self):
+        # the database threads observe while the event loop renders
+        histogram = Histogram('chess_test_seconds', "Test", buckets=(0.1, 1))
+        stop = threading.Event()
+
+        def render():
+            while not stop.is_set():
+                histogram.render()
+
+        def observe():
+            for _ in range(20000):
+                histogram.observe(0.5)
+
+        reader = threading.Thread(target=render)
+        reader.start()
+        writers = [threading.Thread(target=observe) for _ in range(4)]
+        for thread in writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        stop.set()
+        reader.join()
+        self.assertIn('chess_test_seconds_count 80000', histogram.render())
+
+    @override_settings(DEBUG=True)
+    def test_actions(self):
+        async def run():
+            white, black = self.socket(self.white), self.socket(self.black)
+            for socket in (white, black):
+                await socket.connect()
+                await socket.receive_json_from()
+            await white.send_json_to({'action': 'create_game', 'base': 60000, 'increment': 0})
+            await white.receive_json_from()
+            await black.send_json_to({'action': 'join_game'})
+            for socket in (white, black):
+                await socket.receive_json_from()
+            await white.send_json_to({'action': 'make_move', 'move': 'e2e4'})
+            for socket in (white, black):
+                await socket.receive_json_from()
+            await white.send_json_to({'action': 'dance'})
+            await white.receive_json_from()
+
+            response = await self.async_client.get('/chess/metrics/')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response['Content-Type'].startswith('text/plain'))
+            text = response.content.decode()
+            for line in (
+                'chess_sockets{consumer="game"} 2',
+                'chess_action_seconds_count{consumer="game",action="connect"} 2',
+                'chess_action_seconds_count{consumer="game",action="make_move"} 1',
+                'chess_action_seconds_count{consumer="game",action="other"} 1',
+                'chess_live_active 1',
+                'chess_layer_game_group_members 2',
+            ):
+                self.assertIn(line, text.splitlines())
+            created = re.search(r'^chess_action_queries_sum\{consumer="game",action="create_game"\} (\S+)$', text, re.M)
+            self.assertGreater(float(created.group(1)), 0)
+            self.assertRegex(text, r'(?m)^chess_layer_send_seconds_count\{method="group_send"\} [1-9]')
+
+            for socket in (white, black):
+                await socket.disconnect()
+            text = (await self.async_client.get('/chess/metrics/')).content.decode()
+            self.assertIn('chess_sockets{consumer="game"} 0', text.splitlines())
+
+        async_to_sync(run)()
+
+    @override_settings(CHESS_METRICS_TOKEN='scrape')
+    def test_token(self):
+        self.assertEqual(self.client.get('/chess/metrics/').status_code, 403)
+        self.assertEqual(self.client.get('/chess/metrics/', HTTP_AUTHORIZATION='Bearer other').status_code, 403)
+        response = self.client.get('/chess/metrics/', HTTP_AUTHORIZATION='Bearer scrape')
+        self.assertEqual(response.status_code, 200)
+        with override_settings(DEBUG=True):
+            self.assertEqual(self.client.get('/chess/metrics/').status_code, 403)
+
+    @override_settings(CHESS_METRICS_TOKEN=None, DEBUG=False)
+    def test_closed_by_default(self):
+        self.assertEqual(self.client.get('/chess/metrics/').status_code, 403)
+        self.client.force_login(self.white)
+        self.assertEqual(self.client.get('/chess/metrics/').status_code, 403)
+        User.objects.filter(pk=self.white.pk).update(is_staff=True)
+        self.assertEqual(self.client.get('/chess/metrics/').status_code, 200)
+
+
+class ProfilerTests(PlayersTestCase):
+    """Sampled actions are profiled per action and printed by `manage.py profile_actions`"""
+
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.TemporaryDirectory()
+        self.saved = (profiler.enabled, profiler.every, profiler.directory)
+        profiler.enabled, profiler.every, profiler.directory = True, {'make_move': 2}, self.dir.name
+        profiler.clear()
+
+    def tearDown(self):
+        profiler.enabled, profiler.every, profiler.directory = self.saved
+        profiler.clear()
+        self.dir.cleanup()
+        super().tearDown()
+
+    def test_sampled_moves(self):
+        async def run():
+            sockets = [
+                WebsocketCommunicator(with_user(ChessConsumer.as_asgi(), user, 'profiled'), '/ws/chess/profiled/')
+                for user in (self.white, self.black)
+            ]
+            for socket in sockets:
+                await socket.connect()
+                await socket.receive_json_from()
+            await sockets[0].send_json_to({'action': 'create_game', 'base': 60000, 'increment': 0})
+            await sockets[0].receive_json_from()
+            await sockets[1].send_json_to({'action': 'join_game'})
+            for socket in sockets:
+                await socket.receive_json_from()
+            for ply, move in enumerate(('e2e4', 'e7e5', 'g1f3', 'b8c6')):
+                await sockets[ply % 2].send_json_to({'action': 'make_move', 'move': move})
+                for socket in sockets:
+                    await socket.receive_json_from()
+            for socket in sockets:
+                await socket.disconnect()
+
+        samples = profiler.samples
+        async_to_sync(run)()
+        # every second move, nothing of the other actions (one in 100)
+        self.assertEqual(profiler.samples - samples, 2)
+        self.assertEqual([os.path.basename(path).split('.')[0] for path in os.listdir(self.dir.name)], ['make_move'])
+
+        out = io.StringIO()
+        call_command('profile_actions', dir=self.dir.name, sort='cumulative', limit=5, clear=True, stdout=out)
+        self.assertIn('== make_move: 1 process(es)', out.getvalue())
+        self.assertIn('handle', out.getvalue())
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+
+class ActionBudgetTests(PlayersTestCase):
+    """SQL queries and peak tracemalloc allocations of each websocket action stay within
+    the budgets in action_budgets.json
+
+    Queries are those of the action's metrics span, so they are counted in the database
+    thread too. A first game warms the process' caches up, the second one is measured.
+    Raise a budget only for a change that needs it, in the same commit.
+    """
+
+    BUDGETS = os.path.join(os.path.dirname(__file__), 'action_budgets.json')
+
+    def setUp(self):
+        super().setUp()
+        lobby.loaded_at = None
+        with open(self.BUDGETS) as budgets:
+            self.budgets = json.load(budgets)
+        # waiting games the lobby loads on connect, one query whatever their number
+        for index in range(5):
+            creator = User.objects.create_user(f'waiting{index}', password='x')
+            game = Game.objects.create(room_id=f'waiting{index}', player1=creator, format='bliz', status='waiting')
+            Clock.objects.create(game=game, total_time=300000, incremental_time=0, clock1=300000, clock2=300000)
+        self.grace = presence.grace
+        self.measured = {}
+        tracemalloc.start()
+
+    def tearDown(self):
+        tracemalloc.stop()
+        presence.grace = self.grace
+        super().tearDown()
+
+    async def measure(self, name, spans, coroutine):
+        """Run coroutine (an action and its replies), keep the most any run of name took"""
+        metrics.clear()
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        await coroutine
+        peak = tracemalloc.get_traced_memory()[1] - before
+        queries = sum(metrics.action_queries.values[span][1] for span in spans)
+        measured = self.measured.setdefault(name, {'queries': 0, 'peak_kib': 0})
+        measured['queries'] = max(measured['queries'], queries)
+        measured['peak_kib'] = max(measured['peak_kib'], round(peak / 1024))
+
+    async def game(self, game_id, measure):
+        async def step(name, spans, coroutine):
+            if measure:
+                await self.measure(name, spans, coroutine)
+            else:
+                await coroutine
+
+        async def reply(socket, content, receivers):
+            await socket.send_json_to(content)
+            for receiver in receivers:
+                await receiver.receive_json_from()
+
+        async def lobby_connect():
+            await room.connect()
+            await room.receive_json_from()
+
+        room = WebsocketCommunicator(with_user(ChessRoomConsumer.as_asgi(), self.black, None), '/ws/chess/')
+        await step('lobby_connect', [('lobby', 'connect')], lobby_connect())
+        await room.disconnect()
+
+        white, black = self.socket(self.white, game_id), self.socket(self.black, game_id)
+        for socket in (white, black):
+            await socket.connect()
+            await socket.receive_json_from()
+        await step('create_game', [('game', 'create_game')], reply(
+            white, {'action': 'create_game', 'base': 60000, 'increment': 0, 'format': 'bullet'}, [white]
+        ))
+        await step('join_game', [('game', 'join_game')], reply(black, {'action': 'join_game'}, [black, white]))
+        for ply, move in enumerate(('e2e4', 'e7e5', 'g1f3', 'b8c6')):
+            await step('make_move', [('game', 'make_move')], reply(
+                (white, black)[ply % 2], {'action': 'make_move', 'move': move}, [white, black]
+            ))
+
+        # black's connection drops: left right away without a grace period, then back
+        presence.grace = 0
+        await step('leave', [('game', 'disconnect')], black.disconnect())
+        presence.grace = self.grace
+
+        async def reconnect():
+            await black.connect()
+            await black.receive_json_from()
+            await black.send_json_to({'action': 'join_game', 'last_ply': 4})
+            for socket in (black, black, white):
+                await socket.receive_json_from()
+
+        black = self.socket(self.black, game_id)
+        await step('reconnect', [('game', 'connect'), ('game', 'join_game')], reconnect())
+        await step('resign_game', [('game', 'resign_game')], reply(black, {'action': 'resign_game'}, [black, white]))
+        for socket in (white, black):
+            await socket.disconnect()
+
+    def test_budgets(self):
+        async def run():
+            await self.game('warmup', measure=False)
+            lobby.loaded_at = None
+            await self.game('budget', measure=True)
+
+        async_to_sync(run)()
+        for name, budget in self.budgets.items():
+            with self.subTest(name):
+                measured = self.measured[name]
+                self.assertLessEqual(measured['queries'], budget['queries'], f'{name} measured {measured}')
+                self.assertLessEqual(measured['peak_kib'], budget['peak_kib'], f'{name} measured {measured}')
+
+
+class GenerateGamesTests(TransactionTestCase):
+    """The synthetic dataset: every status and format, moves that replay to the stored position"""
+
+    def test_generate(self):
+        out = io.StringIO()
+        call_command('generate_games', games=300, users=20, batch=70, lines=20, seed=1, move_rows=True, stdout=out)
+        self.assertRegex(
+            out.getvalue().splitlines()[-1],
+            r'^Generated 300 games \(\d+ waiting, \d+ active, \d+ ended\), 20 users, \d+ move rows in '
+        )
+        self.assertEqual(User.objects.filter(username__startswith='syn').count(), 20)
+        self.assertEqual(Clock.objects.filter(game__room_id__startswith='syn').count(), 300)
+        games = list(Game.objects.filter(room_id__startswith='syn'))
+        self.assertEqual(len(games), 300)
+        self.assertEqual({game.status for game in games}, {'waiting', 'active', 'ended'})
+        self.assertEqual({game.format for game in games}, {'bullet', 'bliz', 'rapid', 'classic', 'custom'})
+        self.assertEqual(Move.objects.count(), sum(game.move_count for game in games))
+        played = max(games, key=lambda game: game.move_count)
+        self.assertEqual(
+            list(Move.objects.filter(game=played).order_by('ply').values_list('move', flat=True)), played.moves
+        )
+
+        for game in games:
+            board = chess.Board()
+            for move in game.moves:
+                board.push_uci(move)
+            self.assertEqual(board.fen(), game.fen)
+            self.assertEqual(len(game.move_times), len(game.moves_packed) * 2)
+            self.assertGreaterEqual(game.updated_at, game.created_at)
+            if game.player2_id is None:
+                self.assertEqual(game.move_count, 0)
+            if game.over_type == 'checkmate':
+                self.assertTrue(board.is_checkmate())
+                self.assertNotEqual(game.winner, game.current_turn)
+            white = game.player1_color == 'white'
+            self.assertEqual(game.current_turn == 'player1', white == board.turn)
+
+        with self.assertRaises(CommandError):
+            call_command('generate_games', games=10, users=2, stdout=io.StringIO())
@@ -1,8 +1,8 @@
 from django.urls import path, include
 
-from . import apiviews
+from . import apiviews, views
 
 urlpatterns = [
     path('', apiviews.get_games, name='get-games'),
-    
-]
\ No newline at end of file
+    path('metrics/', views.prometheus_metrics, name='metrics'),
+]
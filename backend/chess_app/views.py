@@ -1,3 +1,65 @@
-from django.shortcuts import render
+import hmac
 
-# Create your views here.
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.http import require_GET
+
+from .live import registry
+from .lobby import LOBBY_GROUP
+from .metrics import metrics
+from .middlewares import token_cache
+from .persistence import writer
+from .presence import presence
+from .profiling import profiler
+from .ratelimit import limiter
+from .reaper import reaper
+from .spectators import watch
+
+GROUP_KINDS = (('game', 'game_'), ('watch', 'watch_'), ('lobby', LOBBY_GROUP))
+
+
+def layer_stats(layer):
+    """The layer's own stats, and its group sizes where it keeps groups in this process (in-memory layer)"""
+    stats = layer.stats() if hasattr(layer, 'stats') else {}
+    groups = getattr(layer, 'groups', None)
+    if isinstance(groups, dict):
+        for kind, prefix in GROUP_KINDS:
+            sizes = [len(members) for group, members in groups.items() if group.startswith(prefix)]
+            stats[f'{kind}_groups'] = len(sizes)
+            stats[f'{kind}_group_members'] = sum(sizes)
+            stats[f'{kind}_group_members_max'] = max(sizes, default=0)
+    return stats
+
+
+async def may_scrape(request):
+    """`Authorization: Bearer <CHESS_METRICS_TOKEN>` when a token is set, anyone with DEBUG on
+    when it is not, and staff users either way"""
+    token = getattr(settings, 'CHESS_METRICS_TOKEN', None)
+    if token:
+        if hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return True
+    elif settings.DEBUG:
+        return True
+    user = await request.auser()
+    return user.is_staff
+
+
+@require_GET
+async def prometheus_metrics(request):
+    """This process' metrics in the Prometheus text format, for scrapers allowed by may_scrape"""
+    # async: the singletons are read on the event loop that changes them
+    if not await may_scrape(request):
+        return HttpResponseForbidden()
+    stats = [
+        ('chess_live', "Live game cache (chess_app/live.py)", registry.stats()),
+        ('chess_write_behind', "Write-behind persistence (chess_app/persistence.py)", writer.stats()),
+        ('chess_token_cache', "Websocket token cache (chess_app/middlewares.py)", token_cache.stats()),
+        ('chess_watch', "Spectator fan-out (chess_app/spectators.py)", watch.stats()),
+        ('chess_rate_limit', "Flood protection (chess_app/ratelimit.py)", limiter.stats()),
+        ('chess_reaper', "Stale game reaping (chess_app/reaper.py)", reaper.stats()),
+        ('chess_presence', "Players' sockets on games (chess_app/presence.py)", presence.stats()),
+        ('chess_layer', "Channel layer", layer_stats(get_channel_layer())),
+        ('chess_profiler', "Sampled action profiles (chess_app/profiling.py)", profiler.stats()),
+    ]
+    return HttpResponse(metrics.render(stats), content_type='text/plain; version=0.0.4; charset=utf-8')